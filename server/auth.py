@@ -1,33 +1,108 @@
+from collections import OrderedDict
 import datetime
+import threading
+import time
 import jwt
 
 
+class TokenCache(object):
+  def __init__(self, token_cache_size, metrics):
+    self.max_size = token_cache_size
+    self.entries = OrderedDict()
+    self.lock = threading.Lock()
+    self.hits = 0
+    self.misses = 0
+    metrics.counter('token_cache_hits_total', 'Token claims found cached',
+                    fn=lambda: self.hits)
+    metrics.counter('token_cache_misses_total', 'Token claims decoded',
+                    fn=lambda: self.misses)
+    metrics.gauge('token_cache_entries', 'Token claims cached',
+                  lambda: len(self.entries))
+
+  def get(self, token):
+    with self.lock:
+      entry = self.entries.pop(token, None)
+      if entry is None:
+        self.misses += 1
+        return None
+      expires, claim = entry
+      if expires < time.time():
+        self.misses += 1
+        return None
+      # re-insert to mark it as the most recently used
+      self.entries[token] = entry
+      self.hits += 1
+      return claim
+
+  def put(self, token, claim):
+    expires = claim.get('exp')
+    if not isinstance(expires, (int, long)) or self.max_size <= 0:
+      return
+    with self.lock:
+      self.entries.pop(token, None)
+      self.entries[token] = (expires, claim)
+      while len(self.entries) > self.max_size:
+        self.entries.popitem(last=False)
+
+  def clear(self):
+    with self.lock:
+      self.entries.clear()
+
+
 class TokenAuthentication(object):
-  def __init__(self, jwt_secret, provide_request, token_ttl):
+  def __init__(self, jwt_secret, current_request, token_ttl, token_cache,
+               max_session_age):
     self.secret = jwt_secret
     self.ttl = token_ttl
-    self.provide_request = provide_request
+    self.current_request = current_request
+    self.cache = token_cache
+    self.max_session_age = max_session_age.total_seconds()
 
-  def generate_token(self, user):
+  def generate_token(self, user, auth_time=None):
+    # auth_time is when the session started with a password, refreshed
+    # tokens carry it over; epoch is the user's token_epoch at issue time
+    if auth_time is None:
+      auth_time = int(time.time())
     user_info = dict(id=user.id, login=user.login, name=user.name)
-    claim = dict(user=user_info, exp=datetime.datetime.utcnow() + self.ttl)
+    claim = dict(user=user_info, exp=datetime.datetime.utcnow() + self.ttl,
+                 auth_time=auth_time, epoch=user.token_epoch)
     return jwt.encode(claim, self.secret)
 
   def get_claim(self, request):
     token = request.headers.get('JWT')
     if token is None:
       return None
+    claim = self.cache.get(token)
+    if claim is not None:
+      return claim
     try:
-      return jwt.decode(token, self.secret)
+      claim = jwt.decode(token, self.secret)
     except:
       return None
+    self.cache.put(token, claim)
+    return claim
 
-  def get_user_id(self):
-    claim = self.get_claim(self.provide_request())
-    if claim is None:
+  def get_refreshable_claim(self, request):
+    # the request's claim, if its session is young enough to be extended
+    claim = self.get_claim(request)
+    if claim is None or self.claim_user_id(claim) is None:
       return None
+    auth_time = claim.get('auth_time')
+    if (not isinstance(auth_time, (int, long)) or
+        auth_time + self.max_session_age < time.time()):
+      return None
+    return claim
+
+  @staticmethod
+  def claim_user_id(claim):
     user_id = claim.get('user', {}).get('id')
     if not isinstance(user_id, int):
       return None
     else:
       return user_id
+
+  def get_user_id(self):
+    claim = self.get_claim(self.current_request())
+    if claim is None:
+      return None
+    return self.claim_user_id(claim)
@@ -0,0 +1,274 @@
+# Load generator for the REST API. Drives the WSGI app built by
+# wiring.web_graph in-process, or over a local socket through the threaded
+# server, and reports throughput and latency percentiles per scenario.
+#
+# Run from the server folder:
+#   python benchmarks/api.py --save results.json
+#   python benchmarks/api.py --mode socket --baseline results.json
+#
+# A scenario regresses when its throughput drops, or its p95 latency grows,
+# by more than --tolerance against the baseline; the exit status is then 1,
+# as it is when a scenario's requests fail.
+import argparse
+import json
+import logging
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import wsgiref.simple_server
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import pinject
+import requests
+from werkzeug.test import Client
+from werkzeug.wrappers import BaseResponse
+from db import DbCreator
+from models import Timezone, User
+import rest_server
+import serving
+import wiring
+
+SCENARIOS = ['login', 'list', 'list_q', 'crud']
+SIZES = [10, 1000, 50000]
+CITIES = ['Rosario', 'Cordoba', 'Mendoza', 'Salta', 'Ushuaia', 'Madrid',
+          'Lisbon', 'Tokyo', 'Auckland', 'Honolulu']
+
+
+class BenchConfigModule(pinject.BindingSpec):
+  def __init__(self, db_url):
+    self.db_url = db_url
+
+  def configure(self, bind):
+    bind('db_url', to_instance=self.db_url)
+    bind('db_verbose', to_instance=False)
+    bind('debug', to_instance=False)
+    bind('hashing_workers', to_instance=0)
+    bind('password_hash_rounds', to_instance=1000)
+    bind('profile_secret', to_instance='')
+    bind('profile_sample_rate', to_instance=0)
+    bind('tzcatalog_path', to_instance=os.path.join(tempfile.gettempdir(),
+                                                    'timezones-tzcatalog.bin'))
+
+  def provide_jwt_secret(self):
+    return 'benchmark'
+
+
+class QuietHandler(wsgiref.simple_server.WSGIRequestHandler):
+  def log_message(self, *args):
+    pass
+
+
+class InProcessClient(object):
+  def __init__(self, app):
+    self.client = Client(app, BaseResponse)
+
+  def request(self, method, path, payload=None, headers=None):
+    response = self.client.open(
+      path, method=method, headers=headers or {},
+      data=None if payload is None else json.dumps(payload),
+      content_type='application/json', buffered=True)
+    return response.status_code, response.data
+
+
+class SocketClient(object):
+  def __init__(self, base_url):
+    self.base_url = base_url
+    self.local = threading.local()
+
+  def request(self, method, path, payload=None, headers=None):
+    session = getattr(self.local, 'session', None)
+    if session is None:
+      session = self.local.session = requests.Session()
+    headers = dict(headers or {}, **{'content-type': 'application/json'})
+    response = session.request(
+      method, self.base_url + path, headers=headers,
+      data=None if payload is None else json.dumps(payload))
+    return response.status_code, response.content
+
+
+class Bench(object):
+  def __init__(self, client, engine):
+    self.client = client
+    self.engine = engine
+    self.users = {}
+
+  def call(self, method, path, payload=None, token=None, expect=200):
+    headers = {} if token is None else {'JWT': token}
+    status, body = self.client.request(method, path, payload, headers)
+    if status != expect:
+      raise AssertionError('{} {}: expected {}, got {}: {}'.format(
+        method, path, expect, status, body[:200]))
+    return json.loads(body) if body else None
+
+  def user(self, size):
+    # one user per size, its timezones inserted straight into the database
+    if size not in self.users:
+      login = 'bench{}'.format(size)
+      self.call('POST', '/users', dict(login=login, password='secret'))
+      token = self.call('POST', '/auth', dict(login=login,
+                                              password='secret'))['token']
+      user_id = self.engine.execute(User.__table__.select().where(
+        User.login == login)).fetchone().id
+      rows = [dict(user_id=user_id, city=CITIES[i % len(CITIES)],
+                   name='TZ{}'.format(i), gmt_delta_seconds=0)
+              for i in xrange(size)]
+      for start in xrange(0, len(rows), 5000):
+        self.engine.execute(Timezone.__table__.insert(),
+                            rows[start:start + 5000])
+      self.users[size] = (login, token)
+    return self.users[size]
+
+  def scenario(self, name, size):
+    login, token = self.user(size)
+    if name == 'login':
+      return lambda: self.call('POST', '/auth',
+                               dict(login=login, password='secret'))
+    if name == 'list':
+      return lambda: self.call('GET', '/timezones', token=token)
+    if name == 'list_q':
+      return lambda: self.call('GET', '/timezones?q=ros', token=token)
+
+    def crud():
+      timezone = dict(city='Bench', name='BEN', gmt_delta_seconds=3600)
+      created = self.call('POST', '/timezones', timezone, token)
+      path = '/timezones/{}'.format(created['id'])
+      self.call('GET', path, token=token)
+      self.call('PUT', path, dict(timezone, city='Benched'), token)
+      self.call('DELETE', path, token=token)
+    return crud
+
+
+def percentile(ordered, fraction):
+  return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def run(fn, concurrency, duration):
+  latencies = [[] for _ in xrange(concurrency)]
+  failures = []
+  deadline = time.time() + duration
+
+  def worker(samples):
+    while time.time() < deadline:
+      start = time.time()
+      try:
+        fn()
+      except Exception as e:
+        # latencies of a scenario that errors don't measure anything
+        failures.append(e)
+        return
+      samples.append(time.time() - start)
+
+  threads = [threading.Thread(target=worker, args=(samples,))
+             for samples in latencies]
+  start = time.time()
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join()
+  elapsed = time.time() - start
+  if failures:
+    raise failures[0]
+  ordered = sorted(sum(latencies, []))
+  return dict(requests=len(ordered), seconds=round(elapsed, 3),
+              throughput=round(len(ordered) / elapsed, 1),
+              p50_ms=round(percentile(ordered, .50) * 1000, 2),
+              p95_ms=round(percentile(ordered, .95) * 1000, 2),
+              p99_ms=round(percentile(ordered, .99) * 1000, 2))
+
+
+def compare(results, baseline, tolerance):
+  regressions = []
+  for key, result in sorted(results.items()):
+    before = baseline.get(key)
+    if before is None:
+      continue
+    throughput = result['throughput'] / before['throughput'] - 1
+    p95 = result['p95_ms'] / max(before['p95_ms'], 0.001) - 1
+    regressed = throughput < -tolerance or p95 > tolerance
+    print '{:24} throughput {:+7.1%}  p95 {:+7.1%}{}'.format(
+      key, throughput, p95, '  REGRESSION' if regressed else '')
+    if regressed:
+      regressions.append(key)
+  return regressions
+
+
+def main():
+  parser = argparse.ArgumentParser(description='REST API benchmarks.')
+  parser.add_argument('--mode', choices=['inprocess', 'socket'],
+                      default='inprocess')
+  parser.add_argument('--scenarios', nargs='+', choices=SCENARIOS,
+                      default=SCENARIOS)
+  parser.add_argument('--sizes', nargs='+', type=int, default=SIZES,
+                      help='timezones per user')
+  parser.add_argument('--concurrency', type=int, default=4)
+  parser.add_argument('--threads', type=int, default=4,
+                      help='server threads in socket mode')
+  parser.add_argument('--duration', type=float, default=5,
+                      help='seconds per scenario')
+  parser.add_argument('--save', help='write the results to this JSON file')
+  parser.add_argument('--baseline', help='compare with this results file')
+  parser.add_argument('--tolerance', type=float, default=0.1)
+  args = parser.parse_args()
+  logging.basicConfig(level=logging.WARNING)
+
+  folder = tempfile.mkdtemp()
+  server = None
+  try:
+    graph = wiring.web_graph(BenchConfigModule(
+      'sqlite:///' + os.path.join(folder, 'bench.sqlite')))
+    creator = graph.provide(DbCreator)
+    creator.create_db()
+    app = graph.provide(rest_server.App).wsgi
+    if args.mode == 'socket':
+      server = serving.ThreadPoolWSGIServer(('localhost', 0), args.threads)
+      server.RequestHandlerClass = QuietHandler
+      server.set_app(app)
+      server.start_threads()
+      threading.Thread(target=server.serve_forever).start()
+      client = SocketClient('http://localhost:{}'.format(
+        server.server_address[1]))
+    else:
+      client = InProcessClient(app)
+    bench = Bench(client, creator.engine)
+    results = {}
+    failed = []
+    for name in args.scenarios:
+      # login cost doesn't depend on how many timezones the user has
+      for size in args.sizes[:1] if name in ('login', 'crud') else args.sizes:
+        key = '{}/{}'.format(name, size)
+        try:
+          results[key] = run(bench.scenario(name, size), args.concurrency,
+                             args.duration)
+        except Exception as e:
+          print '{:24} FAILED: {}'.format(key, e)
+          failed.append(key)
+          continue
+        print '{:24} {throughput:9.1f} req/s  p50 {p50_ms:8.2f}ms  ' \
+              'p95 {p95_ms:8.2f}ms  p99 {p99_ms:8.2f}ms'.format(
+                key, **results[key])
+  finally:
+    if server is not None:
+      server.shutdown()
+      server.stop_threads()
+      server.server_close()
+    shutil.rmtree(folder)
+
+  if args.save:
+    with open(args.save, 'w') as output:
+      json.dump(dict(mode=args.mode, concurrency=args.concurrency,
+                     python=platform.python_version(), time=time.time(),
+                     results=results), output, indent=2, sort_keys=True)
+  if args.baseline:
+    with open(args.baseline) as baseline:
+      if compare(results, json.load(baseline)['results'], args.tolerance):
+        sys.exit(1)
+  if failed:
+    sys.exit(1)
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,124 @@
+# Per-request dependency injection overhead: the request plan against the
+# pinject request scope it replaced. Each simulated request reads the request
+# and the DB session twice, as a typical handler does through auth and
+# SessionContext. Run from the server folder:
+# python benchmarks/request_scope.py
+import os
+import sys
+import threading
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import pinject
+from request_scope import RequestScopeMiddleware
+
+
+class Session(object):
+  def close(self):
+    pass
+
+
+# the pinject scope and middleware before request plans
+class LegacyScope(pinject.Scope):
+  def __init__(self, middleware):
+    self.middleware = middleware
+
+  def provide(self, binding_key, default_provider_fn):
+    if binding_key not in self.middleware:
+      self.middleware[binding_key] = to_provide = default_provider_fn()
+      return to_provide
+    else:
+      return self.middleware[binding_key]
+
+
+class LegacyMiddleware(object):
+  def __init__(self):
+    self.local = threading.local()
+
+  def __contains__(self, item):
+    return item in self.local.store
+
+  def __getitem__(self, item):
+    return self.local.store[item]
+
+  def __setitem__(self, key, item):
+    self.local.store[key] = item
+
+  def __call__(self, request, response, app):
+    self.local.store = dict()
+    self.local.request = request
+    try:
+      return app(request, response)
+    finally:
+      del self.local.store
+      del self.local.request
+
+
+class LegacySpec(pinject.BindingSpec):
+  def __init__(self, middleware):
+    self.middleware = middleware
+
+  @pinject.provides(in_scope='request')
+  def provide_request(self):
+    return self.middleware.local.request
+
+  @pinject.provides(in_scope='request')
+  def provide_db_session(self):
+    return Session()
+
+
+class LegacyHandler(object):
+  def __init__(self, provide_request, provide_db_session):
+    self.provide_request = provide_request
+    self.provide_db_session = provide_db_session
+
+  def __call__(self, request, response):
+    self.provide_request()
+    self.provide_db_session()
+    self.provide_request()
+    self.provide_db_session()
+    return response
+
+
+def legacy():
+  middleware = LegacyMiddleware()
+  graph = pinject.new_object_graph(
+    modules=None, classes=[LegacyHandler],
+    binding_specs=[LegacySpec(middleware)],
+    id_to_scope=dict(request=LegacyScope(middleware)),
+    is_scope_usable_from_scope=lambda inner, outer: True)
+  handler = graph.provide(LegacyHandler)
+  return lambda: middleware(object(), None, handler)
+
+
+def planned():
+  middleware = RequestScopeMiddleware()
+
+  def open_session():
+    session = Session()
+    middleware.add_teardown(session.close)
+    return session
+
+  current_request = middleware.request
+  current_db_session = middleware.plan.add('db_session', open_session)
+
+  def handler(request, response):
+    current_request()
+    current_db_session()
+    current_request()
+    current_db_session()
+    return response
+
+  return lambda: middleware(object(), None, handler)
+
+
+def per_request(fn, number):
+  return min(timeit.repeat(fn, number=number, repeat=5)) / number * 1e6
+
+
+if __name__ == '__main__':
+  number = 20000
+  print 'pinject request scope: {:6.1f} us/request'.format(
+    per_request(legacy(), number))
+  print 'request plan:          {:6.1f} us/request'.format(
+    per_request(planned(), number))
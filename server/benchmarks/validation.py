@@ -0,0 +1,105 @@
+# Validator throughput, compiled schemas against the hand-written checks they
+# replaced. Run from the server folder: python benchmarks/validation.py
+import os
+import re
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from dto import UserDto, TimezoneDto
+
+alpha_re = re.compile('^[a-zA-Z][0-9a-zA-Z]+$')
+
+
+# UserDto.validate before the schemas
+def legacy_user(msg):
+  errors = []
+  if not isinstance(msg, dict):
+    return [("", "type error")]
+  login = msg.get('login')
+  if login is None:
+    errors.append(('login', 'is missing'))
+  elif not isinstance(login, basestring):
+    errors.append(('login', 'must be a string'))
+  elif len(login) > 50:
+    errors.append(('login', 'must be shorter than 50 characters'))
+  elif len(login) < 5:
+    errors.append(("login", 'must be at least 5 characters long'))
+  elif not alpha_re.match(login):
+    errors.append(("login", "must begin followed by alphanumerics"))
+  password = msg.get('password')
+  if password is None:
+    errors.append(('password', 'is missing'))
+  elif not isinstance(password, basestring):
+    errors.append(('password', 'must be a string'))
+  elif len(password) < 5:
+    errors.append(("password", 'must be at least 5 characters long'))
+  name = msg.get('name')
+  if name is None:
+    pass
+  elif not isinstance(name, basestring):
+    errors.append(('name', 'must be a string'))
+  elif len(name) < 5:
+    errors.append(("name", 'must be at least 5 characters long'))
+  elif len(name) > 50:
+    errors.append(("name", 'must be shorter than 50 characters'))
+  return errors
+
+
+# TimezoneDto.validate before the schemas, name checks fixed
+def legacy_timezone(msg):
+  errors = []
+  if not isinstance(msg, dict):
+    return [('', 'type error')]
+  gmt_delta_seconds = msg.get('gmt_delta_seconds')
+  if gmt_delta_seconds is None:
+    errors.append(('gmt_delta_seconds', 'is missing'))
+  elif not isinstance(gmt_delta_seconds, int):
+    errors.append(('gmt_delta_seconds', 'must be an integer'))
+  elif not -15 * 60 * 60 < gmt_delta_seconds < 15 * 60 * 60:
+    errors.append(('gmt_delta_seconds', 'value out of range'))
+  city = msg.get('city')
+  if city is None:
+    errors.append(('city', 'is missing'))
+  elif not isinstance(city, basestring):
+    errors.append(('city', 'must be a string'))
+  elif len(city) == 0:
+    errors.append(('city', 'must not be empty'))
+  elif len(city) > 50:
+    errors.append(('city', 'must be shorter than 50 characters'))
+  name = msg.get('name')
+  if name is None:
+    errors.append(('name', 'is missing'))
+  elif not isinstance(name, basestring):
+    errors.append(('name', 'must be a string'))
+  elif len(name) == 0:
+    errors.append(('name', 'must not be empty'))
+  elif len(name) > 50:
+    errors.append(('name', 'must be shorter than 50 characters'))
+  return errors
+
+
+CASES = [
+  ('user, valid', legacy_user, UserDto.validate,
+   dict(login='someone', password='secret', name='Some One')),
+  ('user, invalid', legacy_user, UserDto.validate,
+   dict(login='1x', password=3, name='x' * 60)),
+  ('timezone, valid', legacy_timezone, TimezoneDto.validate,
+   dict(city='Rosario', name='ART', gmt_delta_seconds=-10800)),
+  ('timezone, invalid', legacy_timezone, TimezoneDto.validate,
+   dict(city='', name=5, gmt_delta_seconds=10 ** 6)),
+]
+
+
+def rate(fn, msg, number):
+  best = min(timeit.repeat(lambda: fn(msg), number=number, repeat=5))
+  return number / best
+
+
+if __name__ == '__main__':
+  number = 200000
+  print '{:20} {:>14} {:>14}'.format('case', 'legacy/s', 'compiled/s')
+  for name, legacy, compiled, msg in CASES:
+    assert legacy(msg) == compiled(msg), name
+    print '{:20} {:14,.0f} {:14,.0f}'.format(
+      name, rate(legacy, msg, number), rate(compiled, msg, number))
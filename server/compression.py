@@ -0,0 +1,123 @@
+import time
+import zlib
+
+# gzip framing for zlib, "deflate" in HTTP is the zlib format
+_WBITS = {'gzip': 16 + zlib.MAX_WBITS, 'deflate': zlib.MAX_WBITS}
+_COMPRESSIBLE = frozenset({'application/json', 'application/javascript',
+                           'application/x-javascript', 'application/xml',
+                           'image/svg+xml'})
+
+
+# Compresses response bodies with gzip or deflate, whichever the client
+# prefers in Accept-Encoding. Bodies under compression_min_size go out as
+# they are, and so do types that don't compress (images, fonts...).
+# Streamed bodies are read up to the threshold to decide, then compressed
+# chunk by chunk. A compression_level of 0 turns it off. As a link in the
+# MiddlewareLink chain it sits inside MetricsMiddleware, which then counts
+# the bytes actually sent.
+class CompressionMiddleware(object):
+  def __init__(self, compression_level, compression_min_size, metrics):
+    self.level = compression_level
+    self.min_size = compression_min_size
+    encoding = ('encoding',)
+    self.bytes_in = metrics.counter(
+      'http_compression_input_bytes_total', 'Response bytes compressed',
+      encoding)
+    self.bytes_out = metrics.counter(
+      'http_compression_output_bytes_total', 'Compressed response bytes',
+      encoding)
+    self.seconds = metrics.counter(
+      'http_compression_seconds_total', 'Time spent compressing responses',
+      encoding)
+    metrics.gauge('http_compression_ratio',
+                  'Compressed over uncompressed response bytes', self.ratio)
+
+  @property
+  def enabled(self):
+    return self.level > 0
+
+  def ratio(self):
+    bytes_in = self.bytes_in.value
+    return self.bytes_out.value / float(bytes_in) if bytes_in > 0 else 1
+
+  def __call__(self, request, response, app):
+    return self.compress(request, app(request, response))
+
+  def _compressible(self, request, response):
+    content_type = response.mimetype
+    return (request.method != 'HEAD' and
+            response.status_code not in (204, 206, 304) and
+            'Content-Encoding' not in response.headers and
+            (content_type.startswith('text/') or
+             content_type in _COMPRESSIBLE))
+
+  def compress(self, request, response):
+    if not self.enabled or not self._compressible(request, response):
+      return response
+    response.vary.add('Accept-Encoding')
+    encoding = request.accept_encodings.best_match(['gzip', 'deflate'])
+    if encoding is None:
+      return response
+    if response.is_streamed:
+      head, rest = self._peek(response)
+      if rest is None:
+        response.set_data(head)
+      else:
+        self._start(response, encoding)
+        response.headers.pop('Content-Length', None)
+        response.response = self._compress_stream(encoding, head, rest)
+        if hasattr(rest, 'close'):
+          response.call_on_close(rest.close)
+        return response
+    data = response.get_data()
+    if len(data) < self.min_size:
+      return response
+    self._start(response, encoding)
+    compressor = self._compressor(encoding)
+    response.set_data(self._run(encoding, data, compressor.compress, data) +
+                      self._run(encoding, '', compressor.flush))
+    return response
+
+  def _peek(self, response):
+    # -> (the first min_size bytes or more, an iterator over the rest or
+    # None when that was all of it)
+    body = iter(response.response)
+    head = []
+    size = 0
+    for chunk in body:
+      head.append(chunk)
+      size += len(chunk)
+      if size >= self.min_size:
+        return ''.join(head), body
+    if hasattr(response.response, 'close'):
+      response.response.close()
+    return ''.join(head), None
+
+  def _start(self, response, encoding):
+    response.headers['Content-Encoding'] = encoding
+    etag, weak = response.get_etag()
+    if etag is not None and not weak:
+      # the compressed body is no longer byte for byte the tagged one
+      response.set_etag(etag, weak=True)
+
+  def _compressor(self, encoding):
+    return zlib.compressobj(self.level, zlib.DEFLATED, _WBITS[encoding])
+
+  def _run(self, encoding, data, fn, *args):
+    start = time.time()
+    output = fn(*args)
+    labels = (encoding,)
+    self.seconds.inc(time.time() - start, labels)
+    self.bytes_in.inc(len(data), labels)
+    self.bytes_out.inc(len(output), labels)
+    return output
+
+  def _compress_stream(self, encoding, head, rest):
+    compressor = self._compressor(encoding)
+    output = self._run(encoding, head, compressor.compress, head)
+    for chunk in rest:
+      # zlib hands output back as its blocks fill up
+      if output:
+        yield output
+      output = self._run(encoding, chunk, compressor.compress, chunk)
+    yield output + self._run(encoding, '', compressor.flush)
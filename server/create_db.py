@@ -1,5 +1,6 @@
 import argparse
 import models
+import search
 import sqlalchemy
 
 if __name__ == '__main__':
@@ -7,4 +8,6 @@ if __name__ == '__main__':
   parser.add_argument('db_url', help='DB url (sqlalchemy format)')
   args = parser.parse_args()
   engine = sqlalchemy.create_engine(args.db_url)
-  models.Base.metadata.create_all(engine)
\ No newline at end of file
+  models.Base.metadata.create_all(engine)
+  models.upgrade(engine)
+  search.create_index(engine)
\ No newline at end of file
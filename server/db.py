@@ -1,21 +1,25 @@
 from contextlib import contextmanager
+import time
 import pinject
-from sqlalchemy import create_engine, MetaData
+from sqlalchemy import create_engine, event, MetaData
+from sqlalchemy.engine.url import make_url
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import QueuePool
 import models
+import search
 
 
 class SessionContext(object):
-  def __init__(self, provide_db_session):
-    self.provide_db_session = provide_db_session
+  def __init__(self, current_db_session):
+    self.current_db_session = current_db_session
 
   @property
   def session(self):
-    return self.provide_db_session()
+    return self.current_db_session()
 
   @contextmanager
   def __call__(self):
-    session = self.provide_db_session()
+    session = self.current_db_session()
     try:
       yield session
       session.commit()
@@ -30,14 +34,87 @@ class DbCreator(object):
 
   def create_db(self):
     models.Base.metadata.create_all(self.engine)
+    models.upgrade(self.engine)
+    search.create_index(self.engine)
+
+
+# Times how long checkouts wait for a free connection. dispose() replaces
+# the pool through recreate(), which has to carry the histogram over.
+class TimedQueuePool(QueuePool):
+  checkout_wait = None
+
+  def _do_get(self):
+    start = time.time()
+    try:
+      return QueuePool._do_get(self)
+    finally:
+      if self.checkout_wait is not None:
+        self.checkout_wait.observe(time.time() - start)
+
+  def recreate(self):
+    pool = QueuePool.recreate(self)
+    pool.checkout_wait = self.checkout_wait
+    return pool
+
+
+def _tune_sqlite(engine, in_memory, busy_timeout):
+  @event.listens_for(engine, 'connect')
+  def on_connect(connection, record):
+    cursor = connection.cursor()
+    # WAL lets readers run alongside a writer, but not for memory databases
+    if not in_memory:
+      cursor.execute('PRAGMA journal_mode=WAL')
+    cursor.execute('PRAGMA synchronous=NORMAL')
+    cursor.execute('PRAGMA busy_timeout={:d}'.format(busy_timeout))
+    cursor.close()
 
 
 class DbModule(pinject.BindingSpec):
-  def provide_db_engine(self, db_url, db_verbose):
-    return create_engine(db_url, echo=db_verbose)
+  def configure(self, bind):
+    bind('db_pool_size', to_instance=5)
+    bind('db_max_overflow', to_instance=10)
+    # seconds, servers drop idle connections on their own
+    bind('db_pool_recycle', to_instance=3600)
+    bind('db_pool_timeout', to_instance=30)
+    # milliseconds a sqlite connection waits on a locked database
+    bind('db_busy_timeout', to_instance=5000)
+
+  def provide_db_engine(self, db_url, db_verbose, db_pool_size,
+                        db_max_overflow, db_pool_recycle, db_pool_timeout,
+                        db_busy_timeout, metrics):
+    url = make_url(db_url)
+    sqlite = url.get_dialect().name == 'sqlite'
+    in_memory = sqlite and url.database in (None, '', ':memory:')
+    options = dict(echo=db_verbose)
+    if not in_memory:
+      # memory databases keep their default per-thread pool, a pooled
+      # connection there is the whole database
+      options.update(poolclass=TimedQueuePool, pool_size=db_pool_size,
+                     max_overflow=db_max_overflow, pool_timeout=db_pool_timeout)
+    if sqlite and not in_memory:
+      # connections are handed between request threads, never shared
+      options.update(connect_args=dict(check_same_thread=False))
+    elif not sqlite:
+      options.update(pool_recycle=db_pool_recycle)
+    engine = create_engine(db_url, **options)
+    if sqlite:
+      _tune_sqlite(engine, in_memory, db_busy_timeout)
+    if isinstance(engine.pool, TimedQueuePool):
+      engine.pool.checkout_wait = metrics.histogram(
+        'db_pool_checkout_wait_seconds',
+        'Time spent waiting for a pooled database connection')
+      metrics.gauge('db_pool_checked_out', 'Database connections in use',
+                    lambda: engine.pool.checkedout())
+    return engine
 
   def provide_db_session_factory(self, db_engine):
     return sessionmaker(bind=db_engine)
 
-  def provide_db_session(self, db_session_factory):
-    return db_session_factory()
+  def provide_current_db_session(self, request_plan, db_session_factory,
+                                 request_teardown):
+    def open_session():
+      session = db_session_factory()
+      # hand the connection back to the pool as soon as the request is done
+      request_teardown(session.close)
+      return session
+    return request_plan.add('db_session', open_session)
@@ -1,12 +1,27 @@
-from models import User, Timezone
+import base64
+import binascii
 import re
+import numpy
+from models import User, Timezone
+from validation import Schema, String, Integer
+
+_DIGITS = re.compile(r'^[0-9]+$')
+
+
+LOGIN = String('login', min_length=5, max_length=50,
+               pattern='^[a-zA-Z][0-9a-zA-Z]+$',
+               pattern_message='must begin followed by alphanumerics')
+PASSWORD = String('password', min_length=5)
 
 
 class UserDto(object):
-  alpha_re = re.compile('^[a-zA-Z][0-9a-zA-Z]+$')
+  validate_login = staticmethod(Schema(LOGIN, PASSWORD).compile())
+  validate = staticmethod(Schema(
+    LOGIN, PASSWORD,
+    String('name', required=False, min_length=5, max_length=50)).compile())
 
-  def __init__(self, password_manager):
-    self.password_manager = password_manager
+  def __init__(self, password_hasher):
+    self.password_hasher = password_hasher
 
   def to_msg(self, user):
     return dict(login=user.login, name=user.name)
@@ -17,66 +32,6 @@ class UserDto(object):
     return user
 
 
-  def validate_login(self, msg):
-    errors = []
-    if not isinstance(msg, dict):
-      return [("", "type error")]
-    login = msg.get('login')
-    if login is None:
-      errors.append(('login', 'is missing'))
-    elif not isinstance(login, basestring):
-      errors.append(('login', 'must be a string'))
-    elif len(login) > 50:
-      errors.append(('login', 'must be shorter than 50 characters'))
-    elif len(login) < 5:
-      errors.append(("login", 'must be at least 5 characters long'))
-    elif not self.alpha_re.match(login):
-      errors.append(("login", "must begin followed by alphanumerics"))
-    password = msg.get('password')
-    if password is None:
-      errors.append(('password', 'is missing'))
-    elif not isinstance(password, basestring):
-      errors.append(('password', 'must be a string'))
-    elif len(password) < 5:
-      errors.append(("password", 'must be at least 5 characters long'))
-    return errors
-
-  def validate(self, msg):
-    errors = []
-    if not isinstance(msg, dict):
-      return [("", "type error")]
-    login = msg.get('login')
-    if login is None:
-      errors.append(('login', 'is missing'))
-    elif not isinstance(login, basestring):
-      errors.append(('login', 'must be a string'))
-    elif len(login) > 50:
-      errors.append(('login', 'must be shorter than 50 characters'))
-    elif len(login) < 5:
-      errors.append(("login", 'must be at least 5 characters long'))
-    elif not self.alpha_re.match(login):
-      errors.append(("login", "must begin followed by alphanumerics"))
-
-    password = msg.get('password')
-    if password is None:
-      errors.append(('password', 'is missing'))
-    elif not isinstance(password, basestring):
-      errors.append(('password', 'must be a string'))
-    elif len(password) < 5:
-      errors.append(("password", 'must be at least 5 characters long'))
-
-    name = msg.get('name')
-    if name is None:
-      pass
-    elif not isinstance(name, basestring):
-      errors.append(('name', 'must be a string'))
-    elif len(name) < 5:
-      errors.append(("name", 'must be at least 5 characters long'))
-    elif len(name) > 50:
-      errors.append(("name", 'must be shorter than 50 characters'))
-
-    return errors
-
   def validate_ref_args(self, args):
     errors = []
     if not isinstance(args, dict):
@@ -90,50 +45,46 @@ class UserDto(object):
   def populate(self, user, msg):
     user.login = msg['login']
     user.name = msg.get('name')
-    user.password = self.password_manager.encrypt(msg['password'])
+    user.password = self.password_hasher.encrypt(msg['password'])
 
 
 class TimezoneDto(object):
+  BATCH_OPS = frozenset({'create', 'update', 'delete'})
+  # ids are signed 64 bit integers in the database
+  MAX_ID = 2 ** 63 - 1
+  # converted times must stay exact once a javascript client parses them
+  MAX_INSTANT = 2 ** 53 - 1 - 15 * 60 * 60
+
+  validate_fields = staticmethod(Schema(
+    Integer('gmt_delta_seconds', greater_than=-15 * 60 * 60,
+            less_than=15 * 60 * 60),
+    String('city', min_length=1, max_length=50),
+    String('name', min_length=1, max_length=50),
+    String('zone_id', required=False, max_length=64)).compile())
+
+  def __init__(self, max_page_size, max_batch_operations,
+               max_convert_instants, max_overlap_days, tz_catalog):
+    self.max_page_size = max_page_size
+    self.max_batch_operations = max_batch_operations
+    self.max_convert_instants = max_convert_instants
+    self.max_overlap_days = max_overlap_days
+    self.tz_catalog = tz_catalog
+
   def to_msg(self, timezone):
     return dict(
       id=timezone.id,
       gmt_delta_seconds=timezone.gmt_delta_seconds,
       city=timezone.city,
-      name=timezone.name
+      name=timezone.name,
+      zone_id=timezone.zone_id
     )
 
   def validate(self, msg):
-    errors = []
-    if not isinstance(msg, dict):
-      return [('', 'type error')]
-    gmt_delta_seconds = msg.get('gmt_delta_seconds')
-    if gmt_delta_seconds is None:
-      errors.append(('gmt_delta_seconds', 'is missing'))
-    elif not isinstance(gmt_delta_seconds, int):
-      errors.append(('gmt_dela_seconds', 'must be an integer'))
-    elif not -15 * 60 * 60 < gmt_delta_seconds < 15 * 60 * 60:
-      errors.append(('gmt_delta_seconds', 'value out of range'))
-
-    city = msg.get('city')
-    if city is None:
-      errors.append(('city', 'is missing'))
-    elif not isinstance(city, basestring):
-      errors.append(('city', 'must be a string'))
-    elif len(city) == 0:
-      errors.append(('city', 'must not be empty'))
-    elif len(city) > 50:
-      errors.append(('city', 'must be shorter than 50 characters'))
-
-    name = msg.get('name')
-    if name is None:
-      errors.append(('name', 'is missing'))
-    elif not isinstance(name, basestring):
-      errors.append(('name', 'must be a string'))
-    elif len(city) == 0:
-      errors.append(('name', 'must not be empty'))
-    elif len(city) > 50:
-      errors.append(('name', 'must be shorter than 50 characters'))
-
+    errors = self.validate_fields(msg)
+    zone_id = msg.get('zone_id') if isinstance(msg, dict) else None
+    if (isinstance(zone_id, basestring) and zone_id not in self.tz_catalog and
+        all(field != 'zone_id' for field, _ in errors)):
+      errors.append(('zone_id', 'is not a known zone'))
     return errors
 
   def validate_ref_args(self, args):
@@ -146,6 +97,132 @@ class TimezoneDto(object):
       errors.append(('id', 'type error'))
     return errors
 
+  def validate_batch(self, msg):
+    if not isinstance(msg, list):
+      return [('', 'type error')]
+    if len(msg) > self.max_batch_operations:
+      return [('', 'must have at most {} operations'
+                   .format(self.max_batch_operations))]
+    errors = []
+    seen_ids = set()
+    for index, operation in enumerate(msg):
+      errors.extend(('{}.{}'.format(index, field) if field else str(index),
+                     message)
+                    for field, message in self._validate_operation(
+                      operation, seen_ids))
+    return errors
+
+  def _validate_operation(self, operation, seen_ids):
+    if not isinstance(operation, dict):
+      return [('', 'type error')]
+    op = operation.get('op')
+    if op not in self.BATCH_OPS:
+      return [('op', 'must be one of create, update or delete')]
+    errors = []
+    if op != 'create':
+      errors.extend(self.validate_ref_args(operation))
+      if len(errors) == 0:
+        if operation['id'] in seen_ids:
+          errors.append(('id', 'is repeated in the batch'))
+        seen_ids.add(operation['id'])
+    if op != 'delete':
+      errors.extend(('timezone.{}'.format(field) if field else 'timezone',
+                     message)
+                    for field, message in self.validate(
+                      operation.get('timezone')))
+    return errors
+
+  def validate_convert(self, msg):
+    if not isinstance(msg, dict):
+      return [('', 'type error')]
+    errors = []
+    instants = msg.get('instants')
+    if not isinstance(instants, list):
+      errors.append(('instants', 'must be a list of seconds since the epoch'))
+    elif not 0 < len(instants) <= self.max_convert_instants:
+      errors.append(('instants', 'must have between 1 and {} values'
+                     .format(self.max_convert_instants)))
+    else:
+      # numpy infers an integer dtype only when every value is an integer
+      # that fits in 64 bits
+      values = numpy.asarray(instants)
+      if values.dtype.kind != 'i' or values.ndim != 1:
+        errors.append(('instants', 'must be a list of seconds since the epoch'))
+      elif (values.min() < -self.MAX_INSTANT or
+            values.max() > self.MAX_INSTANT):
+        errors.append(('instants', 'must be within {} seconds of the epoch'
+                       .format(self.MAX_INSTANT)))
+    errors.extend(self._validate_ids(msg.get('ids')))
+    return errors
+
+  def _validate_ids(self, ids):
+    if ids is None:
+      return []
+    if (not isinstance(ids, list) or len(ids) == 0 or
+        not all(type(i) in (int, long) and 0 < i <= self.MAX_ID
+                for i in ids)):
+      return [('ids', 'must be a list of timezone ids')]
+    return []
+
+  validate_overlap_fields = staticmethod(Schema(
+    Integer('start', greater_than=-MAX_INSTANT - 1,
+            less_than=MAX_INSTANT + 1),
+    Integer('end', greater_than=-MAX_INSTANT - 1, less_than=MAX_INSTANT + 1),
+    # seconds from local midnight
+    Integer('work_start', greater_than=-1, less_than=24 * 60 * 60),
+    Integer('work_end', greater_than=0, less_than=24 * 60 * 60 + 1)).compile())
+
+  def validate_overlap(self, msg):
+    errors = self.validate_overlap_fields(msg)
+    if len(errors) > 0:
+      return errors
+    if not msg['start'] < msg['end'] <= (msg['start'] +
+                                         self.max_overlap_days * 86400):
+      errors.append(('end', 'must be after start, by at most {} days'
+                     .format(self.max_overlap_days)))
+    if msg['work_end'] <= msg['work_start']:
+      errors.append(('work_end', 'must be after work_start'))
+    weekdays = msg.get('weekdays')
+    if weekdays is not None and (
+        not isinstance(weekdays, list) or len(weekdays) == 0 or
+        not all(type(day) is int and 0 <= day <= 6 for day in weekdays)):
+      errors.append(('weekdays', 'must be a list of days, 0 for monday'))
+    errors.extend(self._validate_ids(msg.get('ids')))
+    return errors
+
+  def to_row(self, msg):
+    return dict(gmt_delta_seconds=msg['gmt_delta_seconds'], city=msg['city'],
+                name=msg['name'], zone_id=msg.get('zone_id'))
+
+  def validate_page_args(self, args):
+    errors = []
+    limit = args.get('limit')
+    if limit is not None:
+      # ASCII only, int() rejects unicode digits such as u'\xb2'
+      if _DIGITS.match(limit) is None:
+        errors.append(('limit', 'must be an integer'))
+      elif not 0 < int(limit) <= self.max_page_size:
+        errors.append(('limit', 'must be between 1 and {}'
+                       .format(self.max_page_size)))
+    cursor = args.get('cursor')
+    if cursor is not None:
+      if limit is None:
+        errors.append(('limit', 'is missing'))
+      if self.decode_cursor(cursor) is None:
+        errors.append(('cursor', 'is invalid'))
+    return errors
+
+  def encode_cursor(self, timezone_id):
+    return base64.urlsafe_b64encode(str(timezone_id))
+
+  def decode_cursor(self, cursor):
+    try:
+      value = base64.urlsafe_b64decode(cursor.encode('ascii'))
+    except (binascii.Error, TypeError, UnicodeError):
+      return None
+    if not value.isdigit() or int(value) > self.MAX_ID:
+      return None
+    return int(value)
 
   def from_msg(self, msg):
     timezone = Timezone()
@@ -156,3 +233,4 @@ class TimezoneDto(object):
     timezone.gmt_delta_seconds = msg["gmt_delta_seconds"]
     timezone.city = msg['city']
     timezone.name = msg['name']
+    timezone.zone_id = msg.get('zone_id')
@@ -0,0 +1,100 @@
+import multiprocessing
+import os
+import threading
+import time
+from werkzeug.exceptions import ServiceUnavailable
+
+
+def _encrypt(password_manager, secret):
+  try:
+    return True, password_manager.encrypt(secret)
+  except Exception, e:
+    return False, e
+
+
+def _verify(password_manager, secret, hashed):
+  try:
+    return True, password_manager.verify(secret, hashed)
+  except Exception, e:
+    return False, e
+
+
+# A passlib handler with its rounds fixed. Unlike a CryptContext it can be
+# pickled to the pool's processes.
+class RoundsPasswordManager(object):
+  def __init__(self, handler, rounds):
+    self.handler = handler
+    self.rounds = rounds
+
+  def encrypt(self, secret):
+    return self.handler.encrypt(secret, rounds=self.rounds)
+
+  def verify(self, secret, hashed):
+    return self.handler.verify(secret, hashed)
+
+
+# Hashes run inline when hashing_workers is 0, otherwise in a process pool
+# created on first use (so it's never inherited across a fork). Hashes over
+# hashing_queue_size pending, or slower than hashing_timeout, get a 503.
+class PasswordHasher(object):
+  def __init__(self, password_manager, metrics, hashing_workers,
+               hashing_queue_size, hashing_timeout):
+    self.password_manager = password_manager
+    self.workers = hashing_workers
+    self.queue_size = hashing_queue_size
+    self.timeout = hashing_timeout
+    self.lock = threading.Lock()
+    self.pending = 0
+    self.pool = None
+    self.pool_pid = None
+    self.latency = metrics.histogram(
+      'password_hash_seconds', 'Time to hash or verify a password')
+    self.rejected = metrics.counter(
+      'password_hash_rejected_total', 'Password hashes refused with a 503')
+    metrics.gauge('password_hash_queue_depth', 'Pending password hashes',
+                  lambda: self.pending)
+
+  def encrypt(self, secret):
+    return self._run(_encrypt, secret)
+
+  def verify(self, secret, hashed):
+    return self._run(_verify, secret, hashed)
+
+  def _run(self, fn, *args):
+    if self.workers == 0:
+      start = time.time()
+      ok, result = fn(self.password_manager, *args)
+      self.latency.observe(time.time() - start)
+    else:
+      ok, result = self._submit(fn, *args)
+    if not ok:
+      raise result
+    return result
+
+  def _submit(self, fn, *args):
+    with self.lock:
+      if self.pending >= self.queue_size:
+        self.rejected.inc()
+        raise ServiceUnavailable()
+      self.pending += 1
+      pool = self._get_pool()
+    start = time.time()
+
+    def done(_):
+      self.latency.observe(time.time() - start)
+      with self.lock:
+        self.pending -= 1
+
+    result = pool.apply_async(fn, (self.password_manager,) + args,
+                              callback=done)
+    try:
+      return result.get(self.timeout)
+    except multiprocessing.TimeoutError:
+      self.rejected.inc()
+      raise ServiceUnavailable()
+
+  def _get_pool(self):
+    if self.pool is None or self.pool_pid != os.getpid():
+      self.pool = multiprocessing.Pool(self.workers)
+      self.pool_pid = os.getpid()
+    return self.pool
@@ -1,10 +1,15 @@
+import logging
 import wiring
 import rest_server
+import tzcatalog
 
 
 if __name__ == '__main__':
+  logging.basicConfig(level=logging.INFO)
   injector = wiring.web_graph(wiring.CmdlineModule(), wiring.DevConfigModule())
   web_server = injector.provide(rest_server.WebServer)
+  # compiled or mapped now rather than on the first request that needs it
+  injector.provide(tzcatalog.TzCatalog).load()
   web_server.run()
 else:
   app = wiring.web_graph().provide(rest_server.App).wsgi
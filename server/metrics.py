@@ -0,0 +1,252 @@
+from bisect import bisect_left
+from collections import OrderedDict
+import threading
+import time
+from werkzeug.wrappers import Response
+
+
+# Recording never takes a lock: every thread writes to its own shard, a dict
+# of label values -> cell, and shards are only merged when scraped. A thread
+# registers its shard, under the lock, the first time it records.
+class _Sharded(object):
+  def __init__(self, name, help, labels):
+    self.name = name
+    self.help = help
+    self.label_names = tuple(labels)
+    self.lock = threading.Lock()
+    self.local = threading.local()
+    self.shards = []
+
+  def _cell(self, labels):
+    try:
+      shard = self.local.shard
+    except AttributeError:
+      shard = self.local.shard = {}
+      with self.lock:
+        self.shards.append(shard)
+    cell = shard.get(labels)
+    if cell is None:
+      cell = shard[labels] = self._new_cell()
+    return cell
+
+  def samples(self):
+    # label values -> merged cell
+    with self.lock:
+      shards = list(self.shards)
+    merged = {}
+    for shard in shards:
+      for labels, cell in shard.items():
+        total = merged.get(labels)
+        if total is None:
+          merged[labels] = list(cell)
+        else:
+          for i, value in enumerate(cell):
+            total[i] += value
+    if len(self.label_names) == 0 and () not in merged:
+      merged[()] = self._new_cell()
+    return merged
+
+  def _total(self, index):
+    return sum(cell[index] for cell in self.samples().itervalues())
+
+
+class Counter(_Sharded):
+  kind = 'counter'
+
+  def __init__(self, name, help, labels=(), fn=None):
+    _Sharded.__init__(self, name, help, labels)
+    self.fn = fn
+
+  @staticmethod
+  def _new_cell():
+    return [0]
+
+  def inc(self, amount=1, labels=()):
+    self._cell(labels)[0] += amount
+
+  @property
+  def value(self):
+    return self._total(0) if self.fn is None else self.fn()
+
+  def lines(self):
+    if self.fn is not None:
+      return [(self.name, (), self.fn())]
+    return [(self.name, labels, cell[0])
+            for labels, cell in sorted(self.samples().items())]
+
+
+class Gauge(Counter):
+  kind = 'gauge'
+
+  def __init__(self, name, help, fn=None, labels=()):
+    Counter.__init__(self, name, help, labels, fn)
+    self._value = 0
+
+  def set(self, value):
+    self._value = value
+
+  def dec(self, amount=1, labels=()):
+    self._cell(labels)[0] -= amount
+
+  @property
+  def value(self):
+    return self._value + Counter.value.fget(self)
+
+  def lines(self):
+    lines = Counter.lines(self)
+    if self.fn is None and len(self.label_names) == 0:
+      return [(self.name, (), self.value)]
+    return lines
+
+
+class Histogram(_Sharded):
+  kind = 'histogram'
+  DEFAULT_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+
+  def __init__(self, name, help, buckets=DEFAULT_BUCKETS, labels=()):
+    _Sharded.__init__(self, name, help, labels)
+    self.buckets = tuple(sorted(buckets))
+
+  def _new_cell(self):
+    # one count per bucket, then +Inf, sum and count
+    return [0] * (len(self.buckets) + 3)
+
+  def observe(self, value, labels=()):
+    cell = self._cell(labels)
+    cell[bisect_left(self.buckets, value)] += 1
+    cell[-2] += value
+    cell[-1] += 1
+
+  @property
+  def counts(self):
+    return [self._total(i) for i in xrange(len(self.buckets) + 1)]
+
+  @property
+  def sum(self):
+    return self._total(-2)
+
+  @property
+  def count(self):
+    return self._total(-1)
+
+  def lines(self):
+    lines = []
+    for labels, cell in sorted(self.samples().items()):
+      cumulative = 0
+      for bound, bucket in zip(self.buckets + ('+Inf',), cell):
+        cumulative += bucket
+        lines.append((self.name + '_bucket', labels + (bound,), cumulative))
+      lines.append((self.name + '_sum', labels, cell[-2]))
+      lines.append((self.name + '_count', labels, cell[-1]))
+    return lines
+
+
+def _escape(value):
+  return (unicode(value).replace('\\', '\\\\').replace('"', '\\"')
+          .replace('\n', '\\n'))
+
+
+class Metrics(object):
+  CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+  def __init__(self):
+    self.registry = OrderedDict()
+    self.lock = threading.Lock()
+
+  def _register(self, cls, name, *args):
+    with self.lock:
+      metric = self.registry.get(name)
+      if metric is None:
+        self.registry[name] = metric = cls(name, *args)
+      elif type(metric) is not cls:
+        raise ValueError("Metric {} already registered as a {}"
+                         .format(name, metric.kind))
+      return metric
+
+  def counter(self, name, help, labels=(), fn=None):
+    return self._register(Counter, name, help, labels, fn)
+
+  def gauge(self, name, help, fn=None, labels=()):
+    return self._register(Gauge, name, help, fn, labels)
+
+  def histogram(self, name, help, buckets=Histogram.DEFAULT_BUCKETS,
+                labels=()):
+    return self._register(Histogram, name, help, buckets, labels)
+
+  def __iter__(self):
+    with self.lock:
+      return iter(list(self.registry.values()))
+
+  def render(self):
+    lines = []
+    for metric in self:
+      lines.append(u'# HELP {} {}'.format(metric.name, metric.help))
+      lines.append(u'# TYPE {} {}'.format(metric.name, metric.kind))
+      names = metric.label_names
+      if metric.kind == 'histogram':
+        names += ('le',)
+      for name, labels, value in metric.lines():
+        if len(labels) > 0:
+          name += u'{{{}}}'.format(u','.join(
+            u'{}="{}"'.format(label, _escape(label_value))
+            for label, label_value in zip(names, labels)))
+        lines.append(u'{} {}'.format(name, value))
+    return u'\n'.join(lines) + u'\n'
+
+  def export(self, args, request):
+    return Response(self.render(), content_type=self.CONTENT_TYPE)
+
+
+# Times every request and labels it with the endpoint the router matched,
+# 'unmatched' for requests no rule took. Streamed responses are measured
+# once the server is done writing them.
+class MetricsMiddleware(object):
+  ENDPOINT_KEY = 'timezones.endpoint'
+  UNMATCHED = 'unmatched'
+
+  def __init__(self, metrics):
+    endpoint = ('endpoint',)
+    self.requests = metrics.counter(
+      'http_requests_total', 'Requests served', endpoint + ('status',))
+    self.latency = metrics.histogram(
+      'http_request_duration_seconds', 'Time to serve a request',
+      labels=endpoint)
+    self.request_bytes = metrics.counter(
+      'http_request_bytes_total', 'Request body bytes received', endpoint)
+    self.response_bytes = metrics.counter(
+      'http_response_bytes_total', 'Response body bytes sent', endpoint)
+    self.in_flight = metrics.gauge('http_requests_in_flight',
+                                   'Requests being served')
+
+  def __call__(self, request, response, app):
+    start = time.time()
+    self.in_flight.inc()
+    try:
+      response = app(request, response)
+    except:
+      self._record(request, 500, start, 0)
+      raise
+    if response.is_streamed:
+      sent = [0]
+      body = response.response
+
+      def count():
+        for chunk in body:
+          sent[0] += len(chunk)
+          yield chunk
+
+      response.response = count()
+      response.call_on_close(lambda: self._record(
+        request, response.status_code, start, sent[0]))
+    else:
+      self._record(request, response.status_code, start,
+                   response.calculate_content_length() or 0)
+    return response
+
+  def _record(self, request, status, start, sent):
+    self.in_flight.dec()
+    endpoint = (request.environ.get(self.ENDPOINT_KEY, self.UNMATCHED),)
+    self.latency.observe(time.time() - start, endpoint)
+    self.requests.inc(1, endpoint + (str(status),))
+    self.request_bytes.inc(request.content_length or 0, endpoint)
+    self.response_bytes.inc(sent, endpoint)
@@ -1,9 +1,19 @@
-from sqlalchemy import Column, String, Integer, ForeignKey
+import time
+from sqlalchemy import (Column, String, Integer, BigInteger, ForeignKey,
+                        Index)
+import sqlalchemy
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship
 
 Base = declarative_base()
 
+
+def initial_version():
+  # versions start from the creation time so a user id reused after a delete
+  # never repeats a previous owner's versions
+  return int(time.time() * 1000)
+
+
 #TODO: optimistic locking support (version field)
 class User(Base):
   __tablename__ = 'users'
@@ -11,10 +21,17 @@ class User(Base):
   login = Column(String(50), nullable=False, unique=True)
   name = Column(String(50))
   password = Column(String(100), nullable=False)
+  # bumped by every write to the user's timezones
+  timezones_version = Column(BigInteger, nullable=False,
+                             default=initial_version)
+  # in every token's claims, bumping it stops the user's tokens from being
+  # refreshed
+  token_epoch = Column(BigInteger, nullable=False, default=initial_version)
 
 
 class Timezone(Base):
   __tablename__ = 'timezones'
+  __table_args__ = (Index('ix_timezones_user_id_id', 'user_id', 'id'),)
 
   id = Column(Integer, primary_key=True)
   user_id = Column(Integer, ForeignKey('users.id'))
@@ -22,3 +39,36 @@ class Timezone(Base):
   gmt_delta_seconds = Column(Integer)
   city = Column(String(50))
   name = Column(String(50))
+  # IANA zone (America/New_York), gmt_delta_seconds only holds for one
+  # part of the year in zones with daylight saving time
+  zone_id = Column(String(64))
+
+
+def upgrade(engine):
+  # create_all only creates missing tables, bring existing ones up to date
+  inspector = sqlalchemy.inspect(engine)
+  for table in Base.metadata.sorted_tables:
+    columns = set(column['name'] for column in
+                  inspector.get_columns(table.name))
+    for column in table.columns:
+      if column.name not in columns:
+        _add_column(engine, table, column)
+    existing = set(index['name'] for index in inspector.get_indexes(table.name))
+    for index in table.indexes:
+      if index.name not in existing:
+        index.create(engine)
+
+
+def _add_column(engine, table, column):
+  ddl = 'ALTER TABLE {} ADD COLUMN {} {}'.format(
+    table.name, column.name, column.type.compile(dialect=engine.dialect))
+  if column.default is not None:
+    value = column.default.arg
+    if column.default.is_callable:
+      value = value(None)
+    ddl += ' DEFAULT {}'.format(sqlalchemy.literal(value).compile(
+      dialect=engine.dialect, compile_kwargs=dict(literal_binds=True)))
+  # existing rows need a default before the column can be NOT NULL
+  if not column.nullable and column.default is not None:
+    ddl += ' NOT NULL'
+  engine.execute(ddl)
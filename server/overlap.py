@@ -0,0 +1,54 @@
+import numpy
+
+DAY = 24 * 60 * 60
+
+
+def _to_utc(offsets_at, local):
+  # the offset for a local time is the one in force at local - offset; a
+  # second lookup settles it everywhere but inside a daylight saving gap
+  return local - offsets_at(local - offsets_at(local))
+
+
+def working_intervals(offsets_at, start, end, work_start, work_end,
+                      weekdays=None):
+  # -> (starts, ends) arrays, in UTC, of a zone's working hours on every
+  # local day touching [start, end). offsets_at maps an int64 array of
+  # instants to the zone's offsets; weekdays counts from 0 for Monday.
+  # Offsets stay under a day, so a day of margin each side is enough.
+  days = numpy.arange(start // DAY - 1, end // DAY + 2, dtype=numpy.int64)
+  if weekdays is not None:
+    # 1970-01-01 was a Thursday
+    days = days[numpy.in1d((days + 3) % 7, weekdays)]
+  midnights = days * DAY
+  return (_to_utc(offsets_at, midnights + work_start),
+          _to_utc(offsets_at, midnights + work_end))
+
+
+def common_intervals(zones, start, end):
+  # -> (starts, ends) of the times within [start, end) that fall inside one
+  # interval of every zone, zones being (starts, ends) pairs whose
+  # intervals don't overlap within a zone. A sweep over the sorted start
+  # and end events: wherever the count of open intervals equals the number
+  # of zones, all of them overlap.
+  empty = numpy.array([], dtype=numpy.int64)
+  if len(zones) == 0:
+    return empty, empty
+  times = numpy.concatenate([s for s, _ in zones] + [e for _, e in zones])
+  opened = sum(len(s) for s, _ in zones)
+  kinds = numpy.concatenate([numpy.ones(opened, numpy.int64),
+                             -numpy.ones(len(times) - opened, numpy.int64)])
+  # by time, ends before starts, so touching intervals don't overlap
+  order = numpy.lexsort((kinds, times))
+  times = times[order]
+  counts = numpy.cumsum(kinds[order])
+  full = numpy.nonzero(counts[:-1] == len(zones))[0]
+  starts = numpy.maximum(times[full], start)
+  ends = numpy.minimum(times[full + 1], end)
+  kept = starts < ends
+  starts, ends = starts[kept], ends[kept]
+  if len(starts) == 0:
+    return empty, empty
+  # joins the pieces split where one zone's consecutive intervals touch
+  joined = numpy.concatenate([[True], starts[1:] > ends[:-1]])
+  last = numpy.concatenate([joined[1:], [True]])
+  return starts[joined], ends[last]
@@ -0,0 +1,104 @@
+import argparse
+import cProfile
+import hashlib
+import hmac
+import itertools
+import logging
+import os
+import re
+import time
+from metrics import MetricsMiddleware
+
+log = logging.getLogger(__name__)
+
+
+def sign(secret, expires):
+  return hmac.new(secret, str(expires), hashlib.sha256).hexdigest()
+
+
+def profile_header(secret, ttl):
+  expires = int(time.time()) + ttl
+  return '{}:{}'.format(expires, sign(secret, expires))
+
+
+# Profiles single requests with cProfile: those carrying a valid X-Profile
+# header ("<expires>:<hmac of expires>", see profile_header) and one in
+# every profile_sample_rate requests when that is above 0. Profiles are
+# written as pstats files to profile_dir, keeping the newest profile_keep.
+# With no secret ('') and no sample rate the middleware stays out of the
+# chain.
+class ProfilingMiddleware(object):
+  HEADER = 'X-Profile'
+
+  def __init__(self, profile_secret, profile_sample_rate, profile_dir,
+               profile_keep):
+    self.secret = profile_secret
+    self.sample_rate = profile_sample_rate
+    self.directory = profile_dir
+    self.keep = profile_keep
+    self.requests = itertools.count(1)
+    self.dumps = itertools.count()
+
+  @property
+  def enabled(self):
+    return len(self.secret) > 0 or self.sample_rate > 0
+
+  def _signed(self, request):
+    value = request.headers.get(self.HEADER)
+    if value is None or len(self.secret) == 0:
+      return False
+    expires, _, signature = value.partition(':')
+    if not expires.isdigit() or int(expires) < time.time():
+      return False
+    return hmac.compare_digest(sign(self.secret, expires), str(signature))
+
+  def _sampled(self):
+    return (self.sample_rate > 0 and
+            next(self.requests) % self.sample_rate == 0)
+
+  def __call__(self, request, response, app):
+    if not (self._sampled() or self._signed(request)):
+      return app(request, response)
+    profile = cProfile.Profile()
+    try:
+      response = profile.runcall(app, request, response)
+    finally:
+      name = self._dump(profile, request)
+    if name is not None:
+      response.headers['X-Profile-File'] = name
+    return response
+
+  def _dump(self, profile, request):
+    endpoint = request.environ.get(MetricsMiddleware.ENDPOINT_KEY,
+                                   MetricsMiddleware.UNMATCHED)
+    name = '{:.0f}-{}-{}-{}.pstats'.format(
+      time.time() * 1000, os.getpid(), next(self.dumps),
+      re.sub('[^0-9a-zA-Z]+', '_', endpoint).strip('_'))
+    try:
+      if not os.path.isdir(self.directory):
+        os.makedirs(self.directory)
+      profile.dump_stats(os.path.join(self.directory, name))
+      self._rotate()
+    except (IOError, OSError):
+      log.exception('could not write profile %s', name)
+      return None
+    return name
+
+  def _rotate(self):
+    profiles = sorted(name for name in os.listdir(self.directory)
+                      if name.endswith('.pstats'))
+    # names start with the time in ms, so the oldest sort first
+    for name in profiles[:max(0, len(profiles) - self.keep)]:
+      try:
+        os.remove(os.path.join(self.directory, name))
+      except OSError:
+        pass
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Sign an X-Profile header.')
+  parser.add_argument('secret_file', help='file holding the profile secret')
+  parser.add_argument('--ttl', type=int, default=600,
+                      help='seconds the header stays valid')
+  args = parser.parse_args()
+  print profile_header(open(args.secret_file).read().strip(), args.ttl)
@@ -0,0 +1,106 @@
+from collections import defaultdict
+import logging
+import time
+from sqlalchemy import event
+from metrics import MetricsMiddleware
+
+log = logging.getLogger(__name__)
+
+
+class QueryStats(object):
+  def __init__(self, request):
+    self.request = request
+    self.count = 0
+    self.seconds = 0
+    self.selects = defaultdict(int)
+
+  @property
+  def endpoint(self):
+    return self.request.environ.get(MetricsMiddleware.ENDPOINT_KEY,
+                                    MetricsMiddleware.UNMATCHED)
+
+  def record(self, statement, seconds):
+    self.count += 1
+    self.seconds += seconds
+    if statement.lstrip()[:6].upper() == 'SELECT':
+      self.selects[statement] += 1
+
+  def repeated(self, threshold):
+    # the same SELECT run over and over, usually once per row of a previous
+    # result; batch writes are expected to repeat their INSERTs
+    return sorted((count, statement)
+                  for statement, count in self.selects.iteritems()
+                  if count >= threshold)
+
+
+# Attributes every statement run on the engine to the request being served
+# on its thread. Statements slower than slow_query_seconds are logged with
+# their endpoint, and so are requests repeating a SELECT at least
+# repeated_query_threshold times. With debug on, responses carry the
+# request's totals in X-Query-Count and X-Query-Time (milliseconds, up to
+# the point the handler returned).
+class QueryStatsMiddleware(object):
+  def __init__(self, db_engine, request_plan, current_request,
+               request_teardown, metrics, slow_query_seconds,
+               repeated_query_threshold, debug):
+    self.current_request = current_request
+    self.request_teardown = request_teardown
+    self.slow_query_seconds = slow_query_seconds
+    self.repeated_query_threshold = repeated_query_threshold
+    self.debug = debug
+    self.current_stats = request_plan.add('query_stats', self._start)
+    self.statement_latency = metrics.histogram(
+      'db_statement_seconds', 'Time to run a single SQL statement')
+    self.queries = metrics.histogram(
+      'db_queries_per_request', 'SQL statements run by a request',
+      (1, 2, 5, 10, 20, 50, 100, 200, 500), ('endpoint',))
+    self.slow = metrics.counter(
+      'db_slow_queries_total', 'Statements over the slow query threshold',
+      ('endpoint',))
+    self.repeated = metrics.counter(
+      'db_repeated_query_requests_total',
+      'Requests repeating a SELECT once per row', ('endpoint',))
+    event.listen(db_engine, 'before_cursor_execute', self._before)
+    event.listen(db_engine, 'after_cursor_execute', self._after)
+
+  def _start(self):
+    stats = QueryStats(self.current_request())
+    self.request_teardown(lambda: self._finish(stats))
+    return stats
+
+  def _finish(self, stats):
+    endpoint = (stats.endpoint,)
+    self.queries.observe(stats.count, endpoint)
+    repeated = stats.repeated(self.repeated_query_threshold)
+    if len(repeated) > 0:
+      self.repeated.inc(1, endpoint)
+      for count, statement in repeated:
+        log.warning('%s ran the same query %d times, once per row? %s',
+                    endpoint[0], count, statement)
+
+  @staticmethod
+  def _before(connection, cursor, statement, parameters, context,
+              executemany):
+    context.query_start = time.time()
+
+  def _after(self, connection, cursor, statement, parameters, context,
+             executemany):
+    seconds = time.time() - context.query_start
+    self.statement_latency.observe(seconds)
+    stats = self.current_stats.get()
+    if stats is not None:
+      stats.record(statement, seconds)
+    if seconds >= self.slow_query_seconds:
+      endpoint = 'no request' if stats is None else stats.endpoint
+      if stats is not None:
+        self.slow.inc(1, (endpoint,))
+      log.warning('slow query on %s (%.3fs): %s', endpoint, seconds,
+                  statement)
+
+  def __call__(self, request, response, app):
+    response = app(request, response)
+    if self.debug:
+      stats = self.current_stats()
+      response.headers['X-Query-Count'] = str(stats.count)
+      response.headers['X-Query-Time'] = '{:.1f}'.format(stats.seconds * 1000)
+    return response
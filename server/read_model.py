@@ -0,0 +1,140 @@
+from array import array
+from collections import OrderedDict
+import bisect
+import sys
+import threading
+from models import Timezone
+
+
+# A user's timezones as their encoded JSON objects, in id order.
+# fragments is None for users with too many timezones to keep.
+class UserTimezones(object):
+  __slots__ = ('version', 'ids', 'fragments', 'size')
+
+  def __init__(self, version, ids, fragments):
+    self.version = version
+    self.ids = ids
+    self.fragments = fragments
+    self.size = sys.getsizeof(self) + sys.getsizeof(ids)
+    if fragments is not None:
+      self.size += sys.getsizeof(fragments) + sum(
+        sys.getsizeof(fragment) for fragment in fragments)
+
+  def fragment(self, timezone_id):
+    index = bisect.bisect_left(self.ids, timezone_id)
+    if index < len(self.ids) and self.ids[index] == timezone_id:
+      return self.fragments[index]
+    return None
+
+  def page(self, after_id=None, limit=None):
+    # -> (fragments, the last id when more follow or None)
+    start = 0
+    if after_id is not None:
+      start = bisect.bisect_right(self.ids, after_id)
+    end = len(self.ids)
+    if limit is not None and start + limit < end:
+      end = start + limit
+      return self.fragments[start:end], self.ids[end - 1]
+    return self.fragments[start:end], None
+
+
+# Read-through cache of every user's timezones, pre-encoded, so reads skip
+# fetching rows and building ORM objects. An entry holds for one
+# timezones_version: looking the version up is the one query a hit costs,
+# and it keeps other worker processes' writes from being missed. Writes
+# here invalidate the user's entry. The least recently used entries go
+# once read_model_max_bytes is held, 0 turns the cache off; a user taking
+# over an eighth of that is read from the database every time.
+class TimezoneReadModel(object):
+  def __init__(self, read_model_max_bytes, timezone_dto, json_encoder,
+               metrics):
+    self.max_bytes = read_model_max_bytes
+    self.max_user_bytes = read_model_max_bytes // 8
+    self.timezone_dto = timezone_dto
+    self.json_encoder = json_encoder
+    self.entries = OrderedDict()
+    self.bytes = 0
+    self.lock = threading.Lock()
+    self.hits = 0
+    self.misses = 0
+    metrics.counter('read_model_hits_total', 'Timezone reads served cached',
+                    fn=lambda: self.hits)
+    metrics.counter('read_model_misses_total',
+                    'Timezone reads that loaded the user',
+                    fn=lambda: self.misses)
+    metrics.gauge('read_model_hit_ratio', 'Timezone reads served cached',
+                  self.hit_ratio)
+    metrics.gauge('read_model_users', 'Users cached', lambda: len(self.entries))
+    metrics.gauge('read_model_bytes', 'Memory held by cached timezones',
+                  lambda: self.bytes)
+
+  @property
+  def enabled(self):
+    return self.max_bytes > 0
+
+  def hit_ratio(self):
+    lookups = self.hits + self.misses
+    return self.hits / float(lookups) if lookups > 0 else 0
+
+  def lookup(self, session, user_id, version):
+    # -> the user's timezones at version, or None to read the database
+    if not self.enabled:
+      return None
+    entry = self.get(user_id, version)
+    if entry is None:
+      entry = self.load(session, user_id, version)
+      self.put(user_id, entry)
+    return entry if entry.fragments is not None else None
+
+  def get(self, user_id, version):
+    with self.lock:
+      entry = self.entries.pop(user_id, None)
+      if entry is None or entry.version != version:
+        if entry is not None:
+          self.bytes -= entry.size
+        self.misses += 1
+        return None
+      self.entries[user_id] = entry
+      # users too large to keep are read from the database all the same
+      if entry.fragments is None:
+        self.misses += 1
+      else:
+        self.hits += 1
+      return entry
+
+  def load(self, session, user_id, version):
+    # rows read after the version are at least as new as it, a write in
+    # between leaves an entry that just never matches
+    rows = session.query(
+      Timezone.id, Timezone.gmt_delta_seconds, Timezone.city, Timezone.name,
+      Timezone.zone_id).filter(Timezone.user_id == user_id).order_by(
+      Timezone.id)
+    encode = self.json_encoder.encode
+    ids = array('l')
+    fragments = []
+    size = 0
+    for row in rows:
+      fragment = encode(self.timezone_dto.to_msg(row))
+      size += len(fragment)
+      if size > self.max_user_bytes:
+        return UserTimezones(version, array('l'), None)
+      ids.append(row.id)
+      fragments.append(fragment)
+    return UserTimezones(version, ids, fragments)
+
+  def put(self, user_id, entry):
+    with self.lock:
+      previous = self.entries.pop(user_id, None)
+      if previous is not None:
+        self.bytes -= previous.size
+      self.entries[user_id] = entry
+      self.bytes += entry.size
+      while self.bytes > self.max_bytes:
+        _, evicted = self.entries.popitem(last=False)
+        self.bytes -= evicted.size
+
+  def invalidate(self, user_id):
+    with self.lock:
+      entry = self.entries.pop(user_id, None)
+      if entry is not None:
+        self.bytes -= entry.size
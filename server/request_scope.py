@@ -1,62 +1,126 @@
+import logging
 import threading
-from pinject import Scope, BindingSpec, provides
-import pinject
-
-
-class RequestScope(Scope):
-  def __init__(self, request_scope_middleware):
-    self.middleware = request_scope_middleware
-
-  def provide(self, binding_key, default_provider_fn):
-    if binding_key not in self.middleware:
-      self.middleware[binding_key] = to_provide = default_provider_fn()
-      return to_provide
-    else:
-      return self.middleware[binding_key]
-
-  @classmethod
-  def external_dep(cls):
-    raise RuntimeError('Cannot resolve dependency through a provider')
+from pinject import BindingSpec
+
+log = logging.getLogger(__name__)
+
+_UNSET = object()
+
+
+# Request-scoped values live in a per-thread list, one slot per value, and
+# are built on first use. Consumers get a RequestValue getter at startup
+# instead of going through the object graph on every access.
+class RequestValue(object):
+  def __init__(self, local, index, name, factory):
+    self.local = local
+    self.index = index
+    self.name = name
+    self.factory = factory
+
+  def __call__(self):
+    values = self.local.values
+    value = values[self.index]
+    if value is _UNSET:
+      value = values[self.index] = self.factory()
+    return value
+
+  def get(self):
+    # None when this thread isn't serving a request
+    if getattr(self.local, 'values', None) is None:
+      return None
+    return self()
+
+
+class RequestPlan(object):
+  def __init__(self, local):
+    self.local = local
+    self.values = []
+
+  def add(self, name, factory):
+    if any(value.name == name for value in self.values):
+      raise ValueError("Request value {} already present".format(name))
+    value = RequestValue(self.local, len(self.values), name, factory)
+    self.values.append(value)
+    return value
+
+  def new_values(self):
+    return [_UNSET] * len(self.values)
+
+  def compile(self, handlers):
+    # fails at startup on handlers reaching getters from another plan,
+    # whose values would never be set while serving this one's requests
+    for endpoint, handler in handlers.iteritems():
+      found = set()
+      _find_values(getattr(handler, '__self__', handler), found, set(), 3)
+      for value in found:
+        if value.local is not self.local:
+          raise ValueError("{} uses request value {} from another plan"
+                           .format(endpoint, value.name))
+
+
+def _find_values(obj, found, seen, depth):
+  if isinstance(obj, RequestValue):
+    found.add(obj)
+    return
+  if depth == 0 or id(obj) in seen or not hasattr(obj, '__dict__'):
+    return
+  seen.add(id(obj))
+  for attribute in vars(obj).itervalues():
+    _find_values(attribute, found, seen, depth - 1)
+
+
+def _outside_request():
+  raise RuntimeError('No request is being served')
 
 
 class RequestScopeMiddleware(object):
   def __init__(self):
     self.local = threading.local()
+    self.plan = RequestPlan(self.local)
+    self.request = self.plan.add('request', _outside_request)
 
-  def __contains__(self, item):
-    return item in self.local.store
-
-  def __getitem__(self, item):
-    return self.local.store[item]
-
-  def __setitem__(self, key, item):
-    self.local.store[key] = item
+  def add_teardown(self, fn):
+    self.local.teardown.append(fn)
 
   def __call__(self, request, response, app):
-    self.local.store = dict()
-    self.local.request = request
-    response = app(request, response)
-    del self.local.store
-    del self.local.request
+    self.local.values = values = self.plan.new_values()
+    values[self.request.index] = request
+    self.local.teardown = []
+    try:
+      response = app(request, response)
+    except:
+      self._teardown()
+      raise
+    if getattr(response, 'is_streamed', False):
+      # the body is produced while the server iterates it, on this same
+      # thread; keep the values and the session until it is done
+      response.call_on_close(self._teardown)
+    else:
+      self._teardown()
     return response
 
+  def _teardown(self):
+    try:
+      for fn in reversed(self.local.teardown):
+        try:
+          fn()
+        except Exception:
+          log.exception('request teardown failed')
+    finally:
+      # pooled threads serve many requests, nothing may leak to the next one
+      del self.local.values
+      del self.local.teardown
+
 
 class RequestScopeModule(BindingSpec):
   def __init__(self):
     self.middleware = RequestScopeMiddleware()
-    self.scope = RequestScope(self.middleware)
-    self.id_to_scope = dict(request=self.scope)
-
-  @provides(in_scope='request')
-  def provide_request(self):
-    return self.middleware.local.request
-
-  def is_usable(self, inner, outer):
-    return True
-    #return not (inner == 'request' and outer == pinject.SINGLETON)
-
-
-
 
+  def provide_request_plan(self):
+    return self.middleware.plan
 
+  def provide_current_request(self):
+    return self.middleware.request
 
+  def provide_request_teardown(self):
+    return self.middleware.add_teardown
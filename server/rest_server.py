@@ -1,6 +1,7 @@
+import collections
 import json
+import re
 import threading
-import wsgiref.simple_server
 import pinject
 import requests
 from werkzeug.exceptions import HTTPException
@@ -8,9 +9,12 @@ from werkzeug.http import parse_options_header
 from werkzeug.routing import Map, Rule
 from werkzeug.utils import cached_property
 from werkzeug.wrappers import Request, Response
-from werkzeug.wsgi import SharedDataMiddleware
+from werkzeug.wsgi import DispatcherMiddleware
 from wsgiref import simple_server
 from db import DbCreator
+from metrics import MetricsMiddleware
+from results import Result
+import serving
 import wiring
 
 
@@ -25,31 +29,83 @@ class JSONRequest(Request):
       return json.loads(self.data)
 
 
+# Rules the router can dispatch without werkzeug: static paths, and static
+# prefixes followed by a single plain <int:...> segment.
+_ID_RULE = re.compile(r'^(?P<prefix>[^<]*)/<int:(?P<arg>\w+)>$')
+# what werkzeug's IntegerConverter accepts, rules are matched as unicode
+_DIGITS = re.compile(r'\d+\Z', re.UNICODE)
+
+
 class RestRouter(object):
   def __init__(self, json_encoder):
     self.handlers = {}
+    self.content_limits = {}
     self.map = Map()
     self.encoder = json_encoder
+    # (method, path) -> endpoint
+    self.static_routes = {}
+    # (method, prefix) -> (endpoint, id argument name)
+    self.id_routes = {}
 
-  def add_rule(self, rule, fn):
+  def add_rule(self, rule, fn, max_content_length=None):
     if rule.endpoint in self.handlers:
       raise ValueError("Endpoint {} already present".format(rule.endpoint))
     self.handlers[rule.endpoint] = fn
+    if max_content_length is not None:
+      self.content_limits[rule.endpoint] = max_content_length
     self.map.add(rule)
-
-  def add_resource(self, service, path):
+    self._compile(rule)
+
+  def _compile(self, rule):
+    # werkzeug still matches anything not compiled here, including every
+    # miss, so 404s and 405s come from it unchanged
+    if (rule.methods is None or rule.subdomain or rule.host or rule.defaults
+        or rule.build_only or rule.redirect_to is not None):
+      return
+    id_rule = _ID_RULE.match(rule.rule)
+    for method in rule.methods:
+      if '<' not in rule.rule:
+        self.static_routes[(method, rule.rule)] = rule.endpoint
+      elif id_rule is not None:
+        self.id_routes[(method, id_rule.group('prefix'))] = (
+          rule.endpoint, id_rule.group('arg'))
+
+  def match(self, request):
+    method = request.method
+    path = request.path
+    endpoint = self.static_routes.get((method, path))
+    if endpoint is not None:
+      return endpoint, {}
+    prefix, _, tail = path.rpartition('/')
+    route = self.id_routes.get((method, prefix))
+    if route is not None and _DIGITS.match(tail):
+      return route[0], {route[1]: int(tail)}
+    return self.map.bind_to_environ(request.environ).match()
+
+  def add_resource(self, service, path, content_limits=None):
     rules = RestRules(path)
+    content_limits = content_limits or {}
     for method in RestRules.METHOD_NAMES:
       if callable(getattr(service, method, None)):
-        self.add_rule(getattr(rules, method), getattr(service, method))
+        self.add_rule(getattr(rules, method), getattr(service, method),
+                      content_limits.get(method))
 
   def __call__(self, request, response):
-    matcher = self.map.bind_to_environ(request.environ)
-    endpoint, args = matcher.match()
+    endpoint, args = self.match(request)
+    request.environ[MetricsMiddleware.ENDPOINT_KEY] = endpoint
     handler = self.handlers[endpoint]
+    if endpoint in self.content_limits:
+      request.max_content_length = self.content_limits[endpoint]
     result = handler(args, request)
+    if isinstance(result, Result):
+      response.headers.extend(result.headers)
+      result = result.value
     if isinstance(result, Response):
       return result
+    elif isinstance(result, collections.Iterator):
+      response.response = self.iter_json(result)
+      response.content_type = 'application/json'
+      return response
     elif result is not None:
       response.set_data(self.encoder.encode(result))
       response.content_type = 'application/json'
@@ -57,9 +113,42 @@ class RestRouter(object):
     else:
       return response
 
+  # bytes buffered before a streamed chunk is handed to the server
+  STREAM_CHUNK_SIZE = 64 * 1024
+
+  def iter_json(self, items):
+    # encodes a JSON array one item at a time, so memory stays flat however
+    # many items there are; encode() is the encoder's fast one-shot path
+    encode = self.encoder.encode
+    chunk = ['[']
+    size = 0
+    separator = ''
+    for item in items:
+      chunk.append(separator)
+      separator = ','
+      encoded = encode(item)
+      chunk.append(encoded)
+      size += len(encoded)
+      if size >= self.STREAM_CHUNK_SIZE:
+        yield ''.join(chunk)
+        chunk = []
+        size = 0
+    chunk.append(']')
+    yield ''.join(chunk)
+
+
+# Adapts a dumps function (ujson, simplejson...) to the json_encoder binding.
+class DumpsEncoder(object):
+  def __init__(self, dumps):
+    self.dumps = dumps
+
+  def encode(self, value):
+    return self.dumps(value)
+
 
 class RestRules(object):
-  METHOD_NAMES = frozenset({'get', 'list', 'update', 'create', 'delete'})
+  METHOD_NAMES = frozenset({'get', 'list', 'update', 'create', 'delete',
+                            'batch', 'convert', 'overlap'})
 
   def __init__(self, path):
     self.get = Rule(path + '/<int:id>', methods=['GET'], endpoint=path + '/get')
@@ -69,6 +158,12 @@ class RestRules(object):
                        endpoint=path + '/delete')
     self.list = Rule(path, methods=['GET'], endpoint=path + '/list')
     self.create = Rule(path, methods=['POST'], endpoint=path + '/create')
+    self.batch = Rule(path + '/batch', methods=['POST'],
+                      endpoint=path + '/batch')
+    self.convert = Rule(path + '/convert', methods=['POST'],
+                        endpoint=path + '/convert')
+    self.overlap = Rule(path + '/overlap', methods=['POST'],
+                        endpoint=path + '/overlap')
 
 
 class MiddlewareLink(object):
@@ -114,15 +209,28 @@ class JsonExceptionWrapper(object):
 
 
 class WebServer(object):
-  def __init__(self, host, port, app, client_folder):
+  def __init__(self, host, port, app, client_folder, workers, threads,
+               db_engine, static_assets):
     if client_folder == '':
       web_app = app.wsgi
     else:
-      web_app = SharedDataMiddleware(app.wsgi, {'/client': client_folder})
-    self.server = wsgiref.simple_server.make_server(host, port, web_app)
+      web_app = DispatcherMiddleware(app.wsgi,
+                                     {static_assets.prefix: static_assets})
+    self.server = serving.ThreadPoolWSGIServer((host, port), threads)
+    self.server.set_app(web_app)
+    self.workers = workers
+    self.db_engine = db_engine
 
   def run(self):
-    self.server.serve_forever()
+    if self.workers > 1:
+      serving.PreforkServer(self.server, self.workers, self.after_fork).run()
+    else:
+      self.server.start_threads()
+      self.server.serve_forever()
+
+  def after_fork(self):
+    # connections pooled before the fork must not be shared with the parent
+    self.db_engine.dispose()
 
 
 class App(object):
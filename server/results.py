@@ -0,0 +1,7 @@
+# A handler's return value when the response needs headers besides the
+# JSON body. Kept apart from rest_server so services can build results
+# without importing the server and its wiring.
+class Result(object):
+  def __init__(self, value, headers=()):
+    self.value = value
+    self.headers = headers
@@ -0,0 +1,104 @@
+import threading
+import sqlalchemy as sa
+from sqlalchemy.sql import column, table
+from models import Timezone
+
+FTS_TABLE = 'timezones_fts'
+
+FTS_TRIGGERS = ('timezones_fts_ai', 'timezones_fts_ad', 'timezones_fts_au')
+
+# user_id is stored unindexed so matches can be restricted to one user
+# inside the FTS query itself
+FTS_DDL = [
+  "CREATE VIRTUAL TABLE timezones_fts USING fts5("
+  "user_id UNINDEXED, city, name, content='timezones', content_rowid='id', "
+  "tokenize='trigram')",
+  "CREATE TRIGGER timezones_fts_ai AFTER INSERT ON timezones BEGIN "
+  "INSERT INTO timezones_fts(rowid, user_id, city, name) "
+  "VALUES (new.id, new.user_id, new.city, new.name); END",
+  "CREATE TRIGGER timezones_fts_ad AFTER DELETE ON timezones BEGIN "
+  "INSERT INTO timezones_fts(timezones_fts, rowid, user_id, city, name) "
+  "VALUES ('delete', old.id, old.user_id, old.city, old.name); END",
+  "CREATE TRIGGER timezones_fts_au AFTER UPDATE ON timezones BEGIN "
+  "INSERT INTO timezones_fts(timezones_fts, rowid, user_id, city, name) "
+  "VALUES ('delete', old.id, old.user_id, old.city, old.name); "
+  "INSERT INTO timezones_fts(rowid, user_id, city, name) "
+  "VALUES (new.id, new.user_id, new.city, new.name); END",
+  "INSERT INTO timezones_fts(timezones_fts) VALUES ('rebuild')",
+]
+
+# trigram indexes can't answer queries shorter than a trigram
+MIN_FTS_QUERY = 3
+
+
+def create_index(engine):
+  if engine.dialect.name != 'sqlite':
+    return False
+  with engine.begin() as connection:
+    columns = _index_columns(connection)
+    if 'user_id' in columns:
+      return True
+    try:
+      connection.execute("CREATE VIRTUAL TABLE temp.fts_probe USING fts5("
+                         "x, tokenize='trigram')")
+      connection.execute("DROP TABLE temp.fts_probe")
+    except sa.exc.OperationalError:
+      return False
+    if len(columns) > 0:
+      # an index from before user_id was stored, rebuild it
+      for trigger in FTS_TRIGGERS:
+        connection.execute("DROP TRIGGER IF EXISTS {}".format(trigger))
+      connection.execute("DROP TABLE {}".format(FTS_TABLE))
+    for statement in FTS_DDL:
+      connection.execute(statement)
+  return True
+
+
+def _index_columns(connection):
+  result = connection.execute("PRAGMA table_info({})".format(FTS_TABLE))
+  # no result set at all when the table is missing
+  return [row[1] for row in result] if result.returns_rows else []
+
+
+def _has_index(connection):
+  return 'user_id' in _index_columns(connection)
+
+
+def _like_pattern(text):
+  escaped = (text.replace('\\', '\\\\').replace('%', '\\%')
+             .replace('_', '\\_'))
+  return u'%{}%'.format(escaped)
+
+
+class TimezoneSearch(object):
+  def __init__(self, db_engine):
+    self.engine = db_engine
+    self.lock = threading.Lock()
+    self.indexed = None
+
+  @property
+  def available(self):
+    if self.indexed is None:
+      with self.lock:
+        if self.indexed is None and self.engine.dialect.name == 'sqlite':
+          with self.engine.connect() as connection:
+            self.indexed = _has_index(connection)
+        elif self.indexed is None:
+          self.indexed = False
+    return self.indexed
+
+  def filter(self, timezones, user_id, text):
+    if len(text) >= MIN_FTS_QUERY and self.available:
+      phrase = u'"{}"'.format(text.replace('"', '""'))
+      matches = sa.select([column('rowid')]).select_from(
+        table(FTS_TABLE)).where(
+        sa.text('timezones_fts MATCH :fts_query AND user_id = :fts_user_id')
+        .bindparams(fts_query=phrase, fts_user_id=user_id))
+      return timezones.filter(Timezone.id.in_(matches))
+    pattern = _like_pattern(text)
+    return timezones.filter(
+      sa.or_(
+        Timezone.city.ilike(pattern, escape='\\'),
+        Timezone.name.ilike(pattern, escape='\\')
+      )
+    )
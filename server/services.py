@@ -1,7 +1,15 @@
+from collections import OrderedDict, namedtuple
 from itertools import groupby
+import functools
 import json
+import threading
+import numpy
 from models import User, Timezone
+import overlap
+from results import Result
 from sqlalchemy.exc import IntegrityError
+from werkzeug.exceptions import Unauthorized
+from werkzeug.http import quote_etag
 from werkzeug.wrappers import Response
 import sqlalchemy as sa
 
@@ -23,28 +31,114 @@ class Errors(object):
     response.data = json.dumps(body)
     return response
 
-  Unauthorized = error("Invalid credentials", 401)
+  INVALID_CREDENTIALS = "Invalid credentials"
+  Unauthorized = error(INVALID_CREDENTIALS, 401)
   Forbidden = error("Access denied", 403)
   NotFound = error("Not found", 404)
   error = staticmethod(error)
 
 
+CachedUser = namedtuple('CachedUser', 'id login name')
+
+
+class UserCache(object):
+  # tombstone for users deleted by this process; it only lives as long as the
+  # entry stays in the cache, tokens still expire on their own.
+  DELETED = object()
+
+  def __init__(self, user_cache_size, metrics):
+    self.max_size = user_cache_size
+    self.entries = OrderedDict()
+    self.lock = threading.Lock()
+    self.hits = 0
+    self.misses = 0
+    metrics.counter('user_cache_hits_total', 'Users found cached',
+                    fn=lambda: self.hits)
+    metrics.counter('user_cache_misses_total', 'User cache lookups missed',
+                    fn=lambda: self.misses)
+    metrics.gauge('user_cache_entries', 'Users cached',
+                  lambda: len(self.entries))
+
+  def get(self, user_id):
+    with self.lock:
+      user = self.entries.pop(user_id, None)
+      if user is not None:
+        self.entries[user_id] = user
+        self.hits += 1
+      else:
+        self.misses += 1
+      return user
+
+  def put(self, user_id, user):
+    with self.lock:
+      self.entries.pop(user_id, None)
+      self.entries[user_id] = user
+      while len(self.entries) > self.max_size:
+        self.entries.popitem(last=False)
+
+  def is_deleted(self, user_id):
+    return self.get(user_id) is self.DELETED
+
+  def invalidate(self, user_id):
+    with self.lock:
+      self.entries.pop(user_id, None)
+
+  def mark_deleted(self, user_id):
+    self.put(user_id, self.DELETED)
+
+
+class ClaimUser(object):
+  def __init__(self, user_id, load):
+    self.id = user_id
+    self._load = load
+
+  def __getattr__(self, name):
+    user = self._load(self.id)
+    if user is UserCache.DELETED:
+      raise AttributeError(name)
+    return getattr(user, name)
+
+
 class AuthMixin(object):
-  def __init__(self, auth, session_context):
+  def __init__(self, auth, session_context, user_cache, trust_token_claims):
     self.auth = auth
     self.session_context = session_context
+    self.user_cache = user_cache
+    self.trust_token_claims = trust_token_claims
 
   def _get_user(self):
+    if not self.trust_token_claims:
+      return self._load_user()
+    user_id = self.auth.get_user_id()
+    if user_id is None or self.user_cache.is_deleted(user_id):
+      return None
+    else:
+      return ClaimUser(user_id, self._cached_user)
+
+  def _load_user(self):
     user_id = self.auth.get_user_id()
     if user_id is None:
       return None
     else:
       return self.session_context.session.query(User).get(user_id)
 
+  def _cached_user(self, user_id):
+    user = self.user_cache.get(user_id)
+    if user is None:
+      found = self.session_context.session.query(User).get(user_id)
+      if found is None:
+        user = UserCache.DELETED
+      else:
+        user = CachedUser(found.id, found.login, found.name)
+      self.user_cache.put(user_id, user)
+    return user
+
 
 class UserService(AuthMixin):
-  def __init__(self, user_dto, auth, session_context):
-    super(UserService, self).__init__(auth, session_context)
+  def __init__(self, user_dto, auth, session_context, user_cache,
+               trust_token_claims):
+    super(UserService, self).__init__(auth, session_context, user_cache,
+                                      trust_token_claims)
     self.user_dto = user_dto
 
 
@@ -57,6 +151,7 @@ class UserService(AuthMixin):
     try:
       session.add(user)
       session.commit()
+      self.user_cache.invalidate(user.id)
       return self.user_dto.to_msg(user)
     except IntegrityError, e:
       session.rollback()
@@ -64,22 +159,23 @@ class UserService(AuthMixin):
 
 
   def delete(self, args, request):
-    user = self._get_user()
+    user = self._load_user()
     if user is None:
       return Errors.Unauthorized
     else:
       with self.session_context() as session:
         session.delete(user)
+      self.user_cache.mark_deleted(user.id)
 
   def get(self, args, request):
-    user = self._get_user()
+    user = self._load_user()
     if user is None:
       return Errors.Unauthorized
     else:
       return self.user_dto.to_msg(user)
 
   def update(self, args, request):
-    user = self._get_user()
+    user = self._load_user()
     if user is None:
       return Errors.Unauthorized
     else:
@@ -87,14 +183,17 @@ class UserService(AuthMixin):
       if len(errors) > 0:
         return Errors.validation(errors)
       self.user_dto.populate(user, request.msg)
+      # the password is set again, tokens issued before can't be refreshed
+      user.token_epoch = User.token_epoch + 1
       with self.session_context() as session:
         session.add(user)
+      self.user_cache.invalidate(user.id)
       return self.user_dto.to_msg(user)
 
 
 class AuthService(object):
-  def __init__(self, password_manager, auth, session_context, user_dto):
-    self.password_manager = password_manager
+  def __init__(self, password_hasher, auth, session_context, user_dto):
+    self.password_hasher = password_hasher
     self.auth = auth
     self.session_context = session_context
     self.user_dto = user_dto
@@ -106,22 +205,79 @@ class AuthService(object):
       return Errors.validation(errors)
     with self.session_context() as session:
       user = session.query(User).filter(User.login == msg['login']).first()
-      if user is not None and self.password_manager.verify(msg['password'],
-                                                           user.password):
+      if user is not None and self.password_hasher.verify(msg['password'],
+                                                          user.password):
         return dict(token=self.auth.generate_token(user))
       else:
         return Errors.Unauthorized
 
+  def refresh(self, args, request):
+    # a fresh token for a valid one, without the password: a signature
+    # check and the user's epoch, so updated or deleted users are refused
+    claim = self.auth.get_refreshable_claim(request)
+    if claim is None:
+      return Errors.Unauthorized
+    with self.session_context() as session:
+      user = session.query(User).get(self.auth.claim_user_id(claim))
+      if user is None or user.token_epoch != claim.get('epoch'):
+        return Errors.Unauthorized
+      return dict(token=self.auth.generate_token(user, claim['auth_time']))
+
 
 class TimezoneService(AuthMixin):
-  def __init__(self, timezone_dto, auth, session_context):
-    super(TimezoneService, self).__init__(auth, session_context)
+  def __init__(self, timezone_dto, auth, session_context, user_cache,
+               trust_token_claims, timezone_search, json_encoder,
+               max_convert_values, tz_catalog, timezone_read_model):
+    super(TimezoneService, self).__init__(auth, session_context, user_cache,
+                                          trust_token_claims)
     self.timezone_dto = timezone_dto
+    self.timezone_search = timezone_search
+    self.json_encoder = json_encoder
+    self.max_convert_values = max_convert_values
+    self.tz_catalog = tz_catalog
+    self.read_model = timezone_read_model
+
+  # keeps IN lists under SQLite's bound parameter limit
+  BATCH_CHUNK = 500
+  # rows fetched at a time when streaming a list
+  STREAM_BATCH = 500
+  # converted values computed and encoded at a time
+  CONVERT_CHUNK = 64 * 1024
 
   @staticmethod
   def _user_timezones(session, user_id):
     return session.query(Timezone).filter(Timezone.user_id == user_id)
 
+  @classmethod
+  def _chunks(cls, values):
+    for start in xrange(0, len(values), cls.BATCH_CHUNK):
+      yield values[start:start + cls.BATCH_CHUNK]
+
+  @staticmethod
+  def _version(session, user_id):
+    return session.query(User.timezones_version).filter(
+      User.id == user_id).scalar()
+
+  @staticmethod
+  def _bump_version(session, user_id):
+    # also how writes check the user still exists, the claim alone isn't
+    # enough once it was deleted; raising rolls the whole write back
+    bumped = session.query(User).filter(User.id == user_id).update(
+      {User.timezones_version: User.timezones_version + 1},
+      synchronize_session=False)
+    if bumped == 0:
+      raise Unauthorized(Errors.INVALID_CREDENTIALS)
+
+  @staticmethod
+  def _etag(user_id, version):
+    return 'tz-{}-{}'.format(user_id, version)
+
+  @staticmethod
+  def _cache_headers(etag):
+    # quote_etag(weak=True) writes a lowercase w/ prefix
+    return [('ETag', 'W/' + quote_etag(etag)),
+            ('Cache-Control', 'private, no-cache'), ('Vary', 'JWT')]
+
   def create(self, args, request):
     user = self._get_user()
     if user is None:
@@ -133,6 +289,8 @@ class TimezoneService(AuthMixin):
       timezone = self.timezone_dto.from_msg(request.msg)
       timezone.user_id = user.id
       session.add(timezone)
+      self._bump_version(session, user.id)
+    self.read_model.invalidate(user.id)
     return self.timezone_dto.to_msg(timezone)
 
   def update(self, args, request):
@@ -152,6 +310,8 @@ class TimezoneService(AuthMixin):
         return Errors.validation(errors)
       self.timezone_dto.populate(timezone, request.msg)
       session.add(timezone)
+      self._bump_version(session, user.id)
+    self.read_model.invalidate(user.id)
     return self.timezone_dto.to_msg(timezone)
 
   def get(self, args, request):
@@ -162,27 +322,180 @@ class TimezoneService(AuthMixin):
     if len(errors) > 0:
       return Errors.validation(errors)
     with self.session_context() as session:
+      version = self._version(session, user.id)
+      if version is None:
+        return Errors.Unauthorized
+      etag = self._etag(user.id, version)
+      headers = self._cache_headers(etag)
+      if request.if_none_match.contains_weak(etag):
+        return Response(status=304, headers=headers)
+      cached = self.read_model.lookup(session, user.id, version)
+      if cached is not None:
+        fragment = cached.fragment(args['id'])
+        if fragment is None:
+          return Errors.NotFound
+        return Response(fragment, headers=headers,
+                        content_type='application/json')
       timezone = self._user_timezones(session, user.id).filter(
         Timezone.id == args['id']).first()
       if timezone is None:
         return Errors.NotFound
-      return self.timezone_dto.to_msg(timezone)
+      return Result(self.timezone_dto.to_msg(timezone), headers)
 
   def list(self, args, request):
     user = self._get_user()
     if user is None:
       return Errors.Unauthorized
+    errors = self.timezone_dto.validate_page_args(request.args)
+    if len(errors) > 0:
+      return Errors.validation(errors)
     with self.session_context() as session:
+      version = self._version(session, user.id)
+      if version is None:
+        return Errors.Unauthorized
+      etag = self._etag(user.id, version)
+      headers = self._cache_headers(etag)
+      if request.if_none_match.contains_weak(etag):
+        return Response(status=304, headers=headers)
       timezones = self._user_timezones(session, user.id)
+      limit = request.args.get('limit')
       query = request.args.get('q')
       if query is not None and isinstance(query, basestring) and len(query) > 0:
-        timezones = timezones.filter(
-          sa.or_(
-            Timezone.city.contains(query),
-            Timezone.name.contains(query)
-          )
-        )
-      return [self.timezone_dto.to_msg(t) for t in timezones]
+        timezones = self.timezone_search.filter(timezones, user.id, query)
+      else:
+        cached = self.read_model.lookup(session, user.id, version)
+        if cached is not None:
+          return Response(self._cached_page(cached, limit,
+                                            request.args.get('cursor')),
+                          headers=headers, content_type='application/json')
+      timezones = timezones.order_by(Timezone.id)
+      if limit is None:
+        result = self._stream(timezones)
+      else:
+        result = self._page(timezones, int(limit), request.args.get('cursor'))
+      return Result(result, headers)
+
+  def _cached_page(self, cached, limit, cursor):
+    if limit is None:
+      return '[' + ','.join(cached.page()[0]) + ']'
+    after_id = None
+    if cursor is not None:
+      after_id = self.timezone_dto.decode_cursor(cursor)
+    fragments, last_id = cached.page(after_id, int(limit))
+    next_cursor = None
+    if last_id is not None:
+      next_cursor = self.timezone_dto.encode_cursor(last_id)
+    return '{{"items":[{}],"next_cursor":{}}}'.format(
+      ','.join(fragments), self.json_encoder.encode(next_cursor))
+
+  def _stream(self, timezones):
+    # rows are fetched and encoded as the response is written, the request
+    # scope keeps the session open until then
+    for timezone in timezones.yield_per(self.STREAM_BATCH):
+      yield self.timezone_dto.to_msg(timezone)
+
+  def _page(self, timezones, limit, cursor):
+    if cursor is not None:
+      after_id = self.timezone_dto.decode_cursor(cursor)
+      timezones = timezones.filter(Timezone.id > after_id)
+    page = timezones.limit(limit + 1).all()
+    if len(page) > limit:
+      page = page[:limit]
+      next_cursor = self.timezone_dto.encode_cursor(page[-1].id)
+    else:
+      next_cursor = None
+    return dict(items=[self.timezone_dto.to_msg(t) for t in page],
+                next_cursor=next_cursor)
+
+  def convert(self, args, request):
+    # {"instants": [seconds], "ids": [timezone ids], optional, all if absent}
+    # -> {"ids": [...], "gmt_delta_seconds": [...], "zone_ids": [...],
+    # "local": [[...], ...]}, local holding a row per instant and a column
+    # per timezone; timezones with a zone_id follow its daylight saving time
+    user = self._get_user()
+    if user is None:
+      return Errors.Unauthorized
+    msg = request.msg
+    errors = self.timezone_dto.validate_convert(msg)
+    if len(errors) > 0:
+      return Errors.validation(errors)
+    with self.session_context() as session:
+      zones = self._selected_zones(session, user.id, msg.get('ids'))
+    if zones is None:
+      return Errors.NotFound
+    instants = msg['instants']
+    if len(instants) * len(zones) > self.max_convert_values:
+      return Errors.validation([('instants', 'times timezones must be at '
+                                 'most {}'.format(self.max_convert_values))])
+    body = self._convert(numpy.array(instants, dtype=numpy.int64), zones)
+    return Response(body, content_type='application/json')
+
+  def _selected_zones(self, session, user_id, ids):
+    # the user's timezones in ids' order, all of them by id when ids is
+    # None; None if any of ids isn't theirs
+    zones = session.query(Timezone.id, Timezone.gmt_delta_seconds,
+                          Timezone.zone_id).filter(Timezone.user_id == user_id)
+    if ids is None:
+      return zones.order_by(Timezone.id).all()
+    found = {}
+    for chunk in self._chunks(ids):
+      found.update((zone.id, zone) for zone in zones.filter(
+        Timezone.id.in_(chunk)))
+    if len(found) < len(set(ids)):
+      return None
+    return [found[i] for i in ids]
+
+  def _offsets_at(self, zone):
+    # instants -> the zone's offsets, its zone_id's when it has one
+    if zone.zone_id is not None:
+      return functools.partial(self.tz_catalog.offsets_at, zone.zone_id)
+    return lambda instants: numpy.full(len(instants), zone.gmt_delta_seconds,
+                                       numpy.int64)
+
+  def overlap(self, args, request):
+    # {"ids": [...] (all if absent), "start": seconds, "end": seconds,
+    # "work_start": seconds from local midnight, "work_end": ...,
+    # "weekdays": [0 for monday...] (all if absent)} -> {"intervals":
+    # [[start, end], ...]}, the times in [start, end) within working hours
+    # in every one of the timezones
+    user = self._get_user()
+    if user is None:
+      return Errors.Unauthorized
+    msg = request.msg
+    errors = self.timezone_dto.validate_overlap(msg)
+    if len(errors) > 0:
+      return Errors.validation(errors)
+    with self.session_context() as session:
+      zones = self._selected_zones(session, user.id, msg.get('ids'))
+    if zones is None:
+      return Errors.NotFound
+    start, end = msg['start'], msg['end']
+    starts, ends = overlap.common_intervals(
+      [overlap.working_intervals(self._offsets_at(zone), start, end,
+                                 msg['work_start'], msg['work_end'],
+                                 msg.get('weekdays'))
+       for zone in zones], start, end)
+    return dict(ids=[zone.id for zone in zones],
+                intervals=numpy.column_stack((starts, ends)).tolist())
+
+  def _convert(self, instants, zones):
+    encode = self.json_encoder.encode
+    deltas = numpy.array([zone.gmt_delta_seconds for zone in zones],
+                         dtype=numpy.int64)
+    zoned = [(column, zone.zone_id) for column, zone in enumerate(zones)
+             if zone.zone_id is not None]
+    yield '{{"ids":{},"gmt_delta_seconds":{},"zone_ids":{},"local":['.format(
+      encode([zone.id for zone in zones]), encode(deltas.tolist()),
+      encode([zone.zone_id for zone in zones]))
+    rows = max(1, self.CONVERT_CHUNK // max(1, len(zones)))
+    for start in xrange(0, len(instants), rows):
+      # one instants x timezones block at a time, memory stays flat
+      chunk = instants[start:start + rows]
+      block = chunk[:, numpy.newaxis] + deltas
+      for column, zone_id in zoned:
+        block[:, column] = chunk + self.tz_catalog.offsets_at(zone_id, chunk)
+      yield (',' if start > 0 else '') + encode(block.tolist())[1:-1]
+    yield ']}'
 
   def delete(self, args, request):
     user = self._get_user()
@@ -196,3 +509,58 @@ class TimezoneService(AuthMixin):
         Timezone.id == args['id']).delete()
       if found == 0:
         return Errors.NotFound
+      self._bump_version(session, user.id)
+    self.read_model.invalidate(user.id)
+
+  def batch(self, args, request):
+    user = self._get_user()
+    if user is None:
+      return Errors.Unauthorized
+    operations = request.msg
+    errors = self.timezone_dto.validate_batch(operations)
+    if len(errors) > 0:
+      return Errors.validation(errors)
+    table = Timezone.__table__
+    results = []
+    updates = []
+    deletes = []
+    with self.session_context() as session:
+      owned = set()
+      for ids in self._chunks([o['id'] for o in operations
+                               if o['op'] != 'create']):
+        owned.update(row.id for row in session.query(Timezone.id).filter(
+          Timezone.user_id == user.id, Timezone.id.in_(ids)))
+      for operation in operations:
+        if operation['op'] == 'create':
+          # one core INSERT per row: sqlite's executemany can't hand back the
+          # generated ids the response needs
+          row = self.timezone_dto.to_row(operation['timezone'])
+          inserted = session.execute(table.insert(), dict(row, user_id=user.id))
+          results.append(dict(status=200, timezone=dict(
+            row, id=inserted.inserted_primary_key[0])))
+        elif operation['id'] not in owned:
+          results.append(dict(status=404, description='Not found'))
+        elif operation['op'] == 'update':
+          row = self.timezone_dto.to_row(operation['timezone'])
+          updates.append(dict(row, timezone_id=operation['id']))
+          results.append(dict(status=200, timezone=dict(row,
+                                                        id=operation['id'])))
+        else:
+          deletes.append(operation['id'])
+          results.append(dict(status=200))
+      if len(updates) > 0:
+        update = table.update().where(sa.and_(
+          table.c.user_id == user.id,
+          table.c.id == sa.bindparam('timezone_id')))
+        session.execute(update.values(
+          city=sa.bindparam('city'),
+          name=sa.bindparam('name'),
+          gmt_delta_seconds=sa.bindparam('gmt_delta_seconds'),
+          zone_id=sa.bindparam('zone_id')), updates)
+      for ids in self._chunks(deletes):
+        session.execute(table.delete().where(sa.and_(
+          table.c.user_id == user.id, table.c.id.in_(ids))))
+      if any(result['status'] == 200 for result in results):
+        self._bump_version(session, user.id)
+    self.read_model.invalidate(user.id)
+    return results
@@ -0,0 +1,188 @@
+import Queue
+import errno
+import logging
+import os
+import signal
+import sys
+import threading
+import time
+import wsgiref.simple_server
+
+log = logging.getLogger(__name__)
+
+
+# Accepts on the calling thread and hands connections to a fixed pool of
+# handler threads. Threads don't survive a fork, so they are only started
+# by start_threads, in the process that will serve.
+class ThreadPoolWSGIServer(wsgiref.simple_server.WSGIServer):
+  # seconds handle_request waits for a connection before checking for stops
+  timeout = 0.5
+
+  def __init__(self, server_address, threads):
+    # no threads would accept connections and never answer them
+    if threads < 1:
+      raise ValueError('threads must be at least 1, got {}'.format(threads))
+    wsgiref.simple_server.WSGIServer.__init__(
+      self, server_address, wsgiref.simple_server.WSGIRequestHandler)
+    self.thread_count = threads
+    self.requests = Queue.Queue(threads * 8)
+    self.threads = []
+
+  def start_threads(self):
+    self.threads = [threading.Thread(target=self._work)
+                    for _ in xrange(self.thread_count)]
+    for thread in self.threads:
+      thread.daemon = True
+      thread.start()
+
+  def process_request(self, request, client_address):
+    self.requests.put((request, client_address))
+
+  def _work(self):
+    while True:
+      request, client_address = self.requests.get()
+      if request is None:
+        return
+      try:
+        self.finish_request(request, client_address)
+      except Exception:
+        self.handle_error(request, client_address)
+      finally:
+        self.shutdown_request(request)
+
+  def stop_threads(self):
+    for _ in self.threads:
+      self.requests.put((None, None))
+    for thread in self.threads:
+      thread.join()
+    self.threads = []
+
+
+# Serves one listening socket from several forked worker processes. SIGTERM
+# and SIGINT stop the workers once their current requests are done, SIGHUP
+# replaces them with a fresh generation and crashed workers are respawned.
+# after_fork runs in every new worker before it accepts connections; workers
+# that fail there are respawned with an exponential backoff, and the server
+# gives up after max_startup_failures failures in a row.
+class PreforkServer(object):
+  STARTUP_FAILED = 3
+  max_startup_failures = 5
+  backoff = 0.1
+  max_backoff = 10
+  # workers dying sooner than this after their fork are respawned with backoff
+  min_uptime = 1
+
+  def __init__(self, server, workers, after_fork):
+    self.server = server
+    self.workers = workers
+    self.after_fork = after_fork
+    self.children = {}
+    self.stopping = False
+    self.restarting = False
+    self.startup_failures = 0
+    self.quick_deaths = 0
+
+  def run(self):
+    signal.signal(signal.SIGTERM, self._on_stop)
+    signal.signal(signal.SIGINT, self._on_stop)
+    signal.signal(signal.SIGHUP, self._on_restart)
+    self._spawn_workers()
+    while self.children:
+      if self.restarting:
+        self.restarting = False
+        old = set(self.children)
+        self._spawn_workers()
+        self._signal(old, signal.SIGTERM)
+      try:
+        pid, status = os.wait()
+      except OSError, e:
+        if e.errno == errno.EINTR:
+          continue
+        raise
+      if pid not in self.children:
+        continue
+      started = self.children.pop(pid)
+      if not self.stopping and status != 0:
+        self._respawn(pid, status, time.time() - started)
+    self.server.server_close()
+    if self.startup_failures >= self.max_startup_failures:
+      raise RuntimeError('workers failed to start {} times in a row'
+                         .format(self.startup_failures))
+
+  def _respawn(self, pid, status, uptime):
+    if os.WIFEXITED(status) and os.WEXITSTATUS(status) == self.STARTUP_FAILED:
+      self.startup_failures += 1
+      if self.startup_failures >= self.max_startup_failures:
+        log.error('workers keep failing to start, giving up')
+        self._on_stop(None, None)
+        return
+    else:
+      self.startup_failures = 0
+    if uptime < self.min_uptime:
+      self.quick_deaths += 1
+      time.sleep(min(self.max_backoff,
+                     self.backoff * 2 ** (self.quick_deaths - 1)))
+    else:
+      self.quick_deaths = 0
+    log.warning('worker %s died (status %s), respawning', pid, status)
+    if not self.stopping:
+      self._spawn()
+
+  def _on_stop(self, signum, frame):
+    self.stopping = True
+    self._signal(self.children, signal.SIGTERM)
+
+  def _on_restart(self, signum, frame):
+    if not self.stopping:
+      self.restarting = True
+
+  @staticmethod
+  def _signal(pids, signum):
+    for pid in list(pids):
+      try:
+        os.kill(pid, signum)
+      except OSError:
+        pass
+
+  def _spawn_workers(self):
+    for _ in xrange(self.workers):
+      self._spawn()
+
+  def _spawn(self):
+    pid = os.fork()
+    if pid != 0:
+      self.children[pid] = time.time()
+      return
+    # the parent's handlers would act on its list of children
+    for signum in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP):
+      signal.signal(signum, signal.SIG_DFL)
+    status = 0
+    try:
+      self._work()
+    except _StartupError:
+      log.exception('worker %s failed to start', os.getpid())
+      status = self.STARTUP_FAILED
+    except Exception:
+      log.exception('worker %s failed', os.getpid())
+      status = 1
+    finally:
+      os._exit(status)
+
+  def _work(self):
+    stop = []
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop.append(signum))
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    try:
+      self.after_fork()
+      self.server.start_threads()
+    except Exception, e:
+      raise _StartupError(e)
+    while not stop:
+      self.server.handle_request()
+    self.server.stop_threads()
+    sys.stdout.flush()
+
+
+class _StartupError(Exception):
+  pass
@@ -0,0 +1,173 @@
+import collections
+import hashlib
+import logging
+import mimetypes
+import os
+import posixpath
+import re
+import time
+import zlib
+from werkzeug.exceptions import MethodNotAllowed, NotFound
+from werkzeug.wrappers import Request, Response
+
+log = logging.getLogger(__name__)
+
+IMMUTABLE = 'public, max-age=31536000, immutable'
+REVALIDATE = 'no-cache'
+# gzip precompressed variants are kept when they save at least this much
+_MIN_SAVING = 0.1
+_CSS_URL = re.compile(r'''url\(\s*(['"]?)([^'")]+?)\1\s*\)''')
+_SOURCE_MAP = re.compile(r'sourceMappingURL=([^\s*]+)')
+_HTML_REF = re.compile(r'''(src|href)=(["'])([^"']+)\2''')
+
+Asset = collections.namedtuple('Asset', 'url mimetype data gzipped digest')
+
+
+def _kind(path):
+  # assets only refer to kinds processed before theirs: stylesheets and
+  # scripts to fonts, images and source maps, pages to all of them
+  ext = posixpath.splitext(path)[1]
+  if ext in ('.html', '.htm'):
+    return 2
+  if ext in ('.css', '.js'):
+    return 1
+  return 0
+
+
+def _split_ref(ref):
+  # -> (path, '?query' or '#fragment' suffix)
+  match = re.search(r'[?#]', ref)
+  if match is None:
+    return ref, ''
+  return ref[:match.start()], ref[match.start():]
+
+
+def _hashed(path, digest):
+  root, ext = posixpath.splitext(path)
+  return '{}.{}{}'.format(root, digest, ext)
+
+
+# The web client's files, read once at startup into an in-memory manifest.
+# Every file is served at its own path, revalidated through a strong ETag,
+# and at a path carrying its content hash, cached for a year: stylesheets,
+# scripts and pages get their references to other assets rewritten to the
+# hashed paths, so a deploy changes the URLs of whatever changed. Files
+# that compress are kept gzipped as well. Changes to the folder show up on
+# restart. Mounted by WebServer under prefix.
+class StaticAssets(object):
+  prefix = '/client'
+
+  def __init__(self, client_folder, metrics):
+    self.folder = client_folder
+    # path -> (asset, cache control)
+    self.routes = {}
+    self.assets = {}
+    metrics.gauge('static_assets', 'Static assets served',
+                  lambda: len(self.assets))
+    metrics.gauge('static_assets_bytes', 'Memory held by static assets',
+                  self.size)
+    if client_folder:
+      self.scan()
+
+  def size(self):
+    return sum(len(a.data) + len(a.gzipped or '')
+               for a in self.assets.itervalues())
+
+  def scan(self):
+    start = time.time()
+    paths = []
+    for folder, dirs, files in os.walk(self.folder):
+      dirs[:] = [d for d in dirs if not d.startswith('.')]
+      for name in files:
+        if not name.startswith('.'):
+          full = os.path.join(folder, name)
+          path = os.path.relpath(full, self.folder).replace(os.sep, '/')
+          paths.append('/' + path)
+    for path in sorted(paths, key=lambda p: (_kind(p), p)):
+      with open(os.path.join(self.folder, path[1:]), 'rb') as source:
+        data = source.read()
+      self.add(path, self._rewrite(path, data))
+    log.info('loaded %d static assets in %.1fms', len(self.assets),
+             (time.time() - start) * 1000)
+
+  def add(self, path, data):
+    digest = hashlib.sha1(data).hexdigest()[:12]
+    mimetype = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+    compressor = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    gzipped = compressor.compress(data) + compressor.flush()
+    if len(gzipped) > len(data) * (1 - _MIN_SAVING):
+      gzipped = None
+    hashed = _hashed(path, digest)
+    asset = Asset(self.prefix + hashed, mimetype, data, gzipped, digest)
+    self.assets[path] = asset
+    self.routes[path] = (asset, REVALIDATE)
+    self.routes[hashed] = (asset, IMMUTABLE)
+
+  def url(self, path):
+    # the hashed URL of the asset at path, relative to the client folder
+    return self.assets[path].url
+
+  def _rewrite(self, path, data):
+    kind = _kind(path)
+    if kind == 0:
+      return data
+    if kind == 2:
+      return _HTML_REF.sub(self._html_ref, data)
+    base = posixpath.dirname(path)
+    if path.endswith('.css'):
+      data = _CSS_URL.sub(
+        lambda m: 'url({0}{1}{0})'.format(
+          m.group(1), self._relative_ref(base, m.group(2))), data)
+    return _SOURCE_MAP.sub(
+      lambda m: 'sourceMappingURL=' + self._relative_ref(base, m.group(1)),
+      data)
+
+  def _relative_ref(self, base, ref):
+    target, suffix = _split_ref(ref)
+    if ':' in target or target.startswith('/'):
+      return ref
+    asset = self.assets.get(posixpath.normpath(posixpath.join(base, target)))
+    if asset is None:
+      return ref
+    hashed = posixpath.basename(asset.url)
+    return posixpath.join(posixpath.dirname(target), hashed) + suffix
+
+  def _html_ref(self, match):
+    target, suffix = _split_ref(match.group(3))
+    asset = None
+    if target.startswith(self.prefix + '/'):
+      asset = self.assets.get(target[len(self.prefix):])
+    if asset is None:
+      return match.group(0)
+    return '{0}={1}{2}{3}{1}'.format(match.group(1), match.group(2),
+                                     asset.url, suffix)
+
+  def __call__(self, environ, start_response):
+    request = Request(environ)
+    try:
+      response = self.serve(request)
+    except (MethodNotAllowed, NotFound) as e:
+      response = e
+    return response(environ, start_response)
+
+  def serve(self, request):
+    if request.method not in ('GET', 'HEAD'):
+      raise MethodNotAllowed(['GET', 'HEAD'])
+    route = self.routes.get(request.path)
+    if route is None:
+      raise NotFound()
+    asset, cache_control = route
+    data = asset.data
+    etag = asset.digest
+    response = Response(mimetype=asset.mimetype)
+    if asset.gzipped is not None:
+      response.vary.add('Accept-Encoding')
+      if request.accept_encodings['gzip']:
+        data = asset.gzipped
+        # a tag per representation, each of them byte for byte
+        etag += '-gz'
+        response.headers['Content-Encoding'] = 'gzip'
+    response.set_data(data)
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = cache_control
+    return response.make_conditional(request)
@@ -1,9 +1,14 @@
+import base64
 import json
+import os
 import threading
 import unittest
 import requests
+from werkzeug.test import Client
+from werkzeug.wrappers import BaseResponse
 import rest_server
 import yaml
+from tests.harness import InProcessServer
 
 
 class TimezonesClient(object):
@@ -15,10 +20,14 @@ class TimezonesClient(object):
     self.base_url = "http://{}{}{}".format(host, port_spec, base_path)
     self.headers = {'content-type': 'application/json'}
 
-  def request(self, url, method, payload=None):
+  def request(self, url, method, payload=None, params=None, headers=None):
     data = None if payload is None else json.dumps(payload)
+    if headers is not None:
+      headers = dict(self.headers, **headers)
+    else:
+      headers = self.headers
     return requests.request(method, '/'.join([self.base_url, url]),
-                            data=data, headers=self.headers)
+                            data=data, headers=headers, params=params)
 
   def set_token(self, token):
     self.headers['JWT'] = token
@@ -30,11 +39,12 @@ class TimezonesClient(object):
   def create(self, resource, value):
     return self.request(resource, 'POST', value)
 
-  def list(self, resource):
-    return self.request(resource, 'GET')
+  def list(self, resource, headers=None, **params):
+    return self.request(resource, 'GET', params=params, headers=headers)
 
-  def get(self, resource, id):
-    return self.request(self._resource_id(resource, id), 'GET')
+  def get(self, resource, id, headers=None):
+    return self.request(self._resource_id(resource, id), 'GET',
+                        headers=headers)
 
   def delete(self, resource, id):
     return self.request(self._resource_id(resource, id), 'DELETE')
@@ -53,17 +63,49 @@ class TimezonesClient(object):
     else:
       return False
 
+  def refresh(self):
+    r = self.create('auth/refresh', None)
+    if r.status_code == requests.codes.ok:
+      self.set_token(r.json()['token'])
+      return True
+    else:
+      return False
+
   def logout(self):
     self.clear_token()
 
 
+class WsgiResponse(BaseResponse):
+  def json(self):
+    return json.loads(self.data)
+
+  @property
+  def text(self):
+    return self.data.decode(self.charset)
+
+
+# Same interface as TimezonesClient, calling the WSGI app in-process.
+class WsgiTimezonesClient(TimezonesClient):
+  def __init__(self, app):
+    TimezonesClient.__init__(self, 'localhost', 80)
+    self.client = Client(app, WsgiResponse)
+
+  def request(self, url, method, payload=None, params=None, headers=None):
+    data = None if payload is None else json.dumps(payload)
+    headers = dict(self.headers, **(headers or {}))
+    # buffered, so streamed responses get closed and their teardown runs
+    return self.client.open('/' + url, method=method, data=data,
+                            headers=headers, query_string=params,
+                            buffered=True)
+
+
 class Base(unittest.TestCase):
   def basic_user(self):
     self.assertOk(client.create('users', dict(login='test1', password='test1')))
     self.assertTrue(client.login('test1', 'test1'))
 
   def setUp(self):
-    server.remote_restart()
+    reset()
 
   def tearDown(self):
     client.logout()
@@ -81,6 +123,9 @@ class Base(unittest.TestCase):
     self.assertBadRequest(response)
     self.assertEquals('Validation Error', response.json()['description'])
 
+  def assertNotModified(self, response):
+    return self.assert_code(response, 304)
+
   def assertOk(self, response):
     return self.assert_code(response, 200)
 
@@ -97,18 +142,33 @@ class Base(unittest.TestCase):
     return self.assert_code(response, 404)
 
 
-server = client = None
+server = client = reset = None
 
 
+def app_service(endpoint):
+  link = server.app.handler
+  while isinstance(link, rest_server.MiddlewareLink):
+    link = link.app
+  return link.handlers[endpoint].__self__
+
+
+# Tests call the app in-process on a copy of a template database, and can
+# run in parallel (nosetests --processes=N). With TIMEZONES_TEST_HTTP set
+# they go through a real server on port 8001 instead.
 def setup():
-  global server, client
-  port = 8001
-  host = 'localhost'
-  restart_path = '/restart'
-  stop_path = '/stop'
-  server = rest_server.RemoteRestartableApp(host, port, restart_path)
-  threading.Thread(target=server.run).start()
-  client = TimezonesClient(host, port)
+  global server, client, reset
+  if os.environ.get('TIMEZONES_TEST_HTTP'):
+    port = 8001
+    host = 'localhost'
+    restart_path = '/restart'
+    server = rest_server.RemoteRestartableApp(host, port, restart_path)
+    threading.Thread(target=server.run).start()
+    client = TimezonesClient(host, port)
+    reset = server.remote_restart
+  else:
+    server = InProcessServer()
+    client = WsgiTimezonesClient(server)
+    reset = server.reset
 
 
 def teardown():
@@ -145,6 +205,35 @@ class TestRegistrationAndLogin(Base):
     self.assertOk(reg)
 
 
+class TestTokenRefresh(Base):
+  def testRefreshesValidTokens(self):
+    self.basic_user()
+    self.assertTrue(client.refresh())
+    self.assertOk(client.list('timezones'))
+    self.assertTrue(client.refresh())
+    client.set_token('bogus')
+    self.assertFalse(client.refresh())
+    client.logout()
+    self.assertFalse(client.refresh())
+
+  def testUpdatedUserTokensAreNotRefreshed(self):
+    self.basic_user()
+    self.assertOk(client.update('users', 1, dict(login='test1',
+                                                 password='test2')))
+    self.assertFalse(client.refresh())
+    self.assertTrue(client.login('test1', 'test2'))
+    self.assertTrue(client.refresh())
+
+  def testDeletedUserTokensAreNotRefreshed(self):
+    self.basic_user()
+    self.assertOk(client.delete('users', 1))
+    self.assertFalse(client.refresh())
+    # nor handed over to the next user given the same id
+    self.assertOk(client.create('users', dict(login='test2',
+                                              password='test2')))
+    self.assertFalse(client.refresh())
+
+
 class TestTimezonesCrud(Base):
   def testNoTimezones(self):
     self.basic_user()
@@ -195,6 +284,309 @@ class TestTimezonesCrud(Base):
     self.assertOk(l)
     self.assertEquals('New York', l.json()['city'])
 
+  def testDeletedUserTokenIsRejected(self):
+    self.basic_user()
+    self.assertOk(client.list('timezones'))
+    self.assertOk(client.delete('users', 1))
+    self.assertUnauthorized(client.list('timezones'))
+    self.assertUnauthorized(client.create(
+      'timezones', dict(city='Rosario', name="ART", gmt_delta_seconds=-1440)))
+
+  def testDeletedUserTokenIsRejectedWithoutTombstone(self):
+    self.basic_user()
+    self.assertOk(client.delete('users', 1))
+    # as in another worker, or once the tombstone was evicted
+    app_service('/timezones/create').user_cache.invalidate(1)
+    base = dict(city='Rosario', name="ART", gmt_delta_seconds=-1440)
+    self.assertUnauthorized(client.list('timezones'))
+    self.assertUnauthorized(client.create('timezones', base))
+    self.assertUnauthorized(client.create('timezones/batch', [
+      dict(op='create', timezone=base)]))
+    # the id is reused by the next user, who must not inherit any rows
+    self.basic_user()
+    self.assertEquals([], client.list('timezones').json())
+
+
+class TestTimezonesPaging(Base):
+  def _create(self, *cities):
+    for city in cities:
+      self.assertOk(client.create(
+        'timezones', dict(city=city, name='TZ', gmt_delta_seconds=0)))
+
+  def _pages(self, **params):
+    pages = []
+    cursor = None
+    while True:
+      if cursor is not None:
+        params['cursor'] = cursor
+      r = client.list('timezones', **params)
+      self.assertOk(r)
+      page = r.json()
+      pages.append([t['city'] for t in page['items']])
+      cursor = page['next_cursor']
+      if cursor is None:
+        return pages
+
+  def testPagesInCreationOrder(self):
+    self.basic_user()
+    self._create('Rosario', 'Cordoba', 'Mendoza', 'Salta', 'Jujuy')
+    self.assertEquals([['Rosario', 'Cordoba'], ['Mendoza', 'Salta'], ['Jujuy']],
+                      self._pages(limit=2))
+
+  def testRejectsNonAsciiDigits(self):
+    self.basic_user()
+    self.assertValidationError(client.list('timezones', limit=u'\xb2'))
+
+  def testCompressedList(self):
+    self.basic_user()
+    for i in xrange(30):
+      client.create('timezones', dict(city='Rosario', name='ART',
+                                      gmt_delta_seconds=-10800))
+    r = client.list('timezones', headers={'Accept-Encoding': 'gzip'})
+    self.assertOk(r)
+    self.assertEquals('gzip', r.headers['Content-Encoding'])
+    self.assertIn('Accept-Encoding', r.headers['Vary'])
+
+  def testUnpagedListStreamsEveryRow(self):
+    self.basic_user()
+    cities = ['City {}'.format(i) for i in xrange(2000)]
+    self.assertOk(client.create('timezones/batch', [
+      dict(op='create', timezone=dict(city=city, name='TZ',
+                                      gmt_delta_seconds=0))
+      for city in cities]))
+    r = client.list('timezones')
+    self.assertOk(r)
+    self.assertEquals(cities, [t['city'] for t in r.json()])
+
+  def testFilterAcrossPages(self):
+    self.basic_user()
+    self._create('Rosario', 'Cordoba', 'Rosarito', 'Salta', 'Rosas')
+    self.assertEquals([['Rosario', 'Rosarito'], ['Rosas']],
+                      self._pages(limit=2, q='Ros'))
+
+  def testSearchIsCaseInsensitive(self):
+    self.basic_user()
+    self._create('Rosario', 'Cordoba', 'ROSARITO')
+    cities = lambda q: sorted(t['city'] for t in
+                              client.list('timezones', q=q).json())
+    self.assertEquals(['ROSARITO', 'Rosario'], cities('rosa'))
+    self.assertEquals(['Cordoba'], cities('dO'))
+    self.assertEquals([], cities('%'))
+
+  def testInvalidPageArgs(self):
+    self.basic_user()
+    self.assertValidationError(client.list('timezones', limit='0'))
+    self.assertValidationError(client.list('timezones', limit='x'))
+    self.assertValidationError(client.list('timezones', limit='2',
+                                           cursor='!!'))
+    self.assertValidationError(client.list('timezones', cursor='MQ=='))
+    self.assertValidationError(client.list(
+      'timezones', limit='2', cursor=base64.urlsafe_b64encode('9' * 30)))
+
+
+class TestTimezonesReadModel(Base):
+  def testReadsAreServedFromMemory(self):
+    self.basic_user()
+    base = dict(city='Rosario', name='ART', gmt_delta_seconds=-10800)
+    id = client.create('timezones', base).json()['id']
+    read_model = app_service('/timezones/list').read_model
+    self.assertEquals(['Rosario'],
+                      [t['city'] for t in client.list('timezones').json()])
+    hits = read_model.hits
+    self.assertEquals(dict(base, id=id, zone_id=None),
+                      client.get('timezones', id).json())
+    self.assertNotFound(client.get('timezones', id + 1))
+    page = client.list('timezones', limit='1').json()
+    self.assertEquals([id], [t['id'] for t in page['items']])
+    self.assertIsNone(page['next_cursor'])
+    self.assertEquals(hits + 3, read_model.hits)
+
+  def testWritesInvalidate(self):
+    self.basic_user()
+    base = dict(city='Rosario', name='ART', gmt_delta_seconds=-10800)
+    id = client.create('timezones', base).json()['id']
+    self.assertEquals(1, len(client.list('timezones').json()))
+    self.assertOk(client.update('timezones', id, dict(base, city='Cordoba')))
+    self.assertEquals('Cordoba', client.get('timezones', id).json()['city'])
+    self.assertOk(client.create('timezones/batch', [
+      dict(op='create', timezone=base)]))
+    self.assertEquals(['Cordoba', 'Rosario'],
+                      [t['city'] for t in client.list('timezones').json()])
+    self.assertOk(client.delete('timezones', id))
+    self.assertNotFound(client.get('timezones', id))
+    self.assertEquals(['Rosario'],
+                      [t['city'] for t in client.list('timezones').json()])
+
+
+class TestTimezonesBatch(Base):
+  def testMixedBatch(self):
+    self.basic_user()
+    base = dict(city='Rosario', name="ART", gmt_delta_seconds=-1440)
+    id1 = client.create('timezones', base).json()['id']
+    id2 = client.create('timezones', base).json()['id']
+    r = client.create('timezones/batch', [
+      dict(op='create', timezone=dict(base, city='Cordoba')),
+      dict(op='update', id=id1, timezone=dict(base, city='New York')),
+      dict(op='delete', id=id2),
+      dict(op='delete', id=id2 + 100),
+    ])
+    self.assertOk(r)
+    results = r.json()
+    self.assertEquals([200, 200, 200, 404], [i['status'] for i in results])
+    created = results[0]['timezone']
+    self.assertEquals('Cordoba', created['city'])
+    self.assertEquals('Cordoba', client.get('timezones',
+                                            created['id']).json()['city'])
+    self.assertEquals('New York', client.get('timezones', id1).json()['city'])
+    self.assertNotFound(client.get('timezones', id2))
+
+  def testInvalidBatchIsRejectedAsAWhole(self):
+    self.basic_user()
+    base = dict(city='Rosario', name="ART", gmt_delta_seconds=-1440)
+    r = client.create('timezones/batch', [
+      dict(op='create', timezone=base),
+      dict(op='create', timezone=dict(base, name=5)),
+      dict(op='update', timezone=base),
+    ])
+    self.assertValidationError(r)
+    fields = r.json()['details']['fields']
+    self.assertEquals({'1.timezone.name', '2.id'}, set(fields))
+    self.assertEquals([], client.list('timezones').json())
+
+
+class TestTimezonesConvert(Base):
+  def testConvertsEveryInstantInEveryTimezone(self):
+    self.basic_user()
+    base = dict(city='Rosario', name="ART", gmt_delta_seconds=-10800)
+    id1 = client.create('timezones', base).json()['id']
+    id2 = client.create('timezones', dict(base, gmt_delta_seconds=3600)).json()[
+      'id']
+    r = client.create('timezones/convert', dict(instants=[0, 1000000]))
+    self.assertOk(r)
+    self.assertEquals(dict(ids=[id1, id2], gmt_delta_seconds=[-10800, 3600],
+                           zone_ids=[None, None],
+                           local=[[-10800, 3600], [989200, 1003600]]), r.json())
+    r = client.create('timezones/convert', dict(instants=[5], ids=[id2, id1]))
+    self.assertEquals([[3605, -10795]], r.json()['local'])
+
+  def testConvertsInChunks(self):
+    self.basic_user()
+    client.create('timezones', dict(city='Rosario', name="ART",
+                                    gmt_delta_seconds=60))
+    instants = range(0, 300000 * 60, 60)[:100000]
+    local = client.create('timezones/convert',
+                          dict(instants=instants)).json()['local']
+    self.assertEquals([[i + 60] for i in instants], local)
+
+  def testFollowsDaylightSavingTime(self):
+    self.basic_user()
+    timezone = client.create('timezones', dict(
+      city='New York', name='EST', gmt_delta_seconds=-18000,
+      zone_id='America/New_York')).json()
+    self.assertEquals('America/New_York', timezone['zone_id'])
+    # 2015-01-01 and 2015-07-01, 00:00 UTC
+    r = client.create('timezones/convert',
+                      dict(instants=[1420070400, 1435708800]))
+    self.assertEquals(['America/New_York'], r.json()['zone_ids'])
+    self.assertEquals([[1420070400 - 18000], [1435708800 - 14400]],
+                      r.json()['local'])
+
+  def testRejectsUnknownZones(self):
+    self.basic_user()
+    r = client.create('timezones', dict(city='Nowhere', name='NOW',
+                                        gmt_delta_seconds=0,
+                                        zone_id='Nowhere/Land'))
+    self.assertValidationError(r)
+    self.assertEquals(['zone_id'], r.json()['details']['fields'].keys())
+
+  def testListsZones(self):
+    zones = client.list('zones').json()
+    self.assertIn('America/New_York', zones)
+    self.assertEquals(sorted(zones), zones)
+
+  def testRejectsInvalidRequests(self):
+    self.basic_user()
+    convert = lambda msg: client.create('timezones/convert', msg)
+    self.assertValidationError(convert(dict(instants=[])))
+    self.assertValidationError(convert(dict(instants=[1, 'a'])))
+    self.assertValidationError(convert(dict(instants=[1.5])))
+    self.assertValidationError(convert(dict(instants=[[1]])))
+    self.assertValidationError(convert(dict(instants=[2 ** 63])))
+    self.assertValidationError(convert(dict(instants=[2 ** 53])))
+    self.assertValidationError(convert(dict(instants=[0] * 100001)))
+    self.assertValidationError(convert(dict(instants=[0], ids=['1'])))
+    self.assertNotFound(convert(dict(instants=[0], ids=[1])))
+    client.logout()
+    self.assertUnauthorized(convert(dict(instants=[0])))
+
+
+class TestTimezonesOverlap(Base):
+  def testFindsCommonWorkingHours(self):
+    self.basic_user()
+    # Buenos Aires (UTC-3) and Madrid, which is UTC+2 in summer
+    ba = client.create('timezones', dict(city='Buenos Aires', name='ART',
+                                         gmt_delta_seconds=-10800)).json()
+    madrid = client.create('timezones', dict(
+      city='Madrid', name='CET', gmt_delta_seconds=3600,
+      zone_id='Europe/Madrid')).json()
+    # monday 2015-07-06 to wednesday 2015-07-08, 00:00 UTC
+    request = dict(start=1436140800, end=1436313600, work_start=9 * 3600,
+                   work_end=18 * 3600)
+    r = client.create('timezones/overlap', request)
+    self.assertOk(r)
+    self.assertEquals([ba['id'], madrid['id']], r.json()['ids'])
+    # 12:00 to 16:00 UTC, each day
+    self.assertEquals([[1436184000, 1436198400], [1436270400, 1436284800]],
+                      r.json()['intervals'])
+    # in winter Madrid is at UTC+1, one more hour
+    r = client.create('timezones/overlap', dict(
+      request, start=1420070400, end=1420156800, ids=[madrid['id'], ba['id']]))
+    self.assertEquals([[1420113600, 1420131600]], r.json()['intervals'])
+    r = client.create('timezones/overlap', dict(request, weekdays=[5, 6]))
+    self.assertEquals([], r.json()['intervals'])
+
+  def testRejectsInvalidRequests(self):
+    self.basic_user()
+    overlap = lambda **msg: client.create('timezones/overlap', dict(
+      dict(start=0, end=86400, work_start=0, work_end=3600), **msg))
+    self.assertOk(overlap())
+    self.assertValidationError(overlap(end=0))
+    self.assertValidationError(overlap(end=400 * 86400))
+    self.assertValidationError(overlap(work_end=0))
+    self.assertValidationError(overlap(work_start=7200))
+    self.assertValidationError(overlap(work_end=86401))
+    self.assertValidationError(overlap(weekdays=[7]))
+    self.assertValidationError(overlap(ids=[]))
+    self.assertNotFound(overlap(ids=[1]))
+
+
+class TestTimezonesConditionalGet(Base):
+  def testListNotModifiedUntilAWrite(self):
+    self.basic_user()
+    base = dict(city='Rosario', name="ART", gmt_delta_seconds=-1440)
+    first = client.list('timezones')
+    etag = first.headers['ETag']
+    self.assertTrue(etag.startswith('W/'))
+    same = client.list('timezones', headers={'If-None-Match': etag})
+    self.assertNotModified(same)
+    self.assertEquals(etag, same.headers['ETag'])
+    timezone_id = client.create('timezones', base).json()['id']
+    changed = client.list('timezones', headers={'If-None-Match': etag})
+    self.assertOk(changed)
+    self.assertNotEquals(etag, changed.headers['ETag'])
+    etag = changed.headers['ETag']
+    self.assertNotModified(client.get('timezones', timezone_id,
+                                      headers={'If-None-Match': etag}))
+    self.assertOk(client.delete('timezones', timezone_id))
+    self.assertOk(client.list('timezones', headers={'If-None-Match': etag}))
+
+  def testEtagsAreNotSharedBetweenUsers(self):
+    self.basic_user()
+    etag = client.list('timezones').headers['ETag']
+    self.assertOk(client.create('users', dict(login='test2', password='pass2')))
+    self.assertTrue(client.login('test2', 'pass2'))
+    self.assertOk(client.list('timezones', headers={'If-None-Match': etag}))
+
 
 class TestTimezoneOwnership(Base):
   def _user2(self):
@@ -222,3 +614,30 @@ class TestTimezoneOwnership(Base):
     self.assertNotFound(client.get('timezones', id2))
     self.assertNotFound(client.update('timezones', id2, dict()))
     self.assertNotFound(client.delete('timezones', id2))
+
+
+class TestMetricsEndpoint(Base):
+  def testExportsPerEndpointMetrics(self):
+    self.basic_user()
+    self.assertOk(client.list('timezones'))
+    self.assertNotFound(client.list('nowhere'))
+    r = client.list('metrics')
+    self.assertOk(r)
+    self.assertTrue(r.headers['content-type'].startswith('text/plain'))
+    lines = r.text.splitlines()
+    self.assertIn('http_requests_total{endpoint="/timezones/list",'
+                  'status="200"} 1', lines)
+    self.assertIn('http_requests_total{endpoint="unmatched",'
+                  'status="404"} 1', lines)
+    self.assertIn('http_request_duration_seconds_count{'
+                  'endpoint="/users/create"} 1', lines)
+    self.assertIn('token_cache_misses_total 1', lines)
+
+
+class TestQueryStatsHeaders(Base):
+  def testDebugResponsesCarryQueryTotals(self):
+    self.basic_user()
+    r = client.list('timezones')
+    self.assertOk(r)
+    self.assertGreater(int(r.headers['X-Query-Count']), 0)
+    self.assertIn('X-Query-Time', r.headers)
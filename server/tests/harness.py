@@ -0,0 +1,72 @@
+import itertools
+import os
+import shutil
+import tempfile
+from db import DbCreator
+import rest_server
+import wiring
+
+
+# A database created once, then copied for every test: restoring the image
+# is a file copy instead of running the DDL again.
+class TemplateDb(object):
+  def __init__(self):
+    self.folder = tempfile.mkdtemp(prefix='timezones-tests-')
+    self.path = os.path.join(self.folder, 'template.sqlite')
+    self.copies = itertools.count()
+    graph = wiring.web_graph(wiring.TestConfigModule(self.url(self.path)))
+    creator = graph.provide(DbCreator)
+    creator.create_db()
+    # checkpoints the WAL, the template is the main file alone
+    creator.engine.dispose()
+
+  @staticmethod
+  def url(path):
+    return 'sqlite:///' + path
+
+  def copy(self):
+    path = os.path.join(self.folder, 'test{}.sqlite'.format(next(self.copies)))
+    shutil.copyfile(self.path, path)
+    return path
+
+  @staticmethod
+  def remove(path):
+    for suffix in ('', '-wal', '-shm'):
+      if os.path.exists(path + suffix):
+        os.remove(path + suffix)
+
+  def close(self):
+    shutil.rmtree(self.folder, ignore_errors=True)
+
+
+# Serves the app straight from the test process. reset() gives the next
+# test a new object graph (fresh caches and metrics) over a fresh copy of
+# the template database.
+class InProcessServer(object):
+  def __init__(self):
+    self.template = TemplateDb()
+    self.app = None
+    self.engine = None
+    self.path = None
+    self.reset()
+
+  def reset(self):
+    self._release()
+    self.path = self.template.copy()
+    graph = wiring.web_graph(
+      wiring.TestConfigModule(self.template.url(self.path)))
+    self.engine = graph.provide(DbCreator).engine
+    self.app = graph.provide(rest_server.App).wsgi
+
+  def __call__(self, environ, start_response):
+    return self.app(environ, start_response)
+
+  def _release(self):
+    if self.engine is not None:
+      self.engine.dispose()
+      self.template.remove(self.path)
+      self.engine = None
+
+  def shutdown(self):
+    self._release()
+    self.template.close()
@@ -0,0 +1,69 @@
+import datetime
+import time
+import unittest
+from auth import TokenAuthentication, TokenCache
+from metrics import Metrics
+
+
+class TestTokenCache(unittest.TestCase):
+  def claim(self, ttl=60):
+    return dict(user=dict(id=1), exp=int(time.time()) + ttl)
+
+  def testHitAfterPut(self):
+    cache = TokenCache(10, Metrics())
+    self.assertIsNone(cache.get('a'))
+    claim = self.claim()
+    cache.put('a', claim)
+    self.assertEquals(claim, cache.get('a'))
+    self.assertEquals(1, cache.hits)
+    self.assertEquals(1, cache.misses)
+
+  def testExpiredEntryIsAMiss(self):
+    cache = TokenCache(10, Metrics())
+    cache.put('a', self.claim(ttl=-1))
+    self.assertIsNone(cache.get('a'))
+
+  def testClaimWithoutExpirationIsNotCached(self):
+    cache = TokenCache(10, Metrics())
+    cache.put('a', dict(user=dict(id=1)))
+    self.assertIsNone(cache.get('a'))
+
+  def testEvictsLeastRecentlyUsed(self):
+    cache = TokenCache(2, Metrics())
+    cache.put('a', self.claim())
+    cache.put('b', self.claim())
+    cache.get('a')
+    cache.put('c', self.claim())
+    self.assertIsNotNone(cache.get('a'))
+    self.assertIsNone(cache.get('b'))
+    self.assertIsNotNone(cache.get('c'))
+
+
+class FakeRequest(object):
+  def __init__(self, token):
+    self.headers = dict(JWT=token)
+
+
+class TestTokenRefresh(unittest.TestCase):
+  def setUp(self):
+    self.auth = TokenAuthentication(
+      'secret', None, datetime.timedelta(hours=1), TokenCache(0, Metrics()),
+      datetime.timedelta(days=1))
+    self.user = type('User', (), dict(id=1, login='test1', name=None,
+                                      token_epoch=5))
+
+  def claim(self, auth_time=None):
+    token = self.auth.generate_token(self.user, auth_time)
+    return self.auth.get_refreshable_claim(FakeRequest(token))
+
+  def testClaimsCarryTheSession(self):
+    claim = self.claim()
+    self.assertEquals(5, claim['epoch'])
+    self.assertAlmostEquals(time.time(), claim['auth_time'], delta=5)
+    self.assertEquals(1, TokenAuthentication.claim_user_id(claim))
+
+  def testOldSessionsAreNotRefreshed(self):
+    day = 24 * 60 * 60
+    self.assertIsNotNone(self.claim(int(time.time()) - day + 60))
+    self.assertIsNone(self.claim(int(time.time()) - day - 60))
+    self.assertIsNone(self.auth.get_refreshable_claim(FakeRequest('bogus')))
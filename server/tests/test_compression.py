@@ -0,0 +1,78 @@
+import unittest
+import zlib
+from werkzeug.test import EnvironBuilder
+from werkzeug.wrappers import Request, Response
+from compression import CompressionMiddleware
+from metrics import Metrics
+
+BODY = '{"items": [' + ', '.join(['{"city": "Rosario"}'] * 200) + ']}'
+
+
+def gunzip(data):
+  return zlib.decompress(data, 16 + zlib.MAX_WBITS)
+
+
+class TestCompressionMiddleware(unittest.TestCase):
+  def setUp(self):
+    self.metrics = Metrics()
+    self.middleware = CompressionMiddleware(6, 1024, self.metrics)
+
+  def call(self, response, accept='gzip, deflate', method='GET'):
+    request = Request(EnvironBuilder(
+      method=method, headers={'Accept-Encoding': accept}).get_environ())
+    return self.middleware(request, Response(), lambda r, _: response)
+
+  def testCompressesLargeBodies(self):
+    response = self.call(Response(BODY, content_type='application/json'))
+    self.assertEquals('gzip', response.headers['Content-Encoding'])
+    self.assertEquals('Accept-Encoding', response.headers['Vary'])
+    self.assertEquals(BODY, gunzip(response.get_data()))
+    self.assertEquals(str(len(response.get_data())),
+                      response.headers['Content-Length'])
+    self.assertTrue(0 < self.middleware.ratio() < 0.1)
+
+  def testNegotiatesTheEncoding(self):
+    json = lambda: Response(BODY, content_type='application/json')
+    response = self.call(json(), 'gzip;q=0, deflate')
+    self.assertEquals('deflate', response.headers['Content-Encoding'])
+    self.assertEquals(BODY, zlib.decompress(response.get_data()))
+    response = self.call(json(), 'identity')
+    self.assertNotIn('Content-Encoding', response.headers)
+    self.assertEquals('Accept-Encoding', response.headers['Vary'])
+
+  def testLeavesSomeResponsesAlone(self):
+    small = self.call(Response('{}', content_type='application/json'))
+    self.assertEquals('{}', small.get_data())
+    image = self.call(Response(BODY, content_type='image/png'))
+    self.assertNotIn('Content-Encoding', image.headers)
+    head = self.call(Response(BODY, content_type='text/css'), method='HEAD')
+    self.assertNotIn('Content-Encoding', head.headers)
+    off = CompressionMiddleware(0, 1024, Metrics())
+    self.assertFalse(off.enabled)
+
+  def testStreamedBodies(self):
+    closed = []
+
+    def body():
+      try:
+        for _ in xrange(100):
+          yield BODY
+      finally:
+        closed.append(True)
+
+    response = self.call(Response(body(), content_type='application/json'))
+    self.assertTrue(response.is_streamed)
+    self.assertNotIn('Content-Length', response.headers)
+    self.assertEquals(BODY * 100, gunzip(''.join(response.response)))
+    response.close()
+    self.assertEquals([True], closed)
+    small = self.call(Response(iter(['{', '}']),
+                               content_type='application/json'))
+    self.assertFalse(small.is_streamed)
+    self.assertEquals('{}', small.get_data())
+
+  def testWeakensStrongEtags(self):
+    response = Response(BODY, content_type='text/css')
+    response.set_etag('abc')
+    self.assertEquals(('abc', True), self.call(response).get_etag())
+
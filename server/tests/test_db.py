@@ -0,0 +1,76 @@
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from werkzeug.wrappers import Request, Response
+import db
+from metrics import Metrics
+from request_scope import RequestScopeMiddleware
+
+
+class TestDbModule(unittest.TestCase):
+  def setUp(self):
+    self.folder = tempfile.mkdtemp()
+    self.metrics = Metrics()
+
+  def tearDown(self):
+    shutil.rmtree(self.folder)
+
+  def engine(self, url, pool_size=5, max_overflow=10):
+    return db.DbModule().provide_db_engine(url, False, pool_size, max_overflow,
+                                           3600, 30, 1234, self.metrics)
+
+  def testTunesSqliteFiles(self):
+    engine = self.engine('sqlite:///' + os.path.join(self.folder, 'db.sqlite'))
+    with engine.connect() as connection:
+      pragma = lambda name: connection.execute('PRAGMA ' + name).scalar()
+      self.assertEquals('wal', pragma('journal_mode'))
+      self.assertEquals(1, pragma('synchronous'))
+      self.assertEquals(1234, pragma('busy_timeout'))
+    engine.dispose()
+
+  def testMemoryDatabasesKeepOneConnectionPerThread(self):
+    engine = self.engine('sqlite://')
+    self.assertNotIsInstance(engine.pool, db.TimedQueuePool)
+    with engine.connect() as connection:
+      self.assertEquals('memory',
+                        connection.execute('PRAGMA journal_mode').scalar())
+
+  def testReportsCheckoutWait(self):
+    engine = self.engine('sqlite:///' + os.path.join(self.folder, 'db.sqlite'),
+                         pool_size=1, max_overflow=0)
+    wait = self.metrics.registry['db_pool_checkout_wait_seconds']
+    in_use = self.metrics.registry['db_pool_checked_out']
+    held = engine.connect()
+    self.assertEquals(1, in_use.value)
+    waiter = threading.Thread(target=lambda: engine.connect().close())
+    waiter.start()
+    threading.Timer(0.1, held.close).start()
+    waiter.join()
+    self.assertEquals(2, wait.count)
+    self.assertGreaterEqual(wait.sum, 0.05)
+    engine.dispose()
+    engine.connect().close()
+    self.assertEquals(3, wait.count)
+
+
+class TestRequestSession(unittest.TestCase):
+  def testSessionIsClosedOnTeardown(self):
+    middleware = RequestScopeMiddleware()
+    closed = []
+
+    class Session(object):
+      def close(self):
+        closed.append(self)
+
+    current_db_session = db.DbModule().provide_current_db_session(
+      middleware.plan, Session, middleware.add_teardown)
+
+    def app(request, response):
+      raise ValueError(current_db_session())
+
+    request = Request.from_values()
+    self.assertRaises(ValueError, middleware, request, Response(), app)
+    self.assertEquals(1, len(closed))
+    self.assertFalse(hasattr(middleware.local, 'teardown'))
@@ -0,0 +1,30 @@
+import unittest
+import passlib.hash
+from werkzeug.exceptions import ServiceUnavailable
+from hashing import PasswordHasher
+from metrics import Metrics
+
+
+class TestPasswordHasher(unittest.TestCase):
+  def hasher(self, workers, queue_size=4):
+    return PasswordHasher(passlib.hash.sha256_crypt, Metrics(), workers,
+                          queue_size, 5)
+
+  def testInline(self):
+    hasher = self.hasher(0)
+    hashed = hasher.encrypt('secret')
+    self.assertTrue(hasher.verify('secret', hashed))
+    self.assertFalse(hasher.verify('other', hashed))
+    self.assertEquals(3, hasher.latency.count)
+
+  def testProcessPool(self):
+    hasher = self.hasher(1)
+    hashed = hasher.encrypt('secret')
+    self.assertTrue(hasher.verify('secret', hashed))
+    self.assertEquals(0, hasher.pending)
+    hasher.pool.terminate()
+
+  def testFullQueueIsUnavailable(self):
+    hasher = self.hasher(1, queue_size=0)
+    self.assertRaises(ServiceUnavailable, hasher.encrypt, 'secret')
+    self.assertEquals(1, hasher.rejected.value)
@@ -0,0 +1,121 @@
+import threading
+import unittest
+from werkzeug.wrappers import Request, Response
+from metrics import Metrics, MetricsMiddleware
+
+
+class TestMetrics(unittest.TestCase):
+  def testRender(self):
+    metrics = Metrics()
+    metrics.counter('hits_total', 'Hits').inc(3)
+    metrics.gauge('depth', 'Depth', lambda: 2)
+    histogram = metrics.histogram('latency_seconds', 'Latency', (0.1, 1))
+    histogram.observe(0.05)
+    histogram.observe(0.5)
+    histogram.observe(5)
+    self.assertEquals('\n'.join([
+      '# HELP hits_total Hits',
+      '# TYPE hits_total counter',
+      'hits_total 3',
+      '# HELP depth Depth',
+      '# TYPE depth gauge',
+      'depth 2',
+      '# HELP latency_seconds Latency',
+      '# TYPE latency_seconds histogram',
+      'latency_seconds_bucket{le="0.1"} 1',
+      'latency_seconds_bucket{le="1"} 2',
+      'latency_seconds_bucket{le="+Inf"} 3',
+      'latency_seconds_sum 5.55',
+      'latency_seconds_count 3',
+    ]) + '\n', metrics.render())
+
+  def testSameNameReturnsTheSameMetric(self):
+    metrics = Metrics()
+    self.assertIs(metrics.counter('a', 'A'), metrics.counter('a', 'A'))
+    self.assertRaises(ValueError, metrics.gauge, 'a', 'A')
+
+  def testLabelsAreEscaped(self):
+    metrics = Metrics()
+    requests = metrics.counter('requests_total', 'Requests',
+                               ('endpoint', 'status'))
+    requests.inc(2, ('/a', '200'))
+    requests.inc(1, ('say "hi"\n', '404'))
+    metrics.histogram('size', 'Size', (10,), ('endpoint',)).observe(
+      3, ('/a',))
+    self.assertEquals('\n'.join([
+      '# HELP requests_total Requests',
+      '# TYPE requests_total counter',
+      'requests_total{endpoint="/a",status="200"} 2',
+      'requests_total{endpoint="say \\"hi\\"\\n",status="404"} 1',
+      '# HELP size Size',
+      '# TYPE size histogram',
+      'size_bucket{endpoint="/a",le="10"} 1',
+      'size_bucket{endpoint="/a",le="+Inf"} 1',
+      'size_sum{endpoint="/a"} 3',
+      'size_count{endpoint="/a"} 1',
+    ]) + '\n', metrics.render())
+
+  def testMergesThreadShards(self):
+    metrics = Metrics()
+    counter = metrics.counter('hits_total', 'Hits')
+    histogram = metrics.histogram('latency_seconds', 'Latency', (1,))
+    in_flight = metrics.gauge('in_flight', 'In flight')
+
+    def record():
+      for _ in xrange(1000):
+        counter.inc()
+        histogram.observe(2)
+        in_flight.inc()
+      in_flight.dec(1000)
+
+    threads = [threading.Thread(target=record) for _ in xrange(4)]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+    self.assertEquals(4, len(counter.shards))
+    self.assertEquals(4000, counter.value)
+    self.assertEquals([0, 4000], histogram.counts)
+    self.assertEquals(8000, histogram.sum)
+    self.assertEquals(0, in_flight.value)
+
+
+class TestMetricsMiddleware(unittest.TestCase):
+  def setUp(self):
+    self.metrics = Metrics()
+    self.middleware = MetricsMiddleware(self.metrics)
+
+  def serve(self, app, endpoint='/things/get'):
+    request = Request.from_values('/', data='12345')
+    if endpoint is not None:
+      request.environ[MetricsMiddleware.ENDPOINT_KEY] = endpoint
+    return self.middleware(request, Response(), app)
+
+  def value(self, name):
+    return self.metrics.registry[name].samples()
+
+  def testRecordsRequests(self):
+    self.serve(lambda request, response: Response('hello', status=201))
+    self.assertRaises(ZeroDivisionError, self.serve,
+                      lambda request, response: 1 / 0)
+    self.assertEquals({('/things/get', '201'): [1],
+                       ('/things/get', '500'): [1]},
+                      self.value('http_requests_total'))
+    self.assertEquals({('/things/get',): [10]},
+                      self.value('http_request_bytes_total'))
+    self.assertEquals({('/things/get',): [5]},
+                      self.value('http_response_bytes_total'))
+    self.assertEquals(2, self.metrics.registry[
+      'http_request_duration_seconds'].count)
+    self.assertEquals(0, self.metrics.registry['http_requests_in_flight'].value)
+
+  def testStreamedResponsesAreRecordedOnClose(self):
+    response = self.serve(
+      lambda request, response: Response(iter(['ab', 'cde'])), None)
+    in_flight = self.metrics.registry['http_requests_in_flight']
+    self.assertEquals(1, in_flight.value)
+    self.assertEquals('abcde', ''.join(response.response))
+    response.close()
+    self.assertEquals(0, in_flight.value)
+    self.assertEquals({('unmatched',): [5]},
+                      self.value('http_response_bytes_total'))
@@ -0,0 +1,47 @@
+import os
+import shutil
+import tempfile
+import unittest
+import sqlalchemy
+import models
+
+
+class TestUpgrade(unittest.TestCase):
+  def setUp(self):
+    self.folder = tempfile.mkdtemp()
+    self.engine = sqlalchemy.create_engine(
+      'sqlite:///' + os.path.join(self.folder, 'db.sqlite'))
+
+  def tearDown(self):
+    self.engine.dispose()
+    shutil.rmtree(self.folder)
+
+  def testAddsMissingIndexes(self):
+    self.engine.execute('CREATE TABLE users (id INTEGER PRIMARY KEY, '
+                        'login VARCHAR(50) NOT NULL UNIQUE, name VARCHAR(50), '
+                        'password VARCHAR(100) NOT NULL)')
+    self.engine.execute('CREATE TABLE timezones (id INTEGER PRIMARY KEY, '
+                        'user_id INTEGER REFERENCES users (id), '
+                        'gmt_delta_seconds INTEGER, city VARCHAR(50), '
+                        'name VARCHAR(50))')
+    models.Base.metadata.create_all(self.engine)
+    models.upgrade(self.engine)
+    models.upgrade(self.engine)
+    indexes = sqlalchemy.inspect(self.engine).get_indexes('timezones')
+    self.assertIn('ix_timezones_user_id_id', [i['name'] for i in indexes])
+
+  def testAddsMissingColumns(self):
+    self.engine.execute('CREATE TABLE users (id INTEGER PRIMARY KEY, '
+                        'login VARCHAR(50) NOT NULL UNIQUE, name VARCHAR(50), '
+                        'password VARCHAR(100) NOT NULL)')
+    self.engine.execute("INSERT INTO users (login, password) "
+                        "VALUES ('old', 'secret')")
+    models.Base.metadata.create_all(self.engine)
+    models.upgrade(self.engine)
+    models.upgrade(self.engine)
+    version, = self.engine.execute(
+      'SELECT timezones_version FROM users').fetchone()
+    self.assertGreater(version, 0)
+    self.assertRaises(sqlalchemy.exc.IntegrityError, self.engine.execute,
+                      "INSERT INTO users (login, password, timezones_version) "
+                      "VALUES ('new', 'secret', NULL)")
@@ -0,0 +1,61 @@
+import unittest
+import numpy
+from overlap import DAY, common_intervals, working_intervals
+
+HOUR = 60 * 60
+
+
+def fixed(offset):
+  return lambda instants: numpy.full(len(instants), offset, numpy.int64)
+
+
+def intervals(starts, ends):
+  return zip(starts.tolist(), ends.tolist())
+
+
+class TestWorkingIntervals(unittest.TestCase):
+  def testFixedOffset(self):
+    # 9 to 17 at UTC-3, over the first two days of 1970
+    starts, ends = working_intervals(fixed(-3 * HOUR), 0, 2 * DAY, 9 * HOUR,
+                                     17 * HOUR)
+    self.assertIn((12 * HOUR, 20 * HOUR), intervals(starts, ends))
+    self.assertIn((DAY + 12 * HOUR, DAY + 20 * HOUR), intervals(starts, ends))
+
+  def testWeekdays(self):
+    # 1970-01-01 was a thursday, 1970-01-03 a saturday
+    starts, _ = working_intervals(fixed(0), 0, 7 * DAY, 0, HOUR, [5, 6])
+    self.assertEquals([2 * DAY, 3 * DAY], starts.tolist())
+
+  def testChangingOffset(self):
+    # an hour ahead from the second day on
+    offsets_at = lambda instants: numpy.where(instants >= DAY, HOUR, 0)
+    starts, ends = working_intervals(offsets_at, 0, 2 * DAY, 9 * HOUR,
+                                     17 * HOUR)
+    self.assertIn((9 * HOUR, 17 * HOUR), intervals(starts, ends))
+    self.assertIn((DAY + 8 * HOUR, DAY + 16 * HOUR), intervals(starts, ends))
+
+
+class TestCommonIntervals(unittest.TestCase):
+  def common(self, zones, start=0, end=100):
+    zones = [(numpy.array([s for s, _ in zone], numpy.int64),
+              numpy.array([e for _, e in zone], numpy.int64))
+             for zone in zones]
+    return intervals(*common_intervals(zones, start, end))
+
+  def testOverlaps(self):
+    self.assertEquals([(5, 10), (30, 35)],
+                      self.common([[(0, 10), (20, 35)], [(5, 15), (30, 40)]]))
+    self.assertEquals([(7, 8)], self.common([[(0, 10)], [(5, 15)], [(7, 8)]]))
+
+  def testTouchingIntervalsDontOverlap(self):
+    self.assertEquals([], self.common([[(0, 10)], [(10, 20)]]))
+
+  def testClipsToTheRange(self):
+    self.assertEquals([(5, 8)], self.common([[(0, 10)], [(2, 20)]], 5, 8))
+
+  def testJoinsIntervalsSplitWithinAZone(self):
+    self.assertEquals([(0, 20)], self.common([[(0, 10), (10, 20)],
+                                              [(0, 30)]]))
+
+  def testNoZones(self):
+    self.assertEquals([], self.common([]))
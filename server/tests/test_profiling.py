@@ -0,0 +1,50 @@
+import os
+import pstats
+import shutil
+import tempfile
+import unittest
+from werkzeug.wrappers import Request, Response
+from profiling import ProfilingMiddleware, profile_header, sign
+
+
+def handler(request, response):
+  sum(xrange(1000))
+  return response
+
+
+class TestProfilingMiddleware(unittest.TestCase):
+  def setUp(self):
+    self.folder = os.path.join(tempfile.mkdtemp(), 'profiles')
+
+  def tearDown(self):
+    shutil.rmtree(os.path.dirname(self.folder))
+
+  def serve(self, middleware, headers=()):
+    request = Request.from_values('/', headers=list(headers))
+    return middleware(request, Response(), handler)
+
+  def testOffByDefault(self):
+    self.assertFalse(ProfilingMiddleware('', 0, self.folder, 5).enabled)
+
+  def testSamplesAndRotates(self):
+    middleware = ProfilingMiddleware('', 2, self.folder, 3)
+    self.assertTrue(middleware.enabled)
+    profiled = [self.serve(middleware).headers.get('X-Profile-File')
+                for _ in xrange(10)]
+    self.assertEquals([False, True] * 5, [name is not None
+                                          for name in profiled])
+    kept = sorted(os.listdir(self.folder))
+    self.assertEquals(sorted(profiled[5::2]), kept)
+    stats = pstats.Stats(os.path.join(self.folder, kept[-1]))
+    self.assertIn('handler', [function for _, _, function in stats.stats])
+
+  def testSignedHeader(self):
+    middleware = ProfilingMiddleware('key', 0, self.folder, 3)
+    valid = profile_header('key', 60)
+    expired = '{0}:{1}'.format(1, sign('key', 1))
+    forged = profile_header('other', 60)
+    for value, profiled in [(valid, True), (expired, False),
+                            (forged, False), ('junk', False)]:
+      response = self.serve(middleware, [('X-Profile', value)])
+      self.assertEquals(profiled, 'X-Profile-File' in response.headers, value)
+    self.assertEquals(1, len(os.listdir(self.folder)))
@@ -0,0 +1,80 @@
+import logging
+import unittest
+import sqlalchemy
+from werkzeug.wrappers import Request, Response
+from metrics import Metrics, MetricsMiddleware
+from query_stats import QueryStatsMiddleware
+from request_scope import RequestScopeMiddleware
+import rest_server
+
+
+class Capture(logging.Handler):
+  def __init__(self):
+    logging.Handler.__init__(self)
+    self.messages = []
+
+  def emit(self, record):
+    self.messages.append(record.getMessage())
+
+
+class TestQueryStats(unittest.TestCase):
+  def setUp(self):
+    self.engine = sqlalchemy.create_engine('sqlite://')
+    self.metrics = Metrics()
+    self.scope = RequestScopeMiddleware()
+    self.stats = QueryStatsMiddleware(
+      self.engine, self.scope.plan, self.scope.request,
+      self.scope.add_teardown, self.metrics, 0.5, 3, True)
+    self.log = Capture()
+    logging.getLogger('query_stats').addHandler(self.log)
+
+  def tearDown(self):
+    logging.getLogger('query_stats').removeHandler(self.log)
+
+  def serve(self, handler):
+    app = rest_server.MiddlewareLink.build([self.scope, self.stats], handler)
+    request = Request.from_values('/')
+    request.environ[MetricsMiddleware.ENDPOINT_KEY] = '/things/list'
+    return app(request, Response())
+
+  def testCountsQueriesPerRequest(self):
+    def handler(request, response):
+      for i in xrange(2):
+        self.engine.execute('SELECT ?', i)
+      return response
+
+    response = self.serve(handler)
+    self.assertEquals('2', response.headers['X-Query-Count'])
+    self.assertGreaterEqual(float(response.headers['X-Query-Time']), 0)
+    self.assertEquals([], self.log.messages)
+    self.assertEquals({('/things/list',): 1},
+                      dict((labels, cell[-1]) for labels, cell in
+                           self.metrics.registry['db_queries_per_request']
+                           .samples().items()))
+    self.engine.execute('SELECT 1')
+    self.assertEquals(3, self.metrics.registry['db_statement_seconds'].count)
+
+  def testFlagsSelectsRepeatedPerRow(self):
+    self.engine.execute('CREATE TABLE t (x INTEGER)')
+
+    def handler(request, response):
+      for i in xrange(3):
+        self.engine.execute('INSERT INTO t VALUES (?)', i)
+      for x, in self.engine.execute('SELECT x FROM t').fetchall():
+        self.engine.execute('SELECT x FROM t WHERE x = ?', x)
+      return response
+
+    self.assertEquals('7', self.serve(handler).headers['X-Query-Count'])
+    self.assertEquals(1, len(self.log.messages))
+    self.assertIn('/things/list ran the same query 3 times',
+                  self.log.messages[0])
+    self.assertEquals(1, self.metrics.registry[
+      'db_repeated_query_requests_total'].value)
+
+  def testLogsSlowQueries(self):
+    self.stats.slow_query_seconds = 0
+    self.serve(lambda request, response:
+               self.engine.execute('SELECT 1') and response)
+    self.assertIn('slow query on /things/list', self.log.messages[0])
+    self.engine.execute('SELECT 2')
+    self.assertIn('slow query on no request', self.log.messages[1])
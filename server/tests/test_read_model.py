@@ -0,0 +1,73 @@
+import json
+import unittest
+import sqlalchemy
+from sqlalchemy.orm import sessionmaker
+import models
+from dto import TimezoneDto
+from metrics import Metrics
+from models import Timezone
+from read_model import TimezoneReadModel
+
+
+class TestTimezoneReadModel(unittest.TestCase):
+  def setUp(self):
+    self.engine = sqlalchemy.create_engine('sqlite://')
+    models.Base.metadata.create_all(self.engine)
+    self.session = sessionmaker(bind=self.engine)()
+
+  def read_model(self, max_bytes=1024 * 1024):
+    dto = TimezoneDto(1000, 1000, 1000, 366, None)
+    return TimezoneReadModel(max_bytes, dto, json.JSONEncoder(), Metrics())
+
+  def add(self, user_id, *cities):
+    for city in cities:
+      self.engine.execute(Timezone.__table__.insert(), user_id=user_id,
+                          city=city, name='TZ', gmt_delta_seconds=0)
+
+  def cities(self, entry, *args):
+    return [json.loads(f)['city'] for f in entry.page(*args)[0]]
+
+  def testLoadsOnceAVersion(self):
+    self.add(1, 'Rosario', 'Cordoba')
+    self.add(2, 'Salta')
+    read_model = self.read_model()
+    entry = read_model.lookup(self.session, 1, 10)
+    self.assertEquals(['Rosario', 'Cordoba'], self.cities(entry))
+    self.assertIs(entry, read_model.lookup(self.session, 1, 10))
+    self.assertEquals((1, 1), (read_model.hits, read_model.misses))
+    self.add(1, 'Mendoza')
+    self.assertEquals(['Rosario', 'Cordoba', 'Mendoza'],
+                      self.cities(read_model.lookup(self.session, 1, 11)))
+    self.assertEquals(2, read_model.misses)
+
+  def testPagesAndFragments(self):
+    self.add(1, 'Rosario', 'Cordoba', 'Mendoza')
+    entry = self.read_model().lookup(self.session, 1, 1)
+    self.assertEquals((['Rosario', 'Cordoba'], 2),
+                      (self.cities(entry, None, 2), entry.page(None, 2)[1]))
+    self.assertEquals((['Mendoza'], None),
+                      (self.cities(entry, 2, 2), entry.page(2, 2)[1]))
+    self.assertEquals('Cordoba', json.loads(entry.fragment(2))['city'])
+    self.assertIsNone(entry.fragment(4))
+
+  def testEvictsLeastRecentlyUsedByMemory(self):
+    for user_id in xrange(1, 4):
+      self.add(user_id, 'Rosario', 'Cordoba')
+    read_model = self.read_model()
+    size = read_model.load(self.session, 1, 1).size
+    read_model.max_bytes = size * 2
+    for user_id in xrange(1, 4):
+      read_model.lookup(self.session, user_id, 1)
+    self.assertEquals([2, 3], read_model.entries.keys())
+    self.assertEquals(size * 2, read_model.bytes)
+    read_model.invalidate(2)
+    self.assertEquals(size, read_model.bytes)
+
+  def testLargeUsersAreNotKept(self):
+    self.add(1, *['City {}'.format(i) for i in xrange(100)])
+    read_model = self.read_model(8 * 1024)
+    self.assertIsNone(read_model.lookup(self.session, 1, 1))
+    self.assertLess(read_model.bytes, 1024)
+    self.assertIsNone(read_model.lookup(self.session, 1, 1))
+    self.assertEquals((0, 2), (read_model.hits, read_model.misses))
+    self.assertIsNone(self.read_model(0).lookup(self.session, 1, 1))
@@ -0,0 +1,49 @@
+import unittest
+from werkzeug.wrappers import Request, Response
+from request_scope import RequestScopeMiddleware
+
+
+class Service(object):
+  def __init__(self, current_request):
+    self.current_request = current_request
+
+  def get(self, args, request):
+    return self.current_request()
+
+
+class TestRequestPlan(unittest.TestCase):
+  def setUp(self):
+    self.middleware = RequestScopeMiddleware()
+    self.built = []
+    self.value = self.middleware.plan.add('value', self.build)
+
+  def build(self):
+    self.built.append(1)
+    return len(self.built)
+
+  def serve(self, app):
+    return self.middleware(Request.from_values(), Response(), app)
+
+  def testValuesAreBuiltLazilyOncePerRequest(self):
+    self.serve(lambda request, response: None)
+    self.assertEquals([], self.built)
+    seen = []
+    for _ in xrange(2):
+      self.serve(lambda request, response: seen.extend(
+        [self.value(), self.value()]))
+    self.assertEquals([1, 1, 2, 2], seen)
+
+  def testRequestIsPreset(self):
+    served = self.serve(
+      lambda request, response: self.middleware.request() is request)
+    self.assertTrue(served)
+    self.assertRaises(AttributeError, self.middleware.request)
+
+  def testCompileChecksHandlersUseThisPlan(self):
+    plan = self.middleware.plan
+    plan.compile({'/get': Service(self.middleware.request).get,
+                  '/other': Service(None).get})
+    self.assertRaises(ValueError, plan.add, 'value', self.build)
+    foreign = RequestScopeMiddleware().request
+    self.assertRaises(ValueError, plan.compile,
+                      {'/get': Service(foreign).get})
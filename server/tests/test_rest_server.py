@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+import json
+import unittest
+from werkzeug.exceptions import HTTPException
+from werkzeug.routing import Rule
+from werkzeug.test import Client
+from werkzeug.wrappers import Request, Response
+from request_scope import RequestScopeMiddleware
+from rest_server import DumpsEncoder, MiddlewareLink, RestRouter, RestRules
+
+
+class TestStreaming(unittest.TestCase):
+  def router(self, encoder=json.JSONEncoder()):
+    router = RestRouter(encoder)
+    router.STREAM_CHUNK_SIZE = 16
+    return router
+
+  def testEncodesIteratorsAsArrays(self):
+    router = self.router()
+    for count in (0, 1, 2, 50):
+      items = [dict(id=i, name=u'z\xfc') for i in xrange(count)]
+      chunks = list(router.iter_json(iter(items)))
+      self.assertEquals(items, json.loads(''.join(chunks)))
+    self.assertGreater(len(chunks), 10)
+
+  def testEncodesLazily(self):
+    produced = []
+
+    def items():
+      for i in xrange(100):
+        produced.append(i)
+        yield dict(id=i)
+
+    chunks = self.router().iter_json(items())
+    chunks.next()
+    self.assertLess(len(produced), 10)
+
+  def testAcceptsDumpsFunctions(self):
+    router = self.router(DumpsEncoder(json.dumps))
+    self.assertEquals([1, [2]], json.loads(''.join(
+      router.iter_json(iter([1, [2]])))))
+
+  def testRequestScopeOutlivesTheStream(self):
+    middleware = RequestScopeMiddleware()
+    events = []
+
+    def handler(args, request):
+      middleware.add_teardown(lambda: events.append('teardown'))
+      for i in xrange(3):
+        events.append(i)
+        yield i
+
+    router = self.router()
+    router.add_rule(Rule('/items', endpoint='items'), handler)
+    app = MiddlewareLink.build([middleware], router)
+
+    def wsgi(environ, start_response):
+      return app(Request(environ), Response())(environ, start_response)
+
+    body, status, headers = Client(wsgi).get('/items')
+    self.assertEquals([], events)
+    self.assertEquals([0, 1, 2], json.loads(''.join(body)))
+    body.close()
+    self.assertEquals([0, 1, 2, 'teardown'], events)
+    self.assertFalse(hasattr(middleware.local, 'store'))
+
+
+class Service(object):
+  def get(self, args, request):
+    pass
+
+  def list(self, args, request):
+    pass
+
+  def update(self, args, request):
+    pass
+
+  def batch(self, args, request):
+    pass
+
+
+class TestDispatch(unittest.TestCase):
+  METHODS = ['GET', 'HEAD', 'POST', 'PUT', 'DELETE', 'PATCH', 'OPTIONS']
+  PATHS = ['/timezones', '/timezones/', '/timezones/12', '/timezones/007',
+           '/timezones/-1', '/timezones/1.5', '/timezones/batch',
+           '/timezones/12/', '/timezones/12/x', '/auth', '/auth/1', '/',
+           '/nope', '//timezones', '/timezones//3', u'/timezones/\u0661',
+           u'/timezones/\xb2', '/timezones/%31',
+           '/timezones/99999999999999999999']
+
+  def setUp(self):
+    self.router = RestRouter(json.JSONEncoder())
+    self.router.add_rule(RestRules('/auth').create, lambda args, request: 0)
+    self.router.add_resource(Service(), '/timezones')
+
+  @staticmethod
+  def outcome(match, request):
+    try:
+      return match(request)
+    except HTTPException, e:
+      return e.code, sorted(getattr(e, 'valid_methods', None) or [])
+
+  def testMatchesLikeWerkzeug(self):
+    for method in self.METHODS:
+      for path in self.PATHS:
+        request = Request.from_values(path, method=method)
+        self.assertEquals(
+          self.outcome(lambda r: self.router.map.bind_to_environ(
+            r.environ).match(), request),
+          self.outcome(self.router.match, request), (method, path))
+
+  def testCompilesResourceRules(self):
+    self.assertEquals('/timezones/list',
+                      self.router.static_routes[('HEAD', '/timezones')])
+    self.assertEquals(('/timezones/update', 'id'),
+                      self.router.id_routes[('PUT', '/timezones')])
+    self.assertEquals('/timezones/batch',
+                      self.router.static_routes[('POST', '/timezones/batch')])
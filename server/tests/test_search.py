@@ -0,0 +1,41 @@
+import unittest
+import sqlalchemy
+from sqlalchemy.orm import sessionmaker
+import models
+import search
+from models import Timezone
+
+
+class TestTimezoneSearch(unittest.TestCase):
+  def setUp(self):
+    self.engine = sqlalchemy.create_engine('sqlite://')
+    models.Base.metadata.create_all(self.engine)
+
+  def matches(self, user_id, text):
+    session = sessionmaker(bind=self.engine)()
+    timezones = session.query(Timezone).filter(Timezone.user_id == user_id)
+    found = search.TimezoneSearch(self.engine).filter(timezones, user_id, text)
+    return sorted(t.city for t in found)
+
+  def add(self, user_id, city):
+    self.engine.execute(Timezone.__table__.insert(), user_id=user_id,
+                        city=city, name='TZ', gmt_delta_seconds=0)
+
+  def testMatchesAreRestrictedToTheUser(self):
+    self.assertTrue(search.create_index(self.engine))
+    self.add(1, 'Rosario')
+    self.add(2, 'Rosarito')
+    self.add(1, 'Cordoba')
+    self.assertEquals(['Rosario'], self.matches(1, 'rosa'))
+    self.assertEquals(['Rosarito'], self.matches(2, 'rosa'))
+
+  def testRebuildsAnIndexWithoutUserId(self):
+    self.add(1, 'Rosario')
+    self.engine.execute(
+      "CREATE VIRTUAL TABLE timezones_fts USING fts5(city, name, "
+      "content='timezones', content_rowid='id', tokenize='trigram')")
+    self.assertFalse(search.TimezoneSearch(self.engine).available)
+    self.assertTrue(search.create_index(self.engine))
+    self.assertTrue(search.TimezoneSearch(self.engine).available)
+    self.add(2, 'Rosarito')
+    self.assertEquals(['Rosario'], self.matches(1, 'rosa'))
@@ -0,0 +1,142 @@
+import os
+import signal
+import threading
+import time
+import unittest
+import requests
+from werkzeug.wrappers import Request, Response
+from request_scope import RequestScopeMiddleware
+from serving import ThreadPoolWSGIServer, PreforkServer
+
+
+def serve_in_thread(server):
+  server.start_threads()
+  thread = threading.Thread(target=server.serve_forever)
+  thread.daemon = True
+  thread.start()
+  return 'http://localhost:{}'.format(server.server_address[1])
+
+
+def stop(server):
+  server.shutdown()
+  server.stop_threads()
+  server.server_close()
+
+
+class TestThreadPoolWSGIServer(unittest.TestCase):
+  def get_all(self, url, count):
+    responses = [None] * count
+
+    def get(i):
+      responses[i] = requests.get(url, params=dict(i=i))
+
+    clients = [threading.Thread(target=get, args=(i,)) for i in xrange(count)]
+    for client in clients:
+      client.start()
+    for client in clients:
+      client.join()
+    return responses
+
+  def testServesRequestsConcurrently(self):
+    barrier = threading.Semaphore(0)
+    arrived = []
+
+    def app(environ, start_response):
+      arrived.append(1)
+      if len(arrived) == 3:
+        barrier.release()
+      barrier.acquire()
+      barrier.release()
+      start_response('200 OK', [('content-type', 'text/plain')])
+      return [threading.current_thread().name]
+
+    server = ThreadPoolWSGIServer(('localhost', 0), 3)
+    server.set_app(app)
+    url = serve_in_thread(server)
+    try:
+      responses = self.get_all(url, 3)
+    finally:
+      stop(server)
+    self.assertEquals([200] * 3, [r.status_code for r in responses])
+    self.assertEquals(3, len(set(r.text for r in responses)))
+
+  def testNeedsAThread(self):
+    self.assertRaises(ValueError, ThreadPoolWSGIServer, ('localhost', 0), 0)
+
+  def testRequestScopeIsIsolatedAcrossPooledThreads(self):
+    middleware = RequestScopeMiddleware()
+    value = middleware.plan.add('value',
+                                lambda: middleware.request().args['i'])
+
+    def handler(request, response):
+      value()
+      time.sleep(0.05)
+      response.set_data(value())
+      return response
+
+    def app(environ, start_response):
+      request = Request(environ)
+      if request.args.get('fail'):
+        try:
+          middleware(request, Response(), lambda request, response: 1 / 0)
+        except ZeroDivisionError:
+          pass
+        leaked = hasattr(middleware.local, 'values')
+        return Response('leaked' if leaked else 'clean')(environ,
+                                                         start_response)
+      return middleware(request, Response(), handler)(environ, start_response)
+
+    server = ThreadPoolWSGIServer(('localhost', 0), 4)
+    server.set_app(app)
+    url = serve_in_thread(server)
+    try:
+      responses = self.get_all(url, 8)
+      failed = requests.get(url, params=dict(fail=1))
+    finally:
+      stop(server)
+    self.assertEquals([str(i) for i in xrange(8)], [r.text for r in responses])
+    self.assertEquals('clean', failed.text)
+
+
+class TestPreforkServer(unittest.TestCase):
+  def setUp(self):
+    self.handlers = [(signum, signal.getsignal(signum))
+                     for signum in (signal.SIGTERM, signal.SIGINT,
+                                    signal.SIGHUP)]
+
+  def tearDown(self):
+    for signum, handler in self.handlers:
+      signal.signal(signum, handler)
+
+  def testWorkersServeUntilStopped(self):
+    def app(environ, start_response):
+      start_response('200 OK', [('content-type', 'text/plain')])
+      return [str(os.getpid())]
+
+    server = ThreadPoolWSGIServer(('localhost', 0), 2)
+    server.set_app(app)
+    url = 'http://localhost:{}'.format(server.server_address[1])
+    pids = []
+
+    def client():
+      for _ in xrange(6):
+        pids.append(requests.get(url).text)
+      os.kill(os.getpid(), signal.SIGTERM)
+
+    threading.Thread(target=client).start()
+    PreforkServer(server, 2, lambda: None).run()
+    self.assertEquals(6, len(pids))
+    self.assertNotIn(str(os.getpid()), pids)
+
+  def testGivesUpWhenWorkersFailToStart(self):
+    def after_fork():
+      raise RuntimeError('no database')
+
+    server = ThreadPoolWSGIServer(('localhost', 0), 1)
+    prefork = PreforkServer(server, 2, after_fork)
+    prefork.backoff = 0.01
+    prefork.max_startup_failures = 3
+    start = time.time()
+    self.assertRaises(RuntimeError, prefork.run)
+    self.assertEquals(3, prefork.startup_failures)
+    self.assertLess(time.time() - start, 5)
@@ -0,0 +1,92 @@
+import os
+import shutil
+import tempfile
+import unittest
+import zlib
+from werkzeug.test import Client
+from werkzeug.wrappers import BaseResponse
+from metrics import Metrics
+from static_assets import IMMUTABLE, REVALIDATE, StaticAssets
+
+CSS = ('@font-face { src: url(../fonts/icons.woff?v=1) format("woff"), '
+       'url("../fonts/missing.ttf"), url(data:font/woff;base64,AAAA); }\n' +
+       'body { color: red; }\n' * 100 +
+       '/*# sourceMappingURL=site.css.map */')
+HTML = ('<script src="/client/app.js"></script>'
+        '<script src="//cdn.example.com/lib.js"></script>'
+        '<link rel="stylesheet" href="/client/css/site.css">')
+
+
+class TestStaticAssets(unittest.TestCase):
+  def setUp(self):
+    self.folder = tempfile.mkdtemp()
+    self.write('index.html', HTML)
+    self.write('app.js', 'angular.module("timezones", []);\n' * 100)
+    self.write('css/site.css', CSS)
+    self.write('css/site.css.map', '{}')
+    self.write('fonts/icons.woff', os.urandom(2048))
+    self.write('.hidden', 'secret')
+    self.assets = StaticAssets(self.folder, Metrics())
+    self.client = Client(self.assets, BaseResponse)
+
+  def tearDown(self):
+    shutil.rmtree(self.folder)
+
+  def write(self, path, data):
+    path = os.path.join(self.folder, path)
+    if not os.path.isdir(os.path.dirname(path)):
+      os.makedirs(os.path.dirname(path))
+    with open(path, 'wb') as out:
+      out.write(data)
+
+  def get(self, path, **headers):
+    return self.client.get(path, headers=headers, buffered=True)
+
+  def testRewritesReferencesToHashedUrls(self):
+    app_js = self.assets.url('/app.js')
+    self.assertRegexpMatches(app_js, r'^/client/app\.[0-9a-f]{12}\.js$')
+    css = self.assets.url('/css/site.css')
+    self.assertEquals(
+      '<script src="{}"></script>'
+      '<script src="//cdn.example.com/lib.js"></script>'
+      '<link rel="stylesheet" href="{}">'.format(app_js, css),
+      self.get('/index.html').data)
+    site = self.get(css[len('/client'):]).data
+    font = os.path.basename(self.assets.url('/fonts/icons.woff'))
+    self.assertIn('url(../fonts/{}?v=1)'.format(font), site)
+    self.assertIn('url("../fonts/missing.ttf")', site)
+    self.assertIn('url(data:font/woff;base64,AAAA)', site)
+    self.assertIn('sourceMappingURL=' +
+                  os.path.basename(self.assets.url('/css/site.css.map')),
+                  site)
+
+  def testCachesHashedUrlsForever(self):
+    hashed = self.get(self.assets.url('/app.js')[len('/client'):])
+    self.assertEquals(200, hashed.status_code)
+    self.assertEquals(IMMUTABLE, hashed.headers['Cache-Control'])
+    plain = self.get('/app.js')
+    self.assertEquals(REVALIDATE, plain.headers['Cache-Control'])
+    self.assertEquals(hashed.headers['ETag'], plain.headers['ETag'])
+    self.assertEquals(
+      304, self.get('/app.js', If_None_Match=plain.headers['ETag']).status_code)
+    self.assertEquals(404, self.get('/.hidden').status_code)
+    self.assertEquals(404, self.get('/missing.js').status_code)
+    self.assertEquals(405, self.client.post('/app.js').status_code)
+
+  def testServesPrecompressedVariants(self):
+    plain = self.get('/app.js')
+    gzipped = self.get('/app.js', Accept_Encoding='gzip')
+    self.assertEquals('gzip', gzipped.headers['Content-Encoding'])
+    self.assertEquals('Accept-Encoding', gzipped.headers['Vary'])
+    self.assertEquals(plain.data,
+                      zlib.decompress(gzipped.data, 16 + zlib.MAX_WBITS))
+    self.assertNotEquals(plain.headers['ETag'], gzipped.headers['ETag'])
+    self.assertNotIn('Content-Encoding',
+                     self.get('/app.js', Accept_Encoding='gzip;q=0').headers)
+    # random bytes don't compress
+    font = self.get('/fonts/icons.woff', Accept_Encoding='gzip')
+    self.assertNotIn('Content-Encoding', font.headers)
+    self.assertNotIn('Vary', font.headers)
+
+  def testNoFolderMeansNoAssets(self):
+    self.assertEquals(0, len(StaticAssets('', Metrics()).assets))
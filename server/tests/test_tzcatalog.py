@@ -0,0 +1,116 @@
+import calendar
+import os
+import shutil
+import tempfile
+import unittest
+import numpy
+from metrics import Metrics
+import tzcatalog
+from tzcatalog import TzCatalog, parse_posix_tz
+
+ZONEINFO = '/usr/share/zoneinfo'
+
+
+def utc(year, month=1, day=1, hour=0):
+  return calendar.timegm((year, month, day, hour, 0, 0))
+
+
+class TestPosixTz(unittest.TestCase):
+  def testParsesRules(self):
+    self.assertEquals((-10800, None), parse_posix_tz('<-03>3'))
+    self.assertEquals((19800, None), parse_posix_tz('IST-5:30'))
+    self.assertEquals(
+      (-18000, (-14400, ('M3.2.0', 7200), ('M11.1.0', 7200))),
+      parse_posix_tz('EST5EDT,M3.2.0,M11.1.0'))
+    self.assertEquals(
+      (37800, (39600, ('M10.1.0', 7200), ('M4.1.0', 7200))),
+      parse_posix_tz('<+1030>-10:30<+11>-11,M10.1.0,M4.1.0'))
+    self.assertEquals(
+      (7200, (10800, ('M3.4.4', 26 * 3600), ('M10.5.0', 7200))),
+      parse_posix_tz('IST-2IDT,M3.4.4/26,M10.5.0'))
+    self.assertEquals(None, parse_posix_tz('bogus'))
+
+  def testRuleDays(self):
+    day = lambda date, year: tzcatalog._rule_day(date, year) * 86400
+    # second sunday of march, first of november
+    self.assertEquals(utc(2015, 3, 8), day('M3.2.0', 2015))
+    self.assertEquals(utc(2015, 11, 1), day('M11.1.0', 2015))
+    # last sunday of october
+    self.assertEquals(utc(2015, 10, 25), day('M10.5.0', 2015))
+    # J counts days without february 29th, plain numbers count it from 0
+    self.assertEquals(utc(2016, 3, 1), day('J60', 2016))
+    self.assertEquals(utc(2016, 2, 29), day('59', 2016))
+
+
+@unittest.skipUnless(os.path.isdir(ZONEINFO), 'no system zoneinfo')
+class TestTzCatalog(unittest.TestCase):
+  def setUp(self):
+    self.folder = tempfile.mkdtemp()
+    self.zoneinfo = os.path.join(self.folder, 'zoneinfo')
+    os.makedirs(os.path.join(self.zoneinfo, 'America'))
+    for zone in ('America/New_York', 'Australia/Lord_Howe', 'Asia/Kolkata'):
+      target = os.path.join(self.zoneinfo, zone)
+      if not os.path.isdir(os.path.dirname(target)):
+        os.makedirs(os.path.dirname(target))
+      shutil.copy(os.path.join(ZONEINFO, zone), target)
+    os.symlink('New_York', os.path.join(self.zoneinfo, 'America', 'Eastern'))
+    self.set_version('2015a')
+    self.path = os.path.join(self.folder, 'catalog.bin')
+
+  def tearDown(self):
+    shutil.rmtree(self.folder)
+
+  def set_version(self, version):
+    with open(os.path.join(self.zoneinfo, 'tzdata.zi'), 'w') as out:
+      out.write('# version {}\n'.format(version))
+
+  def catalog(self):
+    return TzCatalog(self.zoneinfo, self.path, Metrics())
+
+  def testResolvesOffsets(self):
+    catalog = self.catalog()
+    self.assertEquals(['America/Eastern', 'America/New_York',
+                       'Asia/Kolkata', 'Australia/Lord_Howe'],
+                      catalog.zone_ids())
+    ny = 'America/New_York'
+    self.assertEquals(-18000, catalog.offset(ny, utc(2015, 1, 1)))
+    self.assertEquals(-14400, catalog.offset(ny, utc(2015, 7, 1)))
+    # 2am EST on the second sunday of march
+    self.assertEquals(-18000, catalog.offset(ny, utc(2015, 3, 8, 6) - 1))
+    self.assertEquals(-14400, catalog.offset(ny, utc(2015, 3, 8, 7)))
+    # before the first transition, local mean time
+    self.assertEquals(-17762, catalog.offset(ny, -2 ** 40))
+    # the POSIX rule, centuries after the last explicit transition
+    self.assertEquals(-14400, catalog.offset(ny, utc(2815, 7, 1)))
+    self.assertEquals(-18000, catalog.offset(ny, utc(2815, 12, 1)))
+    self.assertEquals(-14400, catalog.offset('America/Eastern',
+                                             utc(2015, 7, 1)))
+    self.assertEquals(19800, catalog.offset('Asia/Kolkata', utc(2515, 7, 1)))
+    # half an hour of daylight saving time, in the southern summer
+    howe = 'Australia/Lord_Howe'
+    self.assertEquals(39600, catalog.offset(howe, utc(2015, 1, 1)))
+    self.assertEquals(37800, catalog.offset(howe, utc(2015, 7, 1)))
+    self.assertEquals(39600, catalog.offset(howe, utc(2415, 1, 1)))
+
+  def testVectorLookupsMatchScalarOnes(self):
+    catalog = self.catalog()
+    instants = numpy.arange(utc(1900), utc(2900), 86400 * 7 + 3607,
+                            dtype=numpy.int64)
+    for zone in catalog.zone_ids():
+      self.assertEquals([catalog.offset(zone, i) for i in instants.tolist()],
+                        catalog.offsets_at(zone, instants).tolist())
+
+  def testCompilesOnceAndAgainWhenTzdataChanges(self):
+    self.catalog().load()
+    os.utime(self.path, (1000, 1000))
+    self.catalog().load()
+    self.assertEquals(1000, os.stat(self.path).st_mtime)
+    self.set_version('2015b')
+    self.catalog().load()
+    self.assertNotEquals(1000, os.stat(self.path).st_mtime)
+
+  def testMissingZoneinfoMeansNoZones(self):
+    catalog = TzCatalog(os.path.join(self.folder, 'missing'), self.path,
+                        Metrics())
+    self.assertEquals([], catalog.zone_ids())
+    self.assertFalse('America/New_York' in catalog)
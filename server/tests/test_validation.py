@@ -0,0 +1,57 @@
+import unittest
+from dto import UserDto, TimezoneDto
+from validation import Schema, String, Integer
+
+
+class TestSchema(unittest.TestCase):
+  def testRulesRunInOrderOncePerField(self):
+    validate = Schema(
+      String('code', min_length=2, max_length=4, pattern='^[A-Z]+$',
+             pattern_message='must be uppercase'),
+      Integer('count', required=False, greater_than=0, less_than=10)).compile()
+    self.assertEquals([], validate(dict(code='AB')))
+    self.assertEquals([('code', 'is missing')], validate({}))
+    self.assertEquals([('', 'type error')], validate([]))
+    self.assertEquals([('code', 'must be at least 2 characters long'),
+                       ('count', 'value out of range')],
+                      validate(dict(code='A', count=10)))
+    self.assertEquals([('code', 'must be uppercase'),
+                       ('count', 'must be an integer')],
+                      validate(dict(code='ab', count=True)))
+    self.assertEquals([('code', 'must be shorter than 4 characters')],
+                      validate(dict(code='ABCDE', count=9)))
+
+  def testQuotesNamesAndMessages(self):
+    validate = Schema(String("it's", pattern='x',
+                             pattern_message='no "x"')).compile()
+    self.assertEquals([("it's", 'no "x"')], validate({"it's": 'y'}))
+
+
+class TestDtoValidation(unittest.TestCase):
+  def timezone(self, **values):
+    return TimezoneDto.validate_fields(dict(dict(city='Rosario', name='ART',
+                                                 gmt_delta_seconds=-10800),
+                                            **values))
+
+  def testTimezone(self):
+    self.assertEquals([], self.timezone())
+    self.assertEquals([('name', 'must not be empty')], self.timezone(name=''))
+    self.assertEquals([('name', 'must be shorter than 50 characters')],
+                      self.timezone(name='x' * 51))
+    self.assertEquals([('gmt_delta_seconds', 'must be an integer')],
+                      self.timezone(gmt_delta_seconds='0'))
+    self.assertEquals([('gmt_delta_seconds', 'value out of range')],
+                      self.timezone(gmt_delta_seconds=15 * 60 * 60))
+
+  def testUser(self):
+    self.assertEquals([], UserDto.validate(dict(login='someone',
+                                                password='secret')))
+    self.assertEquals([('login', 'must begin followed by alphanumerics'),
+                       ('name', 'must be at least 5 characters long'),
+                       ('password', 'is missing')],
+                      sorted(UserDto.validate(dict(login='1someone',
+                                                   name='x'))))
+    self.assertEquals([('login', 'must be shorter than 50 characters')],
+                      UserDto.validate_login(dict(login='x' * 51,
+                                                  password='secret',
+                                                  name=5)))
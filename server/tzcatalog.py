@@ -0,0 +1,295 @@
+import argparse
+from bisect import bisect_right
+import calendar
+import datetime
+import json
+import logging
+import mmap
+import os
+import re
+import struct
+import threading
+import time
+import numpy
+
+log = logging.getLogger(__name__)
+
+# transitions for instants before a zone's first one, see _compile_zone
+_MIN_TIME = -2 ** 63
+_NEVER = 2 ** 63 - 1
+# POSIX TZ rules repeat every 400 gregorian years, to the second
+_CYCLE = 146097 * 24 * 60 * 60
+_EPOCH = datetime.date(1970, 1, 1).toordinal()
+_MAGIC = 'TZCAT1\n'
+# leap second variants, duplicates and the host's own zone
+_SKIP = frozenset({'posix', 'right', 'localtime', 'posixrules'})
+
+
+def _seconds(text):
+  # [+-]hh[:mm[:ss]]
+  sign = -1 if text.startswith('-') else 1
+  parts = [int(part) for part in text.lstrip('+-').split(':')]
+  parts += [0] * (3 - len(parts))
+  return sign * (parts[0] * 3600 + parts[1] * 60 + parts[2])
+
+
+_NAME = r'(?:<[^>]+>|[A-Za-z]{3,})'
+_OFFSET = r'[+-]?\d{1,3}(?::\d{1,2}){0,2}'
+_RULE = r'(?:J\d{1,3}|\d{1,3}|M\d{1,2}\.\d\.\d)(?:/' + _OFFSET + ')?'
+_TZ = re.compile('^{n}({o})(?:{n}({o})?,({r}),({r}))?$'.format(
+  n=_NAME, o=_OFFSET, r=_RULE))
+
+
+def parse_posix_tz(tz):
+  # -> (std offset, None) or (std offset, (dst offset, start, end)), offsets
+  # east of UTC; None when the zone has no rule (or one we can't read)
+  match = _TZ.match(tz)
+  if match is None:
+    return None
+  std_text, dst_text, start, end = match.groups()
+  # POSIX offsets are west of UTC
+  std = -_seconds(std_text)
+  if start is None:
+    return std, None
+  dst = std + 3600 if dst_text is None else -_seconds(dst_text)
+  return std, (dst, _parse_rule(start), _parse_rule(end))
+
+
+def _parse_rule(rule):
+  date, _, at = rule.partition('/')
+  return date, _seconds(at) if at else 2 * 3600
+
+
+def _rule_day(date, year):
+  # -> days since the epoch of the rule's date in year
+  leap = calendar.isleap(year)
+  jan1 = datetime.date(year, 1, 1).toordinal() - _EPOCH
+  if date.startswith('J'):
+    day = int(date[1:]) - 1
+    return jan1 + day + (1 if leap and day >= 59 else 0)
+  if not date.startswith('M'):
+    return jan1 + int(date)
+  month, week, weekday = [int(part) for part in date[1:].split('.')]
+  first = datetime.date(year, month, 1)
+  day = 1 + (weekday - (first.weekday() + 1)) % 7 + (week - 1) * 7
+  last = calendar.monthrange(year, month)[1]
+  while day > last:
+    day -= 7
+  return first.toordinal() - _EPOCH + day - 1
+
+
+def _rule_transitions(rule, first_year, last_year):
+  # -> [(utc instant, offset)] the rule produces over those years
+  std, (dst, (start, start_at), (end, end_at)) = rule
+  transitions = []
+  for year in xrange(first_year, last_year + 1):
+    # starts are given in standard time, ends in daylight time
+    transitions.append((_rule_day(start, year) * 86400 + start_at - std, dst))
+    transitions.append((_rule_day(end, year) * 86400 + end_at - dst, std))
+  transitions.sort()
+  return transitions
+
+
+def _year(instant):
+  return time.gmtime(max(0, min(instant, 2 ** 34)))[0]
+
+
+def read_tzif(data):
+  # -> (transition times, offset after each, initial offset, POSIX footer)
+  # from a TZif file (RFC 8536), preferring its 64 bit section
+  if data[:4] != 'TZif':
+    raise ValueError('not a TZif file')
+  version = data[4]
+  header = struct.Struct('>4s c 15x 6l')
+  _, _, isutcnt, isstdcnt, leapcnt, timecnt, typecnt, charcnt = \
+    header.unpack_from(data, 0)
+  offset = header.size
+  time_size, time_type = 4, '>i4'
+  if version >= '2':
+    offset += (timecnt * 5 + typecnt * 6 + charcnt + leapcnt * 8 + isstdcnt +
+               isutcnt)
+    _, _, isutcnt, isstdcnt, leapcnt, timecnt, typecnt, charcnt = \
+      header.unpack_from(data, offset)
+    offset += header.size
+    time_size, time_type = 8, '>i8'
+  times = numpy.frombuffer(data, time_type, timecnt, offset).astype(
+    numpy.int64)
+  offset += timecnt * time_size
+  indexes = numpy.frombuffer(data, numpy.uint8, timecnt, offset)
+  offset += timecnt
+  utoffs = [struct.unpack_from('>l', data, offset + i * 6)[0]
+            for i in xrange(typecnt)]
+  offset += (typecnt * 6 + charcnt + leapcnt * (time_size + 4) + isstdcnt +
+             isutcnt)
+  footer = ''
+  if version >= '2':
+    footer = data[offset:].strip('\n').split('\n')[0]
+  offsets = numpy.array(utoffs, numpy.int32)[indexes]
+  return times, offsets, utoffs[0], footer
+
+
+def _compile_zone(data):
+  # -> (transitions, offsets, fold), every table starting with a _MIN_TIME
+  # entry so a lookup always lands on one. Past the explicit transitions the
+  # POSIX rule is expanded for 400 years; instants after fold map back into
+  # them by whole cycles.
+  times, offsets, initial, footer = read_tzif(data)
+  times = [_MIN_TIME] + times.tolist()
+  offsets = [initial] + offsets.tolist()
+  rule = parse_posix_tz(footer) if footer else None
+  fold = _NEVER
+  if rule is not None and rule[1] is not None:
+    first_year = _year(times[-1]) if len(times) > 1 else 1970
+    for instant, offset in _rule_transitions(rule, first_year,
+                                             first_year + 401):
+      if instant > times[-1]:
+        times.append(instant)
+        offsets.append(offset)
+    fold = (datetime.date(first_year + 1, 1, 1).toordinal() - _EPOCH) * 86400
+  return times, offsets, fold
+
+
+def _source_version(zoneinfo_dir):
+  try:
+    with open(os.path.join(zoneinfo_dir, 'tzdata.zi')) as source:
+      return source.readline().strip()
+  except IOError:
+    return str(os.stat(zoneinfo_dir).st_mtime)
+
+
+def compile_catalog(zoneinfo_dir, output):
+  # writes every zone under zoneinfo_dir to one file: the magic, a JSON
+  # index of zone -> [start, end, fold], then all the transition times
+  # (int64) and the offsets (int32) after them, back to back
+  zones = {}
+  compiled = {}
+  times = []
+  offsets = []
+  for folder, folders, files in os.walk(zoneinfo_dir):
+    folders[:] = sorted(f for f in folders if f not in _SKIP)
+    for name in sorted(files):
+      path = os.path.join(folder, name)
+      zone_id = os.path.relpath(path, zoneinfo_dir)
+      if name in _SKIP:
+        continue
+      real = os.path.realpath(path)
+      if real not in compiled:
+        with open(path, 'rb') as source:
+          data = source.read()
+        if data[:4] != 'TZif':
+          continue
+        zone_times, zone_offsets, fold = _compile_zone(data)
+        compiled[real] = [len(times), len(times) + len(zone_times), fold]
+        times.extend(zone_times)
+        offsets.extend(zone_offsets)
+      # links share their target's tables
+      zones[zone_id] = compiled[real]
+  index = json.dumps(dict(version=_source_version(zoneinfo_dir),
+                          count=len(times), zones=zones), sort_keys=True)
+  # the arrays start 8 byte aligned
+  index += ' ' * (-(len(_MAGIC) + 4 + len(index)) % 8)
+  folder = os.path.dirname(output)
+  if folder and not os.path.isdir(folder):
+    os.makedirs(folder)
+  temporary = '{}.{}.tmp'.format(output, os.getpid())
+  with open(temporary, 'wb') as out:
+    out.write(_MAGIC)
+    out.write(struct.pack('<l', len(index)))
+    out.write(index)
+    out.write(numpy.array(times, '<i8').tostring())
+    out.write(numpy.array(offsets, '<i4').tostring())
+  os.rename(temporary, output)
+
+
+# Maps IANA zone ids to their UTC offset at any instant. The tables are
+# compiled from zoneinfo_dir once into tzcatalog_path, recompiled when the
+# tzdata version changes, and memory mapped on first use: lookups are a
+# binary search over a zone's transitions, no file is read per request.
+class TzCatalog(object):
+  def __init__(self, zoneinfo_dir, tzcatalog_path, metrics):
+    self.zoneinfo_dir = zoneinfo_dir
+    self.path = tzcatalog_path
+    self.lock = threading.Lock()
+    self.zones = None
+    self.load_time = metrics.gauge('tzcatalog_load_seconds',
+                                   'Time taken to load the zone catalog')
+    metrics.gauge('tzcatalog_zones', 'Zones in the catalog',
+                  lambda: len(self.zones or ()))
+
+  def load(self):
+    with self.lock:
+      if self.zones is not None:
+        return
+      start = time.time()
+      if not os.path.isdir(self.zoneinfo_dir):
+        log.warning('no zoneinfo at %s, the catalog is empty',
+                    self.zoneinfo_dir)
+        self.zones = {}
+        return
+      if not self._map():
+        compile_catalog(self.zoneinfo_dir, self.path)
+        if not self._map():
+          raise ValueError('could not load ' + self.path)
+      self.load_time.set(time.time() - start)
+      log.info('loaded %d zones in %.1fms', len(self.zones),
+               (time.time() - start) * 1000)
+
+  def _map(self):
+    # False when the file is missing or stale
+    try:
+      with open(self.path, 'rb') as source:
+        data = mmap.mmap(source.fileno(), 0, access=mmap.ACCESS_READ)
+    except (IOError, ValueError, mmap.error):
+      return False
+    if data[:len(_MAGIC)] != _MAGIC:
+      return False
+    offset = len(_MAGIC) + 4
+    length = struct.unpack_from('<l', data, len(_MAGIC))[0]
+    index = json.loads(data[offset:offset + length])
+    if index['version'] != _source_version(self.zoneinfo_dir):
+      return False
+    offset += length
+    count = index['count']
+    self.times = numpy.frombuffer(data, '<i8', count, offset)
+    self.offsets = numpy.frombuffer(data, '<i4', count, offset + count * 8)
+    self.zones = {str(zone_id): tuple(entry)
+                  for zone_id, entry in index['zones'].iteritems()}
+    return True
+
+  def __contains__(self, zone_id):
+    self.load()
+    return zone_id in self.zones
+
+  def zone_ids(self):
+    self.load()
+    return sorted(self.zones)
+
+  def offset(self, zone_id, instant):
+    self.load()
+    start, end, fold = self.zones[zone_id]
+    if instant >= fold:
+      instant = fold + (instant - fold) % _CYCLE
+    return int(self.offsets[bisect_right(self.times, instant, start, end) - 1])
+
+  def offsets_at(self, zone_id, instants):
+    # instants: an int64 array of seconds since the epoch
+    self.load()
+    start, end, fold = self.zones[zone_id]
+    if fold != _NEVER:
+      instants = numpy.where(instants >= fold,
+                             fold + (instants - fold) % _CYCLE, instants)
+    found = numpy.searchsorted(self.times[start:end], instants, 'right')
+    return self.offsets[start:end][found - 1]
+
+  def list(self, args, request):
+    return self.zone_ids()
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Compile the zone catalog.')
+  parser.add_argument('--zoneinfo', default='/usr/share/zoneinfo')
+  parser.add_argument('--output', default='db/tzcatalog.bin')
+  args = parser.parse_args()
+  start = time.time()
+  compile_catalog(args.zoneinfo, args.output)
+  print 'compiled in {:.0f}ms'.format((time.time() - start) * 1000)
@@ -0,0 +1,98 @@
+import re
+
+
+# Declarative field rules for request messages. A Schema compiles its fields
+# once into the source of a plain function, the same if/elif chain one would
+# write by hand, so validating costs no more than the hand-written checks did.
+# Validators return lists of (field, message) tuples, as Errors.validation
+# expects.
+class Field(object):
+  def __init__(self, name, required=True):
+    self.name = name
+    self.required = required
+
+  def checks(self, constant):
+    # (failing condition on `value`, message) pairs, tried in order
+    raise NotImplementedError()
+
+
+class String(Field):
+  def __init__(self, name, required=True, min_length=None, max_length=None,
+               pattern=None, pattern_message=None):
+    Field.__init__(self, name, required)
+    self.min_length = min_length
+    self.max_length = max_length
+    self.pattern = pattern
+    self.pattern_message = pattern_message
+
+  def checks(self, constant):
+    checks = [('not isinstance(value, basestring)', 'must be a string')]
+    if self.min_length == 1:
+      checks.append(('len(value) == 0', 'must not be empty'))
+    elif self.min_length is not None:
+      checks.append(('len(value) < {:d}'.format(self.min_length),
+                     'must be at least {} characters long'
+                     .format(self.min_length)))
+    if self.max_length is not None:
+      checks.append(('len(value) > {:d}'.format(self.max_length),
+                     'must be shorter than {} characters'
+                     .format(self.max_length)))
+    if self.pattern is not None:
+      checks.append(('not {}.match(value)'.format(
+        constant(re.compile(self.pattern))), self.pattern_message))
+    return checks
+
+
+class Integer(Field):
+  # bounds are exclusive
+  def __init__(self, name, required=True, greater_than=None, less_than=None):
+    Field.__init__(self, name, required)
+    self.greater_than = greater_than
+    self.less_than = less_than
+
+  def checks(self, constant):
+    # bools are ints to isinstance
+    checks = [('type(value) not in (int, long)', 'must be an integer')]
+    bounds = []
+    if self.greater_than is not None:
+      bounds.append('{:d} < value'.format(self.greater_than))
+    if self.less_than is not None:
+      bounds.append('value < {:d}'.format(self.less_than))
+    if len(bounds) > 0:
+      checks.append(('not ({})'.format(' and '.join(bounds)),
+                     'value out of range'))
+    return checks
+
+
+class Schema(object):
+  def __init__(self, *fields):
+    self.fields = fields
+
+  def compile(self):
+    namespace = {}
+
+    def constant(value):
+      name = '_c{}'.format(len(namespace))
+      namespace[name] = value
+      return name
+
+    lines = ['def validate(msg):',
+             '  if not isinstance(msg, dict):',
+             "    return [('', 'type error')]",
+             '  errors = []']
+    for field in self.fields:
+      lines.append('  value = msg.get({!r})'.format(field.name))
+      lines.append('  if value is None:')
+      if field.required:
+        lines.append('    errors.append(({!r}, {!r}))'.format(field.name,
+                                                            'is missing'))
+      else:
+        lines.append('    pass')
+      for condition, message in field.checks(constant):
+        lines.append('  elif {}:'.format(condition))
+        lines.append('    errors.append(({!r}, {!r}))'.format(field.name,
+                                                            message))
+    lines.append('  return errors')
+    code = compile('\n'.join(lines), '<schema>', 'exec')
+    exec code in namespace
+    return namespace['validate']
@@ -2,14 +2,25 @@ import argparse
 import base64
 import json
 import datetime
+import functools
+import multiprocessing
+import os
+import sys
+import tempfile
 import passlib.hash
 import pinject
+from werkzeug.routing import Rule
 import auth
 import request_scope
 import rest_server
+import services, dto, db, hashing, metrics, query_stats, profiling
+import compression, read_model, results, search, serving, static_assets
+import tzcatalog, validation
 
-#keep these unused imports, pinject needs them to find providers
-import services, dto, db
+try:
+  import ujson
+except ImportError:
+  ujson = None
 
 
 class WebModule(pinject.BindingSpec):
@@ -18,19 +29,73 @@ class WebModule(pinject.BindingSpec):
 
   def configure(self, bind):
     bind('auth', to_class=auth.TokenAuthentication)
-    bind('json_encoder', to_class=json.JSONEncoder)
+    if ujson is not None:
+      bind('json_encoder', to_instance=rest_server.DumpsEncoder(
+        functools.partial(ujson.dumps, escape_forward_slashes=False)))
+    else:
+      bind('json_encoder', to_class=json.JSONEncoder)
     bind('token_ttl', to_instance=datetime.timedelta(hours=24))
-    bind('password_manager', to_instance=passlib.hash.sha256_crypt)
+    # refreshing extends a session up to this long after the password login
+    bind('max_session_age', to_instance=datetime.timedelta(days=30))
+    bind('token_cache_size', to_instance=10000)
+    bind('trust_token_claims', to_instance=True)
+    bind('user_cache_size', to_instance=10000)
+    bind('hashing_queue_size', to_instance=64)
+    bind('hashing_timeout', to_instance=5)
     bind('request_cls', to_instance=rest_server.JSONRequest)
+    bind('max_page_size', to_instance=1000)
+    bind('max_batch_operations', to_instance=10000)
+    bind('max_convert_instants', to_instance=100000)
+    # instants times timezones in one conversion
+    bind('max_convert_values', to_instance=10 ** 7)
+    bind('max_overlap_days', to_instance=366)
+    # pre-encoded timezones kept in memory, 0 to always read the database
+    bind('read_model_max_bytes', to_instance=64 * 1024 * 1024)
+    # batches get their own ceiling, above JSONRequest.max_content_length
+    bind('batch_max_content_length', to_instance=1024 * 1024 * 16)
+    # where Prometheus scrapes the metrics from, '' to not serve them
+    bind('metrics_path', to_instance='/metrics')
+    bind('slow_query_seconds', to_instance=0.1)
+    # a SELECT repeated this often in one request is likely run once per row
+    bind('repeated_query_threshold', to_instance=10)
+    bind('profile_dir', to_instance='profiles')
+    bind('profile_keep', to_instance=50)
+    # zlib level 1-9, 0 to not compress responses
+    bind('compression_level', to_instance=6)
+    bind('compression_min_size', to_instance=1024)
+    bind('zoneinfo_dir', to_instance='/usr/share/zoneinfo')
+
+  def provide_password_manager(self, password_hash_rounds):
+    return hashing.RoundsPasswordManager(passlib.hash.sha256_crypt,
+                                         password_hash_rounds)
 
   def provide_web_app(self, json_exception_wrapper, rest_router, user_service,
-                      timezone_service, auth_service):
+                      timezone_service, auth_service, batch_max_content_length,
+                      request_plan, metrics, metrics_middleware, metrics_path,
+                      query_stats_middleware, debug, profiling_middleware,
+                      tz_catalog, compression_middleware):
     rest_router.add_rule(rest_server.RestRules('/auth').create,
                          auth_service.login)
+    rest_router.add_rule(Rule('/auth/refresh', methods=['POST'],
+                              endpoint='/auth/refresh'), auth_service.refresh)
     rest_router.add_resource(user_service, '/users')
-    rest_router.add_resource(timezone_service, '/timezones')
-    return rest_server.MiddlewareLink.build(
-      [json_exception_wrapper, self.req_scope_middleware], rest_router)
+    rest_router.add_resource(timezone_service, '/timezones',
+                             dict(batch=batch_max_content_length))
+    rest_router.add_rule(Rule('/zones', methods=['GET'], endpoint='/zones'),
+                         tz_catalog.list)
+    if metrics_path:
+      rest_router.add_rule(Rule(metrics_path, methods=['GET'],
+                                endpoint=metrics_path), metrics.export)
+    request_plan.compile(rest_router.handlers)
+    chain = [metrics_middleware]
+    if compression_middleware.enabled:
+      chain.append(compression_middleware)
+    chain += [json_exception_wrapper, self.req_scope_middleware]
+    if debug:
+      chain.append(query_stats_middleware)
+    if profiling_middleware.enabled:
+      chain.append(profiling_middleware)
+    return rest_server.MiddlewareLink.build(chain, rest_router)
 
 
 class CmdlineModule(pinject.BindingSpec):
@@ -40,6 +105,14 @@ class CmdlineModule(pinject.BindingSpec):
     parser.add_argument('--port', type=int, default=8000, help='bind port')
     parser.add_argument('--client', type=str, default='../client',
                         help='serve web app static files')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='worker processes (more than 1 pre-forks)')
+    parser.add_argument('--threads', type=int, default=1,
+                        help='request threads per worker process')
+    parser.add_argument('--profile-sample-rate', type=int, default=0,
+                        help='profile one in this many requests, 0 for none')
+    parser.add_argument('--profile-secret-file', default=None,
+                        help='key for signed X-Profile request headers')
     return parser.parse_args()
 
   def provide_host(self, cmdline_args):
@@ -51,34 +124,71 @@ class CmdlineModule(pinject.BindingSpec):
   def provide_client_folder(self, cmdline_args):
     return cmdline_args.client
 
+  def provide_workers(self, cmdline_args):
+    return cmdline_args.workers
+
+  def provide_threads(self, cmdline_args):
+    return cmdline_args.threads
+
+  def provide_profile_sample_rate(self, cmdline_args):
+    return cmdline_args.profile_sample_rate
+
+  def provide_profile_secret(self, cmdline_args):
+    if cmdline_args.profile_secret_file is None:
+      return ''
+    return open(cmdline_args.profile_secret_file).read().strip()
+
 
 class DevConfigModule(pinject.BindingSpec):
   def configure(self, bind):
     bind('db_url', to_instance='sqlite:///db/db.sqlite')
-    bind('db_verbose', to_instance=True)
+    # slow statements are logged by QueryStatsMiddleware instead
+    bind('db_verbose', to_instance=False)
+    bind('debug', to_instance=True)
+    bind('hashing_workers', to_instance=multiprocessing.cpu_count())
+    bind('password_hash_rounds',
+         to_instance=passlib.hash.sha256_crypt.default_rounds)
+    bind('tzcatalog_path', to_instance='db/tzcatalog.bin')
 
   def provide_jwt_secret(self):
     return base64.decodestring(open('jwt_secret.txt').read())
 
 
 class TestConfigModule(pinject.BindingSpec):
+  def __init__(self, db_url='sqlite://'):  #in memory by default
+    self.db_url = db_url
+
   def configure(self, bind):
-    bind('db_url', to_instance='sqlite://')  #in memory
+    bind('db_url', to_instance=self.db_url)
     bind('db_verbose', to_instance=False)
+    bind('debug', to_instance=True)
+    bind('hashing_workers', to_instance=0)
+    # the minimum passlib accepts, hashing dominated the suite's run time
+    bind('password_hash_rounds', to_instance=1000)
+    bind('profile_secret', to_instance='')
+    bind('profile_sample_rate', to_instance=0)
+    # compiled by the first test run, reused until tzdata changes
+    bind('tzcatalog_path', to_instance=os.path.join(tempfile.gettempdir(),
+                                                    'timezones-tzcatalog.bin'))
 
   def provide_jwt_secret(self):
     return 'test'
 
 
+GRAPH_MODULES = [auth, compression, db, dto, hashing, metrics, profiling,
+                 query_stats, read_model, request_scope, rest_server, results,
+                 search, serving, services, static_assets, tzcatalog,
+                 validation,
+                 sys.modules[__name__]]
+
+
 def web_graph(*extra_specs):
   req_scope_module = request_scope.RequestScopeModule()
   specs = [req_scope_module,
            WebModule(req_scope_module.middleware),
            db.DbModule()] + list(extra_specs)
-  return pinject.new_object_graph(
-    binding_specs=specs,
-    id_to_scope=req_scope_module.id_to_scope,
-    is_scope_usable_from_scope=req_scope_module.is_usable
-  )
+  # scanning every loaded module for classes costs tens of milliseconds,
+  # which the tests pay for each graph they build
+  return pinject.new_object_graph(modules=GRAPH_MODULES, binding_specs=specs)
 
 